@@ -2,59 +2,72 @@ import os
 import time
 import random
 import streamlit as st
-import subprocess
-from PIL import Image
 
-from retrieve import retrieve_and_return
+from retrieve import retrieve_stream
 from descr_generator import generate_image_descrptions, rename_images, get_pics_without_descrs, create_embeddings, update_embeddings
-from utils import validate_openai_api_key, get_image_count, get_descr_filepath, query_for_related_descriptions
-#TODO: state for importing so firebase only inits once??
-from fb_storage_utils import init_app, upload_images_from_list, upload_json_descriptions_file, download_descr_file, does_image_folder_exist
+from utils import validate_openai_api_key, get_image_count, get_descr_filepath, get_embeddings_store_dir
+from vector_store import ensure_vector_store
+from descr_store import export_descriptions_json, descr_log_path
+from search_session import SearchSession
+from result_cache import RESULT_CACHE
+from image_utils import get_rendition, THUMBNAIL_CACHE
+from hash_catalog import (bytes_hash, catalog_album, find_duplicate_in_album, reuse_known_images, missing_vector_rows,
+                          add_entries as add_catalog_entries)
+#remote storage clients are created on first use, see storage_backends.py
+from fb_storage_utils import upload_images_from_list, upload_json_descriptions_file, download_descr_file, does_image_folder_exist
+from sync_worker import get_sync_service, SYNC_QUEUED, SYNC_DESCRIPTIONS, SYNC_IMAGES, SYNC_FAILED
 
 MAIN_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIRECTORY = os.path.join(MAIN_DIR, 'data')
 
 JSON_DESCR_FILENAME = 'descriptions.json'
 
-DEPLOYED_PYTHON_PATH = '/home/adminuser/venv/bin/python'
-
-FIXED_WIDTH = 300
-FIXED_HEIGHT = 400
-
+GALLERY_PAGE_SIZE = 24
+#seconds between reruns while a background sync is running
+SYNC_POLL_INTERVAL = 1.0
 
 def sync_local_with_remote(api_key):
-    # TODO: st state to kick off subprocess only once, rest of function
-    # TODO     checks completion to be ran on repeat until process complete.
+    """
+    queue a background sync of the album's descriptions and images, progress is polled with display_sync_status
+    """
     basename = create_image_dir_name(api_key)
     json_descr_file = os.path.join(DATA_DIRECTORY, basename, JSON_DESCR_FILENAME)
     local_images_folder_path = os.path.join(DATA_DIRECTORY, basename, 'images')
 
     print('SYNCING LOCAL WITH REMOTE')
+    st.session_state.sync_job_id = get_sync_service().submit(basename, json_descr_file, local_images_folder_path)
+    st.session_state.images_dir = local_images_folder_path
+    return True
 
-    if os.path.exists(DEPLOYED_PYTHON_PATH):
-        python_path = DEPLOYED_PYTHON_PATH
-    else:
-        python_path = 'python'
-
-    proc_cmd = [
-        python_path,
-        'fb_storage_utils.py',
-        json_descr_file,
-        local_images_folder_path
-    ]
-    process = subprocess.Popen(proc_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-
-    # Check if the subprocess ended without errors
-    if process.returncode == 0:
+
+def display_sync_status():
+    """
+    show progress of the session's sync job, returns True once descriptions are available locally
+    """
+    job_id = st.session_state.sync_job_id
+    if job_id is None:
+        return True
+    status = get_sync_service().status(job_id)
+    if status is None:
         return True
+
+    if status['state'] in (SYNC_QUEUED, SYNC_DESCRIPTIONS):
+        st.info('Syncing descriptions...')
+    elif status['state'] == SYNC_IMAGES:
+        if status['total']:
+            st.progress(status['done'] / status['total'],
+                        text=f"Downloading images {status['done']}/{status['total']}, search is available")
+        else:
+            st.info('Listing images...')
+    elif status['state'] == SYNC_FAILED:
+        st.error(f"Sync encountered an error: {status['error']}")
+        st.session_state.sync_job_id = None
     else:
-        st.error("Script encountered an error.")
-        st.error(stderr.decode())
-        return False
+        st.session_state.sync_job_id = None
+    return status['descriptions_ready'] or status['state'] == SYNC_FAILED
 
 
-def send_request(prompt):
+def send_request(prompt, search_session=None):
     print(f"SENDING REQUEST: {prompt}")
     print('-----')
 
@@ -69,12 +82,25 @@ def send_request(prompt):
             base_dir = os.path.dirname(images_dir)
             json_file_path = os.path.join(base_dir, JSON_DESCR_FILENAME)
     
-            if not os.path.exists(json_file_path):
+            if not os.path.exists(json_file_path) and not os.path.exists(descr_log_path(json_file_path)):
                 print('descriptions file not found, getting from firebase')
                 download_descr_file(json_file_path)
 
             start_t = time.perf_counter()
-            output_image_names = retrieve_and_return(json_file_path, prompt, st.session_state.user_openai_api_key)
+            #show each top result as soon as the model names it, the placeholder is replaced by the final grid
+            output_image_names = []
+            found_paths = []
+            stream_placeholder = st.empty()
+            for img in retrieve_stream(json_file_path, prompt, st.session_state.user_openai_api_key,
+                                       search_session=search_session):
+                output_image_names.append(img)
+                img_path = os.path.join(images_dir, img)
+                if os.path.exists(img_path):
+                    found_paths.append(img_path)
+                    with stream_placeholder.container():
+                        st.text(f"Found {len(found_paths)} images so far...")
+                        display_image_grid(found_paths, columns=2, caption="Top Result")
+            stream_placeholder.empty()
             end_t = time.perf_counter()
 
             print('output images list:', output_image_names)
@@ -122,27 +148,7 @@ def user_folder_exists_remote(api_key):
         return False
 
 
-def resize_and_crop_image(image, fixed_width=FIXED_WIDTH, max_height=FIXED_HEIGHT):
-    width, height = image.size
-    aspect_ratio = height / width
-
-    new_height = int(fixed_width * aspect_ratio)
-    
-    #resize the image to the fixed width while maintaining aspect ratio
-    resized_image = image.resize((fixed_width, new_height))
-    
-    #crop the image if its height exceeds the max height
-    if new_height > max_height:
-        top = (new_height - max_height) // 2
-        bottom = top + max_height
-
-        resized_image = resized_image.crop((0, top, fixed_width, bottom))
-    
-    return resized_image
-
-
 def on_generate_button_submit(uploaded_images, from_uploaded=True, generate=True):
-    st.session_state.name_and_image_dict = dict()
     st.session_state.init_display_images = True
     st.session_state.search_result_images = []
 
@@ -156,19 +162,39 @@ def on_generate_button_submit(uploaded_images, from_uploaded=True, generate=True
         os.makedirs(images_dir)
         print('image folder created')
     
+    album_dir = os.path.dirname(images_dir)
+    catalog_album(album_dir)
+
     if from_uploaded:
         uploads_to_firestore = []
-        uploaded_img_names = [img.name for img in uploaded_images]
 
-        new_uploaded_img_names = rename_images(images_dir, uploaded_img_names)
+        #drop uploads this album already has (same bytes), before writing, uploading or describing them
+        new_uploads = []
+        upload_hashes = set()
+        duplicate_count = 0
+        for uploaded_img in uploaded_images:
+            content_hash = bytes_hash(uploaded_img.getbuffer())
+            if content_hash in upload_hashes or find_duplicate_in_album(content_hash, album_dir):
+                duplicate_count += 1
+                continue
+            upload_hashes.add(content_hash)
+            new_uploads.append((uploaded_img, content_hash))
+        if duplicate_count:
+            st.info(f"Skipped {duplicate_count} duplicate images already in this album")
+
+        uploaded_img_names = [img.name for img, _ in new_uploads]
+        new_uploaded_img_names = rename_images(images_dir, uploaded_img_names) if uploaded_img_names else []
     
-        for uploaded_img, img_name in zip(uploaded_images, new_uploaded_img_names):
+        catalog_entries = []
+        for (uploaded_img, content_hash), img_name in zip(new_uploads, new_uploaded_img_names):
             file_path = os.path.join(images_dir, img_name)
 
             #write the uploaded file to the file system
             with open(file_path, "wb") as f:
                 f.write(uploaded_img.getbuffer())
             uploads_to_firestore.append(file_path)
+            catalog_entries.append((content_hash, os.path.basename(album_dir), img_name))
+        add_catalog_entries(catalog_entries)
 
         #TODO: One succuess bar, add images while looping?
         st.success(f"Images saved")
@@ -176,7 +202,13 @@ def on_generate_button_submit(uploaded_images, from_uploaded=True, generate=True
         #FIREBASE - STORE IMAGES
         if uploads_to_firestore:
             print('uploading images to firebase')
-            upload_images_from_list(uploads_to_firestore)
+            upload_progress = st.progress(0.0)
+            def on_upload_progress(done_count, total_count):
+                upload_progress.progress(done_count / total_count, text=f"Uploading images, {done_count}/{total_count} done")
+
+            upload_report = upload_images_from_list(uploads_to_firestore, progress_callback=on_upload_progress)
+            if upload_report['failed']:
+                st.warning(f"{len(upload_report['failed'])} images failed to upload, they will be retried on the next upload")
             print('finished uploading to firebase')
 
     #NOTE: dev-only param
@@ -186,18 +218,29 @@ def on_generate_button_submit(uploaded_images, from_uploaded=True, generate=True
             #rename_files_in_directory(images_dir)
             ...
         new_images = get_pics_without_descrs(images_dir)
-        new_descriptions = []
+        new_descriptions = dict()
         api_key = st.session_state.user_openai_api_key
         generate_total_time = 0.0
+
+        #images already described elsewhere (same content) reuse that description and embedding, no api calls
+        reused_descriptions = reuse_known_images(album_dir, new_images)
+        if reused_descriptions:
+            st.info(f"Reused descriptions for {len(reused_descriptions)} previously described images")
+            new_images = [img for img in new_images if img not in reused_descriptions]
+            for img_name in missing_vector_rows(album_dir, reused_descriptions.keys()):
+                new_descriptions[img_name] = reused_descriptions[img_name]
+
         if new_images:
             for i, generation_result in enumerate(generate_image_descrptions(new_images, images_dir, api_key)):
-                new_descr = generation_result[0]
+                if generation_result == 0:
+                    st.write(f"({i+1}/{len(new_images)}) Failed generating a description")
+                    continue
+                new_descr, generation_time, img_name = generation_result
 
-                generation_time = generation_result[1]
                 generate_total_time += generation_time
 
-                st.write(f"({i+1}/{len(new_images)}) Finished generating for {new_images[i]} in {generation_time} seconds")
-                new_descriptions.append(new_descr)
+                st.write(f"({i+1}/{len(new_images)}) Finished generating for {img_name} in {generation_time} seconds")
+                new_descriptions[img_name] = new_descr
 
         if type(generate_total_time) == list: #unsuccesful generate/did not finish
             st.error('Error occured while generating... press generate to try again.')
@@ -209,14 +252,21 @@ def on_generate_button_submit(uploaded_images, from_uploaded=True, generate=True
             descr_filepath = get_descr_filepath(images_dir)
 
             #EMBEDDINGS - LOCAL
-            embeddings_pickle_file = os.path.join(DATA_DIRECTORY, foldername, 'embeddings.pkl')
+            embeddings_store_dir = get_embeddings_store_dir(images_dir)
             t_start_embeddings = time.perf_counter()
-            if os.path.exists(embeddings_pickle_file):
+            embeddings_progress = st.progress(0.0)
+            def on_embeddings_progress(done_count, total_count):
+                embeddings_progress.progress(done_count / total_count,
+                                             text=f"Embedded {done_count}/{total_count} descriptions")
+
+            if ensure_vector_store(embeddings_store_dir):
                 st.write("Updating Embeddings....")
-                update_embeddings(api_key, embeddings_pickle_file, new_descriptions)
+                update_embeddings(api_key, embeddings_store_dir, new_descriptions,
+                                  progress_callback=on_embeddings_progress)
             else:
                 st.write("Generating Embeddings....")
-                create_embeddings(api_key, embeddings_pickle_file, descr_filepath)
+                create_embeddings(api_key, embeddings_store_dir, descr_filepath,
+                                  progress_callback=on_embeddings_progress)
 
             t_end_embeddings = time.perf_counter()
             embeddings_time = round(t_end_embeddings - t_start_embeddings, 2)
@@ -225,29 +275,46 @@ def on_generate_button_submit(uploaded_images, from_uploaded=True, generate=True
 
             #FIREBASE - STORE JSON
             print('starting json upload')
-            upload_json_descriptions_file(descr_filepath)
+            upload_json_descriptions_file(export_descriptions_json(descr_filepath))
             print('finished json upload')
 
     return True #TODO: handle good/bad return
 
 
-def create_images_dict(images_dir):
-    names_and_images = {}
-    image_paths = [os.path.join(st.session_state.images_dir, img)
-                    for img in os.listdir(images_dir) if img.endswith((".png", ".jpg"))]
+def get_album_image_paths(images_dir):
+    return [os.path.join(images_dir, img) for img in os.listdir(images_dir) if img.endswith((".png", ".jpg"))]
 
-    for img_path in image_paths:
-        opened_img = Image.open(img_path)
-        cropped_img = resize_and_crop_image(opened_img)
-        names_and_images[img_path] = cropped_img
-    
-    return names_and_images
+
+def display_image_grid(image_paths, columns=4, caption=None):
+    """
+    show images in rows of columns, only these thumbnails are resolved and sent to the browser
+    """
+    #thumbnails come from the process-wide cache, shared across sessions
+    thumbnails = THUMBNAIL_CACHE.get_many(image_paths)
+    for i in range(0, len(image_paths), columns):
+        for col, img_path in zip(st.columns(columns), image_paths[i:i+columns]):
+            col.image(thumbnails[img_path], use_column_width=True, caption=caption)
+
+
+def page_controls(state_key, num_pages):
+    """
+    previous/next buttons for a paginated view, current page (0-based) is kept in st.session_state[state_key]
+    """
+    page = min(st.session_state.get(state_key, 0), num_pages - 1)
+    prev_col, info_col, next_col = st.columns([1, 4, 1])
+    if prev_col.button('Previous', key=f"{state_key}_prev", disabled=page <= 0):
+        page -= 1
+    if next_col.button('Next', key=f"{state_key}_next", disabled=page >= num_pages - 1):
+        page += 1
+    page = max(0, min(page, num_pages - 1))
+    info_col.text(f"Page {page + 1} of {num_pages}")
+    st.session_state[state_key] = page
+    return page
 
 
 def retrieval_page():
     images_dir = st.session_state.images_dir
-    if len(st.session_state.name_and_image_dict) == 0:
-        st.session_state.name_and_image_dict = create_images_dict(images_dir)
+    album_image_paths = get_album_image_paths(images_dir)
     
     images_count = get_image_count(images_dir)
     api_key = st.session_state.user_openai_api_key
@@ -260,9 +327,15 @@ def retrieval_page():
         return
 
     #side bar
-    st.sidebar.title("Random image, try to search for this")
-    random_img = random.choice(list(st.session_state.name_and_image_dict.values()))
-    st.sidebar.image(random_img, use_column_width=True)
+    if album_image_paths:
+        st.sidebar.title("Random image, try to search for this")
+        random_img_path = random.choice(album_image_paths)
+        st.sidebar.image(get_rendition(random_img_path, 'preview'), use_column_width=True)
+
+    cache_stats = RESULT_CACHE.stats()
+    if cache_stats['hits'] + cache_stats['misses']:
+        st.sidebar.caption(f"Result cache: {cache_stats['hit_rate']:.0%} hit rate, "
+                           f"{cache_stats['saved_seconds']}s saved (threshold {cache_stats['threshold']})")
 
     st.text("Search through {} images submitted by API Key: {}".format(images_count, api_key))
 
@@ -279,47 +352,31 @@ def retrieval_page():
         #no longer display images without search results
         st.session_state.init_display_images = False
         
-        #TODO: needed?
-        top_col1, top_col2 = st.columns(2)
-        folder_name = os.path.dirname(images_dir)
-        embeddings_pickle_file = os.path.join(DATA_DIRECTORY, folder_name, 'embeddings.pkl')
+        embeddings_store_dir = get_embeddings_store_dir(images_dir)
 
         print("FILE NAMES:")
-        print(embeddings_pickle_file)
+        print(embeddings_store_dir)
         print(images_dir)
 
         t_start = time.perf_counter()
-        images_ranked = query_for_related_descriptions(api_key, user_input, embeddings_pickle_file, images_dir, k=0)
+        #query embedded once, shared by the gallery pages and the retrieval request. only the first page is ranked here
+        search_session = SearchSession(api_key, user_input, embeddings_store_dir, get_descr_filepath(images_dir),
+                                       page_size=GALLERY_PAGE_SIZE)
+        st.session_state.search_session = search_session
+        st.session_state.results_page = 0
+        if search_session.fallback_reason is not None:
+            st.warning("Embedding search is unavailable right now, results are ranked by keyword matches.")
 
         print('\n------------------------------NEW SEARCH------------------------------')
-        
-        if len(images_ranked[0]) > 1:
-            st.session_state.images_ranked = images_ranked[0].tolist()
-            st.session_state.all_images = [os.path.join(st.session_state.images_dir, img)
-                                               for img in st.session_state.images_ranked]
 
         t_end = time.perf_counter()
         print(f"Embeddings Ranking Time: {round(t_end - t_start, 2)}s")
-        send_request(user_input)
+        send_request(user_input, search_session)
     
     if st.session_state.init_display_images:
-        img_list = list(st.session_state.name_and_image_dict.values())
-        for i in range(0, len(img_list), 4):
-            col1, col2, col3, col4 = st.columns(4)
-
-            i1 = img_list[i]
-
-            col1.image(i1, use_column_width=True)
-            
-            if i + 1 < len(img_list):
-                i2 = img_list[i+1]
-                col2.image(i2, use_column_width=True)
-            if i + 2 < len(img_list):
-                i3 = img_list[i+2]
-                col3.image(i3, use_column_width=True)
-            if i + 3 < len(img_list):
-                i4 = img_list[i+3]
-                col4.image(i4, use_column_width=True)
+        num_pages = max(1, -(-len(album_image_paths) // GALLERY_PAGE_SIZE))
+        page = page_controls('gallery_page', num_pages)
+        display_image_grid(album_image_paths[page * GALLERY_PAGE_SIZE : (page + 1) * GALLERY_PAGE_SIZE])
 
     images_to_display = []
     for item_type, content in st.session_state.history:
@@ -328,39 +385,16 @@ def retrieval_page():
         elif item_type == 'image':
             images_to_display.append(content)
 
-    for i in range(0, len(st.session_state.search_result_images), 2):
-        col1, col2 = st.columns(2)
-
-        res_img = st.session_state.name_and_image_dict[st.session_state.search_result_images[i]]
-        col1.image(res_img, use_column_width=True, caption="Top Result")
-        
-        if i + 1 < len(st.session_state.search_result_images):
-            res_img = st.session_state.name_and_image_dict[st.session_state.search_result_images[i+1]]
-            col2.image(res_img, use_column_width=True, caption='Top Tesult')
-
-    #display rest of images in ranked order
-    if not st.session_state.init_display_images:
-        remaining_images = [img for img in st.session_state.all_images 
-                                    if img not in st.session_state.search_result_images]
-    else:
-        remaining_images = []
-
-    for i in range(0, len(remaining_images), 4):
-        col1, col2, col3, col4 = st.columns(4)
-
-        i1 = st.session_state.name_and_image_dict[remaining_images[i]]
+    display_image_grid(st.session_state.search_result_images, columns=2, caption="Top Result")
 
-        col1.image(i1, use_column_width=True)
-        
-        if i + 1 < len(remaining_images):
-            i2 = st.session_state.name_and_image_dict[remaining_images[i+1]]
-            col2.image(i2, use_column_width=True)
-        if i + 2 < len(remaining_images):
-            i3 = st.session_state.name_and_image_dict[remaining_images[i+2]]
-            col3.image(i3, use_column_width=True)
-        if i + 3 < len(remaining_images):
-            i4 = st.session_state.name_and_image_dict[remaining_images[i+3]]
-            col4.image(i4, use_column_width=True)
+    #display rest of images in ranked order, one page at a time
+    search_session = st.session_state.search_session
+    if not st.session_state.init_display_images and search_session is not None:
+        page = page_controls('results_page', search_session.num_pages())
+        remaining_images = [os.path.join(images_dir, img) for img in search_session.ranked_page(page)]
+        remaining_images = [img for img in remaining_images
+                                    if img not in st.session_state.search_result_images and os.path.exists(img)]
+        display_image_grid(remaining_images)
 
 
 def main():
@@ -442,7 +476,8 @@ def main():
                     st.session_state.has_submitted_images = True
                     st.session_state.show_retrieval_page = True
     
-    if st.session_state.has_submitted_images or st.session_state.api_key_exists:
+    descriptions_ready = display_sync_status()
+    if descriptions_ready and (st.session_state.has_submitted_images or st.session_state.api_key_exists):
         if st.session_state.api_key_exists and st.session_state.display_infobar_for_existing_images:
             #one time info bar: tell user there are existing picture the submitted
             st.info('Found Existing images for submitted API Key.')
@@ -468,14 +503,14 @@ def main():
         if st.session_state.show_retrieval_page:
             retrieval_page()
 
+    #rerun to poll the sync job, images downloaded so far show up in the gallery on each pass
+    if st.session_state.sync_job_id is not None and get_sync_service().is_active(st.session_state.sync_job_id):
+        time.sleep(SYNC_POLL_INTERVAL)
+        st.rerun()
+
 
 def make_st_vars():
     #app start point
-    if 'firebase_init' not in st.session_state:
-        print('initing app')
-        st.session_state.firebase_init = True
-        init_app()
-
     if 'submitted_api_key' not in st.session_state:
         st.session_state.submitted_api_key = False
 
@@ -491,19 +526,20 @@ def make_st_vars():
     if 'history' not in st.session_state:
         st.session_state.history = []
 
-    if 'all_images' not in st.session_state:
-        st.session_state.all_images = []
-
     if 'images_dir' not in st.session_state:
         st.session_state.images_dir = ""
-    elif os.path.exists(st.session_state.images_dir):
-        st.session_state.all_images = []
-        for img in os.listdir(st.session_state.images_dir):
-            if img.endswith((".png", ".jpg")):
-                st.session_state.all_images.append(os.path.join(st.session_state.images_dir, img))
 
-    if 'images_ranked' not in st.session_state:
-        st.session_state.images_ranked  = []
+    if 'sync_job_id' not in st.session_state:
+        st.session_state.sync_job_id = None
+
+    if 'search_session' not in st.session_state:
+        st.session_state.search_session = None
+
+    if 'gallery_page' not in st.session_state:
+        st.session_state.gallery_page = 0
+
+    if 'results_page' not in st.session_state:
+        st.session_state.results_page = 0
 
     if 'all_descriptions_generated' not in st.session_state:
         st.session_state.all_descriptions_generated = False
@@ -517,9 +553,6 @@ def make_st_vars():
     if 'search_result_images' not in st.session_state:
         st.session_state.search_result_images = []
     
-    if 'name_and_image_dict' not in st.session_state:
-        st.session_state.name_and_image_dict = dict()
-
     if 'init_display_images' not in st.session_state:
         st.session_state.init_display_images = True
 
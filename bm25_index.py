@@ -0,0 +1,297 @@
+"""
+Local lexical (BM25) index over an album's descriptions
+
+lexical_index.jsonl (next to descriptions.json) holds one {"name", "hash", "tf", "len"} line per indexed
+description, or {"name", "deleted": true} for a removed one. Lines are only ever appended, later lines win.
+The in-memory inverted index is rebuilt from that file once per process and then kept in sync with the
+description store incrementally, only new or changed descriptions are tokenized.
+
+Ranking needs no network, so it works as a fast path when the embedding API is slow or down,
+and as the lexical half of hybrid ranking (reciprocal rank fusion with the FAISS ranking, see search_session.py).
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import math
+import hashlib
+import random
+import threading
+from collections import Counter
+
+from descr_store import load_descriptions, descriptions_version
+
+LEXICAL_INDEX_FILENAME = 'lexical_index.jsonl'
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+#rank constant of reciprocal rank fusion, 60 as in the original RRF paper
+RRF_K = 60
+#rewrite the index file once it holds this many superseded lines per live document
+COMPACT_RATIO = 1.0
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the there this to was were with
+image images photo picture shows showing shown appears visible can seen
+""".split())
+
+_indexes = {} #descriptions_file -> BM25Index
+_indexes_lock = threading.Lock()
+
+
+def tokenize(text):
+    """
+    lowercase word tokens without stopwords, trailing plural 's' removed so 'dogs' matches 'dog'
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def description_hash(description):
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+
+
+def lexical_index_path(descriptions_file):
+    return os.path.join(os.path.dirname(descriptions_file), LEXICAL_INDEX_FILENAME)
+
+
+class BM25Index:
+    """
+    Inverted index with BM25 scoring, persisted as an append-only file.
+
+    index_file(str): lexical_index.jsonl path, None keeps the index in memory only
+    """
+    def __init__(self, index_file=None, k1=BM25_K1, b=BM25_B):
+        self.index_file = index_file
+        self.k1 = k1
+        self.b = b
+
+        self.postings = {} #term -> {name : term frequency}
+        self.doc_tf = {} #name -> {term : term frequency}
+        self.doc_len = {}
+        self.doc_hash = {}
+        self.total_len = 0
+        self.synced_version = None
+        self._file_lines = 0
+        self._lock = threading.Lock()
+
+        if index_file is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self.doc_tf)
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        #torn final line from a crash mid-append, that document is re-indexed on the next sync
+                        continue
+                    self._file_lines += 1
+                    if entry.get('deleted'):
+                        self._remove(entry['name'])
+                    else:
+                        self._insert(entry['name'], entry['hash'], entry['tf'], entry['len'])
+        except FileNotFoundError:
+            pass
+
+    def _insert(self, name, doc_hash, tf, length):
+        #caller holds _lock (or is _load)
+        self._remove(name)
+        self.doc_tf[name] = tf
+        self.doc_len[name] = length
+        self.doc_hash[name] = doc_hash
+        self.total_len += length
+        for term, count in tf.items():
+            self.postings.setdefault(term, {})[name] = count
+
+    def _remove(self, name):
+        tf = self.doc_tf.pop(name, None)
+        if tf is None:
+            return
+        self.total_len -= self.doc_len.pop(name)
+        self.doc_hash.pop(name)
+        for term in tf:
+            docs = self.postings[term]
+            del docs[name]
+            if not docs:
+                del self.postings[term]
+
+    def _append_lines(self, entries):
+        if self.index_file is None or not entries:
+            return
+        with open(self.index_file, 'a') as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self._file_lines += len(entries)
+
+        if self._file_lines > (1 + COMPACT_RATIO) * max(len(self.doc_tf), 1):
+            self._compact()
+
+    def _compact(self):
+        #caller holds _lock
+        tmp_path = self.index_file + '.tmp'
+        with open(tmp_path, 'w') as file:
+            for name, tf in self.doc_tf.items():
+                file.write(json.dumps({'name' : name, 'hash' : self.doc_hash[name], 'tf' : tf,
+                                       'len' : self.doc_len[name]}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.index_file)
+        self._file_lines = len(self.doc_tf)
+
+    def add_documents(self, descriptions):
+        """
+        index {image_name : description} pairs, unchanged descriptions are skipped
+        """
+        with self._lock:
+            entries = []
+            for name, description in descriptions.items():
+                doc_hash = description_hash(description)
+                if self.doc_hash.get(name) == doc_hash:
+                    continue
+                tokens = tokenize(description)
+                tf = dict(Counter(tokens))
+                self._insert(name, doc_hash, tf, len(tokens))
+                entries.append({'name' : name, 'hash' : doc_hash, 'tf' : tf, 'len' : len(tokens)})
+            self._append_lines(entries)
+            return len(entries)
+
+    def remove_documents(self, names):
+        with self._lock:
+            removed = [name for name in names if name in self.doc_tf]
+            for name in removed:
+                self._remove(name)
+            self._append_lines([{'name' : name, 'deleted' : True} for name in removed])
+
+    def sync(self, descriptions):
+        """
+        bring the index in line with a full {image_name : description} dict, returns number of documents changed
+        """
+        with self._lock:
+            stale = [name for name in self.doc_tf if name not in descriptions]
+        if stale:
+            self.remove_documents(stale)
+        return self.add_documents(descriptions) + len(stale)
+
+    def search(self, query, k=10):
+        """
+        Returns (scores, names) of the k best matching documents, best first.
+        Documents sharing no term with the query are not returned, k=0 returns all matches
+        """
+        terms = Counter(tokenize(query))
+        with self._lock:
+            num_docs = len(self.doc_tf)
+            if not num_docs or not terms:
+                return [], []
+            avg_len = self.total_len / num_docs
+
+            scores = {}
+            for term, query_count in terms.items():
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for name, tf in docs.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_len[name] / avg_len)
+                    scores[name] = scores.get(name, 0.0) + query_count * idf * tf * (self.k1 + 1) / (tf + norm)
+
+        if k <= 0 or k >= len(scores):
+            best = sorted(scores.items(), key=lambda item: -item[1])
+        else:
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [score for _, score in best], [name for name, _ in best]
+
+
+def get_lexical_index(descriptions_file):
+    """
+    process-wide BM25 index for an album, synced with the description store whenever its version changes
+    """
+    with _indexes_lock:
+        index = _indexes.get(descriptions_file)
+        if index is None:
+            index = BM25Index(lexical_index_path(descriptions_file))
+            _indexes[descriptions_file] = index
+
+    version = descriptions_version(descriptions_file)
+    if index.synced_version != version:
+        descriptions = load_descriptions(descriptions_file) or {}
+        changed = index.sync(descriptions)
+        if changed:
+            print(f"lexical index: {changed} documents updated for {descriptions_file}")
+        index.synced_version = version
+    return index
+
+
+def add_to_lexical_index(descriptions_file, descriptions):
+    """
+    index newly written descriptions right away, e.g. as generate_image_descrptions produces them
+    """
+    with _indexes_lock:
+        index = _indexes.get(descriptions_file)
+        if index is None:
+            index = BM25Index(lexical_index_path(descriptions_file))
+            _indexes[descriptions_file] = index
+    index.add_documents(descriptions)
+
+
+def rrf_scores(rankings, k=RRF_K):
+    """
+    {name : sum(1 / (k + rank))} over the ranked lists a name appears in (rank from 1)
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, name in enumerate(ranking, start=1):
+            scores[name] = scores.get(name, 0.0) + 1.0 / (k + rank)
+    return scores
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K, limit=None):
+    """
+    fuse ranked lists of names by their rrf_scores, returns the fused list of names, best first
+    """
+    scores = rrf_scores(rankings, k)
+    fused = sorted(scores, key=lambda name: -scores[name])
+    return fused[:limit] if limit else fused
+
+
+def benchmark_lexical_search(num_docs=10_000, num_queries=200, seed=0):
+    """
+    build an in-memory index over synthetic descriptions and time index build and queries
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)] + ["dog", "beach", "sunset", "mountain", "car", "city", "snow"]
+    descriptions = {f"IMG{i}.jpg" : ' '.join(rng.choice(vocabulary) for _ in range(60)) for i in range(num_docs)}
+    queries = [' '.join(rng.choice(vocabulary) for _ in range(4)) for _ in range(num_queries)]
+
+    index = BM25Index()
+    t_start = time.perf_counter()
+    index.add_documents(descriptions)
+    build_time = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for query in queries:
+        index.search(query, k=24)
+    query_time = (time.perf_counter() - t_start) / num_queries
+
+    print(f"{num_docs} documents: build {build_time:.2f}s, {query_time * 1000:.3f}ms per query (top 24)")
+
+
+if __name__ == '__main__':
+    #python bm25_index.py [num_docs]
+    benchmark_lexical_search(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,129 @@
+"""
+Token-budgeted candidate selection for the retrieval prompt
+
+Candidates are taken in ranked order up to a cutoff picked from the query's distance distribution,
+then packed until the descriptions fill the token budget. Filenames are replaced by short numeric
+aliases in the prompt and mapped back after the response is parsed.
+"""
+
+import os
+import re
+import ast
+import json
+
+import numpy as np
+import tiktoken
+
+#tokens of candidate descriptions per retrieval prompt, override with PHOTOFIND_PROMPT_TOKENS
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PHOTOFIND_PROMPT_TOKENS", 6000))
+MIN_CANDIDATES = 5
+MAX_CANDIDATES = 300
+#a gap between consecutive distances this many times the average gap ends the candidate list
+GAP_FACTOR = 3.0
+#without a clear gap, keep candidates within this many standard deviations of the best distance
+SPREAD_FACTOR = 2.0
+
+_encodings = {}
+
+
+def get_encoding(model='gpt-4o'):
+    """
+    tiktoken encoding for a model, None if it can't be loaded (tiktoken fetches encodings on first use)
+    """
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            print(f"tiktoken encoding for {model} unavailable ({e}), estimating tokens from length")
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def count_tokens(text, model='gpt-4o'):
+    encoding = get_encoding(model)
+    if encoding is None:
+        #~4 characters per token for english text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def adaptive_cutoff(distances, min_k=MIN_CANDIDATES, max_k=MAX_CANDIDATES):
+    """
+    number of candidates to keep from ascending distances.
+
+    Cuts at the largest gap between consecutive distances (after min_k) when it stands out from the average gap,
+    i.e. a clear group of matches; otherwise keeps everything within SPREAD_FACTOR std of the best distance.
+    """
+    distances = np.asarray(distances[:max_k], dtype='float64')
+    if len(distances) <= min_k:
+        return len(distances)
+
+    gaps = np.diff(distances)
+    tail_gaps = gaps[min_k - 1:]
+    mean_gap = gaps.mean()
+    if mean_gap > 0 and len(tail_gaps) and tail_gaps.max() >= GAP_FACTOR * mean_gap:
+        return min_k + int(np.argmax(tail_gaps))
+
+    within = distances <= distances[0] + SPREAD_FACTOR * distances.std()
+    return max(min_k, int(within.sum()))
+
+
+def pack_candidates(ranked_names, distances, descriptions, token_budget=PROMPT_TOKEN_BUDGET,
+                    min_k=MIN_CANDIDATES, max_k=MAX_CANDIDATES, model='gpt-4o'):
+    """
+    Returns (aliases, prompt_descriptions)
+
+    aliases(dict): {alias : image name}
+    prompt_descriptions(dict): {alias : description}, ranked order, fits in token_budget
+    """
+    k = adaptive_cutoff(distances, min_k, max_k)
+
+    aliases = {}
+    prompt_descriptions = {}
+    used_tokens = 0
+    for name in ranked_names[:k]:
+        description = descriptions.get(name)
+        if description is None:
+            continue
+        alias = str(len(aliases) + 1)
+        #one '"alias": "description", ' entry of the JSON object in the prompt
+        entry_tokens = count_tokens(json.dumps({alias : description}), model)
+        if used_tokens + entry_tokens > token_budget and aliases:
+            break
+        aliases[alias] = name
+        prompt_descriptions[alias] = description
+        used_tokens += entry_tokens
+
+    print(f"packed {len(aliases)} candidates (cutoff {k}) into {used_tokens}/{token_budget} tokens")
+    return aliases, prompt_descriptions
+
+
+def parse_alias_response(res):
+    """
+    list of alias strings from a model response, a python/JSON list or any text with numbers in it
+    """
+    try:
+        parsed = ast.literal_eval(res.strip())
+        if parsed is None:
+            return []
+        if isinstance(parsed, (list, tuple)):
+            return [str(item).strip() for item in parsed]
+        return [str(parsed).strip()]
+    except (ValueError, SyntaxError):
+        return re.findall(r"\b\d+\b", res)
+
+
+def resolve_aliases(outputs, aliases):
+    """
+    map parsed outputs back to image names, real filenames are passed through, unknown values dropped
+    """
+    names = set(aliases.values())
+    resolved = []
+    for output in outputs:
+        output = str(output).strip(' \'"[]#')
+        name = aliases.get(output) or (output if output in names else None)
+        if name is not None and name not in resolved:
+            resolved.append(name)
+    return resolved
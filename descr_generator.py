@@ -4,13 +4,40 @@ import os
 import json
 import time
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from langchain_community.embeddings import OpenAIEmbeddings
+from utils import (retrieve_contents_from_json, create_and_store_embeddings,
+                   add_new_descr_to_embedding_store, remove_description_pretense)
+from image_utils import get_renditions_parallel
+from retry_utils import TokenBucketLimiter, backoff_delay, retry_after_seconds
+from descr_store import append_descriptions, get_description_names, load_descriptions
+from log_sink import get_log_writer
+from bm25_index import add_to_lexical_index
+from embedding_backends import get_embedding_backend, get_store_backend
 
 DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
 
-from utils import (reduce_png_quality, retrieve_contents_from_json, create_and_store_embeddings_to_pickle,
-                   add_new_descr_to_embedding_pickle, remove_description_pretense, reduce_jpeg_size)
+#vision requests in flight at once
+DESCRIBE_MAX_WORKERS = int(os.environ.get("PHOTOFIND_DESCRIBE_WORKERS", 8))
+#gpt-4o (requests, tokens) per minute by OpenAI usage tier
+OPENAI_TIER_LIMITS = {
+    1 : (500, 30_000),
+    2 : (5_000, 450_000),
+    3 : (5_000, 800_000),
+    4 : (10_000, 2_000_000),
+    5 : (10_000, 30_000_000),
+}
+#account tier, set PHOTOFIND_OPENAI_TIER to raise it for a key on a higher tier.
+#tier 1 by default, most user pasted keys are. PHOTOFIND_RPM / PHOTOFIND_TPM override the tier's limits
+OPENAI_TIER = int(os.environ.get("PHOTOFIND_OPENAI_TIER", 1))
+#unknown tiers get the tier 1 limits
+_tier_rpm, _tier_tpm = OPENAI_TIER_LIMITS.get(OPENAI_TIER, OPENAI_TIER_LIMITS[1])
+REQUESTS_PER_MINUTE = int(os.environ.get("PHOTOFIND_RPM", _tier_rpm))
+TOKENS_PER_MINUTE = int(os.environ.get("PHOTOFIND_TPM", _tier_tpm))
+#high detail image (<=1105 tokens) + prompt + max_tokens, counted against the TPM budget
+ESTIMATED_TOKENS_PER_IMAGE = int(os.environ.get("PHOTOFIND_TOKENS_PER_IMAGE", 1600))
+MAX_REQUEST_ATTEMPTS = 5
+REQUEST_TIMEOUT = 120
 
 IMAGE_QUESTION = 'As descriptive as possible, describe the contents of this image in a single sentence.'
 
@@ -60,50 +87,18 @@ def encode_image(image_path):
 
 def append_to_json_info_file(file_path, data):
     """
-    append to info file that stores full requets response objects
+    append to info file that stores full requets response objects, one JSON line per response
     """
-    try:
-        with open(file_path, 'r') as file:
-            if os.path.getsize(file_path) != 0:
-              existing_data = json.load(file)
-            else:
-                existing_data = []
-    except FileNotFoundError:
-        existing_data = []
-
-    existing_data.append(data)
-
-    info_dir = os.path.dirname(file_path)
-    if not os.path.exists(info_dir):
-        os.mkdir(info_dir)
-
-    with open(file_path, 'w') as file:
-        json.dump(existing_data, file, indent=2)
+    get_log_writer(file_path).write(data)
 
 
 def append_to_json_file(file_path, data):
     """
-    For appending a {image_name : description} pair to the descriptions file 
+    For appending a {image_name : description} pair to the descriptions file.
+    Only appends a line to the album's description log, see descr_store.py, and indexes it for lexical search
     """
-    try:
-        with open(file_path, 'r') as file:
-            if os.path.getsize(file_path) != 0:
-              existing_data = json.load(file)
-            else:
-                existing_data = {}
-    except FileNotFoundError as e:
-        print(f"append_to_json_file: {e}")
-        existing_data = {}
-
-    if type(existing_data) == dict:
-      existing_data.update(data)
-    else:
-        #TODO: old json format
-        append_to_old_json_file(file_path, existing_data, data)
-        assert False, "deprecated JSON description file format"
-
-    with open(file_path, 'w') as file:
-        json.dump(existing_data, file, indent=2)
+    append_descriptions(file_path, data)
+    add_to_lexical_index(file_path, data)
 
 
 def append_to_old_json_file(file_path, existing_data, data):
@@ -131,26 +126,10 @@ def get_file_names_from_json(json_file_path):
     """
     Get filenames from descriptions file -- should be the keys of a dictionary 
     """
-    try:
-        with open(json_file_path, 'r') as file:
-            data = json.load(file)
-
-            if isinstance(data, dict):
-                # if dictionary, search for  keys
-                return data.keys()
-            elif isinstance(data, list):
-                # if list, search for keys in each dictionary
-                return [item.get("file_name", None) for item in data]
-            else:
-                print("Invalid JSON format. Expected a dictionary or a list of dictionaries.")
-                return None
-
-    except FileNotFoundError:
+    if load_descriptions(json_file_path) is None:
         print(f"File not found: {json_file_path}")
         return None
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
-        return None
+    return get_description_names(json_file_path)
 
 
 def find_new_pic_files(images_dir, descriptions_file):
@@ -160,7 +139,7 @@ def find_new_pic_files(images_dir, descriptions_file):
     """
     existing_pictures = get_file_names_from_json(descriptions_file)
     if existing_pictures is None:
-        existing_pictures = []
+        existing_pictures = set()
 
     print(f"Descriptions exist for {len(existing_pictures)} images.")
     new_images = []
@@ -245,110 +224,157 @@ def get_pics_without_descrs(images_dir):
     return new_pics
 
 
-def generate_image_descrptions(new_pics, images_dir, api_key):
+def describe_image(pic, compressed_future, api_key, limiter):
+    """
+    Worker: encode one image once its compression (on the process pool) is done, then request its description.
+    Rate limited by the shared limiter, 429s honor Retry-After, other failures back off exponentially.
+
+    Returns tuple(pic, response json or None, request_time(float), generation_time(float))
+    """
+    start_time = time.perf_counter()
+
+    base64_image = base64.b64encode(compressed_future.result()).decode('utf-8')
+
+    payload = default_payload(IMAGE_QUESTION)
+    payload['messages'][0]['content'][1]['image_url']['url'] = f"data:image/jpeg;base64,{base64_image}"
+
+    start_time_req = time.perf_counter()
+    response_json = None
+    for attempt in range(1, MAX_REQUEST_ATTEMPTS + 1):
+        if attempt > 1:
+            print(f"{pic}: attempt {attempt}")
+        limiter.acquire(ESTIMATED_TOKENS_PER_IMAGE)
+
+        response = None
+        try:
+            response = requests.post("https://api.openai.com/v1/chat/completions",
+                                     headers=headers(api_key),
+                                     json=payload,
+                                     timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"{pic}: {e}")
+
+        if response is not None and response.status_code < 500 and response.status_code != 429:
+            response_json = response.json()
+            break
+
+        if attempt == MAX_REQUEST_ATTEMPTS:
+            if response is not None:
+                try:
+                    response_json = response.json()
+                except ValueError:
+                    print(f"{pic}: non-JSON error response ({response.status_code})")
+            break
+
+        delay = retry_after_seconds(response)
+        if response is not None and response.status_code == 429:
+            delay = delay if delay is not None else backoff_delay(attempt, base_delay=2.0)
+            limiter.pause(delay)
+        elif delay is None:
+            delay = backoff_delay(attempt, base_delay=2.0)
+        print(f"{pic}: request failed, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    request_time = round(time.perf_counter() - start_time_req, 2)
+    return pic, response_json, request_time, round(time.perf_counter() - start_time, 2)
+
+
+def generate_image_descrptions(new_pics, images_dir, api_key, max_workers=DESCRIBE_MAX_WORKERS):
     """
     Generator: take in list of images, yield one description per call
 
     Package an encoded image with the description prompt to get a description for an image.
-    Returns tuple(description(str), generation_time(float)) OR 0 for failure
+    API renditions come from the rendition cache, or are compressed on a process pool (originals are left
+    untouched), and are described concurrently by a bounded worker pool, results are yielded as they complete.
+    Throughput is capped at TOKENS_PER_MINUTE / ESTIMATED_TOKENS_PER_IMAGE images per minute whatever max_workers is,
+    e.g. ~18/min on a tier 1 account (30k TPM) where one worker would keep up, ~280/min on tier 2.
+    Returns tuple(description(str), generation_time(float), image name(str)) OR 0 for failure
     """
     key_base_dir = os.path.dirname(images_dir)
 
     json_description_file_path = os.path.join(key_base_dir, 'descriptions.json')
-    json_info_file_path = os.path.join(key_base_dir, 'info.json')
-
-    for i, pic in enumerate(new_pics):
-        start_time = time.perf_counter()
-        print('({}/{}) Getting description for {}'.format(i+1, len(new_pics), pic))
+    json_info_file_path = os.path.join(key_base_dir, 'info.jsonl')
 
-        img_path = os.path.join(images_dir, pic)
-        if img_path.endswith(".png"):
-            reduce_png_quality(img_path, img_path)
-        elif img_path.endswith(".jpg"):
-            reduce_jpeg_size(img_path, img_path)
+    limiter = TokenBucketLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    compressed = get_renditions_parallel([os.path.join(images_dir, pic) for pic in new_pics], 'api')
+    try:
+        futures = [executor.submit(describe_image, pic, compressed[os.path.join(images_dir, pic)], api_key, limiter)
+                   for pic in new_pics]
 
-        base64_image = encode_image(img_path)
+        #files are only written from this thread, workers just make requests
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                pic, response_json, request_time, generation_time = future.result()
+            except Exception as e: #image preprocessing or decoding failure in the worker
+                print(f"({i+1}/{len(new_pics)}) description worker failed: {e}")
+                yield 0
+                continue
+            print('({}/{}) response recieved for {} in {} seconds'.format(i+1, len(new_pics), pic, request_time))
 
-        start_time_req = time.perf_counter()
+            if response_json is None:
+                print(f"no response for {pic}")
+                yield 0
+                continue
 
-        payload = default_payload(IMAGE_QUESTION)
-        payload['messages'][0]['content'][1]['image_url']['url'] = f"data:image/jpeg;base64,{base64_image}"
+            append_to_json_info_file(json_info_file_path, response_json)
 
-        try_again = False
-        attempts = 0
-        while attempts < 3:
-            attempts += 1
-            if attempts > 1:
-                print(f"attempt {attempts}")
             try:
-                response = requests.post("https://api.openai.com/v1/chat/completions",
-                                         headers=headers(api_key),
-                                         json=payload)
-            except Exception as e: #TODO: specify exceptions
-                print(e)
-                print('error, sleeping')
-                time.sleep(15)
-                try_again = True
-
-            if try_again:
-                try_again = False
-            else:
-                break
-            
-        stop_time_req = time.perf_counter()
-        request_time = round(stop_time_req - start_time_req, 2)
-
-        print('response recieved for {} in {} seconds'.format(pic, request_time))
-
-        append_to_json_info_file(json_info_file_path, response.json())
-
-        try:
-            response_description = response.json()["choices"][0]["message"]["content"]
-            response_description = remove_description_pretense(response_description)
-
-            description_obj = { f"{pic}" : f"{response_description}" }
-            append_to_json_file(json_description_file_path, description_obj)
+                response_description = response_json["choices"][0]["message"]["content"]
+                response_description = remove_description_pretense(response_description)
 
-            end_time = time.perf_counter()
+                description_obj = { f"{pic}" : f"{response_description}" }
+                append_to_json_file(json_description_file_path, description_obj)
 
-            yield (response_description, round(end_time - start_time, 2))
+                yield (response_description, generation_time, pic)
 
-        except KeyError as e:
-            print(f"KeyError occurred: {e}")
-            print(response.json())
-            yield 0
+            except KeyError as e:
+                print(f"KeyError occurred: {e}")
+                print(response_json)
+                yield 0
 
-        #TODO: other exceptions?
+            #TODO: other exceptions?
+    finally:
+        #caller stopped early -> drop queued images, let in-flight requests finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future in compressed.values():
+            future.cancel()
 
 
-def update_embeddings(api_key, embeddings_pickle_file, new_descriptions):
+def update_embeddings(api_key, embeddings_store_dir, new_descriptions, progress_callback=None):
     """
     Call utils function to get text embeddings for new descriptions from api request
-    and add to embeddings file.
+    and add to the embeddings store.
+
+    new_descriptions(dict): {image_name : description} for the newly described images
+    progress_callback(callable): called with (embedded_count, total_count)
     """
     print('Updating embeddings')
-    embeddings_obj = OpenAIEmbeddings(api_key=api_key)
-    add_new_descr_to_embedding_pickle(embeddings_obj, embeddings_pickle_file, new_descriptions)
+    #same backend as the rows already in the store
+    embeddings_obj = get_store_backend(embeddings_store_dir, api_key)
+    add_new_descr_to_embedding_store(embeddings_obj, embeddings_store_dir,
+                                     list(new_descriptions.keys()), list(new_descriptions.values()),
+                                     progress_callback=progress_callback)
     
 
-def create_embeddings(api_key, embeddings_pickle_file, json_description_file_path):
+def create_embeddings(api_key, embeddings_store_dir, json_description_file_path, progress_callback=None):
     """
     Get descriptions for a given api key and call utils ile to create embeddings for them.
+    Uses the configured embedding backend, see embedding_backends.py
     """
     print('Creating embeddings')
-    embeddings_obj = OpenAIEmbeddings(api_key=api_key)
+    embeddings_obj = get_embedding_backend(api_key)
     descriptions = retrieve_contents_from_json(json_description_file_path)
-    if type(descriptions) == dict:
-        descriptions = list(descriptions.values())
-    else:
-        assert False, "invalid descr retrieve, expecting list of descriptions, {not img:descr} dict"
-    create_and_store_embeddings_to_pickle(embeddings_obj, embeddings_pickle_file, descriptions)
+    if type(descriptions) != dict:
+        assert False, "invalid descr retrieve, expecting {img:descr} dict"
+    create_and_store_embeddings(embeddings_obj, embeddings_store_dir, descriptions,
+                                progress_callback=progress_callback)
 
 
 if __name__ == '__main__':
     #test creating embeddings
     api_key = ''
-    pkl_file = ''
+    store_dir = ''
     descr_file = ''
 
-    create_embeddings(api_key, pkl_file, descr_file)
\ No newline at end of file
+    create_embeddings(api_key, store_dir, descr_file)
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""
+Append-only description store for an album
+
+descriptions.json           - compacted {image_name : description} snapshot, uploaded to firebase
+descriptions.log.jsonl      - one {"name", "description"} line per description added since the snapshot
+
+Adding a description appends one line to the log. Every COMPACT_EVERY lines the log is merged
+into a new snapshot (written to a temp file and atomically renamed), then truncated.
+Readers get snapshot + log replay from an in-memory index that reloads only when either file changes.
+"""
+
+import os
+import json
+import threading
+
+DESCR_LOG_SUFFIX = '.log.jsonl'
+
+#merge the log into descriptions.json after this many appends
+COMPACT_EVERY = 200
+
+_cache = {} #descriptions_file -> {'stamp', 'descriptions', 'log_lines'}
+_lock = threading.Lock()
+
+
+def descr_log_path(descriptions_file):
+    base, _ = os.path.splitext(descriptions_file)
+    return base + DESCR_LOG_SUFFIX
+
+
+def _stat_stamp(file_path):
+    try:
+        stat = os.stat(file_path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def _files_stamp(descriptions_file):
+    return (_stat_stamp(descriptions_file), _stat_stamp(descr_log_path(descriptions_file)))
+
+
+def _read_snapshot(descriptions_file):
+    try:
+        with open(descriptions_file, 'r') as file:
+            if os.path.getsize(descriptions_file) == 0:
+                return {}
+            data = json.load(file)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        print(f"Error decoding JSON file: {descriptions_file}")
+        return {}
+
+    if isinstance(data, list):
+        #deprecated list of {"file_name", "description"} format
+        return {item.get("file_name") : item.get("description") for item in data}
+    return data
+
+
+def _replay_log(log_file, descriptions):
+    """
+    apply log lines on top of descriptions, returns number of lines applied
+    """
+    applied = 0
+    try:
+        with open(log_file, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    #torn final line from a crash mid-append
+                    print(f"skipping unreadable description log line in {log_file}")
+                    continue
+                descriptions[entry['name']] = entry['description']
+                applied += 1
+    except FileNotFoundError:
+        pass
+    return applied
+
+
+def _load_entry(descriptions_file):
+    #caller holds _lock
+    stamp = _files_stamp(descriptions_file)
+    entry = _cache.get(descriptions_file)
+    if entry is not None and entry['stamp'] == stamp:
+        return entry
+
+    descriptions = _read_snapshot(descriptions_file)
+    exists = descriptions is not None or stamp[1] is not None
+    if descriptions is None:
+        descriptions = {}
+    log_lines = _replay_log(descr_log_path(descriptions_file), descriptions)
+
+    entry = {'stamp' : stamp, 'descriptions' : descriptions, 'log_lines' : log_lines, 'exists' : exists}
+    _cache[descriptions_file] = entry
+    return entry
+
+
+def load_descriptions(descriptions_file):
+    """
+    {image_name : description} for an album (snapshot + log), None if the album has no descriptions yet
+    """
+    with _lock:
+        entry = _load_entry(descriptions_file)
+        if not entry['exists']:
+            return None
+        return dict(entry['descriptions'])
+
+
+def descriptions_version(descriptions_file):
+    """
+    value that changes whenever the album's descriptions do (snapshot and log file stamps)
+    """
+    return _files_stamp(descriptions_file)
+
+
+def get_description_names(descriptions_file):
+    """
+    set of image names that have a description
+    """
+    with _lock:
+        return set(_load_entry(descriptions_file)['descriptions'].keys())
+
+
+def _ends_with_torn_line(log_file):
+    try:
+        with open(log_file, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell() == 0:
+                return False
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) != b'\n'
+    except FileNotFoundError:
+        return False
+
+
+def append_descriptions(descriptions_file, data):
+    """
+    add {image_name : description} pairs, one appended log line each
+    """
+    log_file = descr_log_path(descriptions_file)
+    descr_dir = os.path.dirname(descriptions_file)
+    if descr_dir and not os.path.exists(descr_dir):
+        os.makedirs(descr_dir)
+
+    with _lock:
+        entry = _load_entry(descriptions_file)
+
+        with open(log_file, 'a') as file:
+            if _ends_with_torn_line(log_file):
+                file.write('\n')
+            for name, description in data.items():
+                file.write(json.dumps({'name' : name, 'description' : description}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        entry['descriptions'].update(data)
+        entry['log_lines'] += len(data)
+        entry['exists'] = True
+        entry['stamp'] = _files_stamp(descriptions_file)
+
+        if entry['log_lines'] >= COMPACT_EVERY:
+            _compact(descriptions_file, entry)
+
+
+def _compact(descriptions_file, entry):
+    #caller holds _lock
+    tmp_path = descriptions_file + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(entry['descriptions'], file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, descriptions_file)
+
+    #a crash before this truncate only means replaying lines that are already in the snapshot
+    open(descr_log_path(descriptions_file), 'w').close()
+
+    entry['log_lines'] = 0
+    entry['stamp'] = _files_stamp(descriptions_file)
+
+
+def compact_descriptions(descriptions_file):
+    """
+    merge the log into descriptions.json, returns the path of the up to date descriptions.json
+    """
+    with _lock:
+        entry = _load_entry(descriptions_file)
+        if entry['exists'] and (entry['log_lines'] > 0 or entry['stamp'][0] is None):
+            _compact(descriptions_file, entry)
+    return descriptions_file
+
+
+def export_descriptions_json(descriptions_file):
+    """
+    complete descriptions.json view of the album, e.g. for the firebase upload
+    """
+    return compact_descriptions(descriptions_file)
@@ -0,0 +1,221 @@
+"""
+Embedding backends for description and query vectors
+
+openai      - OpenAI embeddings through langchain (network, the default)
+hashing     - signed feature hashing of word unigrams/bigrams, log-scaled term counts, L2-normalized.
+              Runs on CPU without network or model files, for development, CI and benchmarks.
+              Lexical rather than semantic, so expect worse rankings than openai on paraphrased queries.
+
+Every backend has embed_documents(texts), embed_query(text), a model name and a dim found without
+building a store. Album vector stores record the {"backend", "model", "dim"} that produced them (see
+vector_store.py), queries on an album always use that backend and appending vectors of another one fails.
+PHOTOFIND_EMBEDDING_BACKEND selects the backend for new albums.
+"""
+
+import os
+import sys
+import time
+import math
+import zlib
+import random
+import threading
+
+import numpy as np
+
+from bm25_index import tokenize
+from vector_store import read_manifest
+
+EMBEDDING_BACKENDS = ('openai', 'hashing')
+DEFAULT_EMBEDDING_BACKEND = os.environ.get("PHOTOFIND_EMBEDDING_BACKEND", 'openai')
+
+DEFAULT_OPENAI_MODEL = 'text-embedding-ada-002'
+#known output sizes, other models are probed with one request
+OPENAI_MODEL_DIMS = {
+    'text-embedding-ada-002' : 1536,
+    'text-embedding-3-small' : 1536,
+    'text-embedding-3-large' : 3072,
+}
+HASHING_DIM = int(os.environ.get("PHOTOFIND_HASHING_DIM", 1024))
+
+#stores from before backends were recorded were all built with the langchain default model
+LEGACY_EMBEDDING = {'backend' : 'openai', 'model' : DEFAULT_OPENAI_MODEL}
+
+_backends = {} #(backend, model, api_key) -> backend object
+_backends_lock = threading.Lock()
+_notified_stores = set()
+
+
+class OpenAIEmbeddingBackend:
+    """
+    langchain OpenAIEmbeddings, created on first use
+    """
+    name = 'openai'
+
+    def __init__(self, api_key, model=DEFAULT_OPENAI_MODEL):
+        self.api_key = api_key
+        self.model = model
+        self._dim = OPENAI_MODEL_DIMS.get(model)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from langchain_community.embeddings import OpenAIEmbeddings
+            self._client = OpenAIEmbeddings(api_key=self.api_key, model=self.model)
+        return self._client
+
+    @property
+    def dim(self):
+        if self._dim is None:
+            self._dim = len(self.client.embed_query("dimension probe"))
+        return self._dim
+
+    def embed_documents(self, texts):
+        return self.client.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.client.embed_query(text)
+
+    def signature(self):
+        return {'backend' : self.name, 'model' : self.model, 'dim' : self.dim}
+
+
+class HashingEmbeddingBackend:
+    """
+    Feature hashing of unigrams + bigrams into dim buckets, crc32 picks the bucket and sign so vectors
+    are the same in every process. No corpus statistics (no IDF), so a vector never changes once written.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim=HASHING_DIM):
+        self.dim = dim
+        self.model = f"hashing-{dim}"
+
+    def embed_query(self, text):
+        tokens = tokenize(text)
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+        counts = {}
+        for feature in features:
+            h = zlib.crc32(feature.encode('utf-8'))
+            bucket = h % self.dim
+            sign = 1.0 if h & 0x80000000 else -1.0
+            counts[bucket] = counts.get(bucket, 0.0) + sign
+
+        vector = np.zeros(self.dim, dtype='float32')
+        for bucket, count in counts.items():
+            #sublinear term frequency, keeps a repeated word from dominating the description
+            vector[bucket] = math.copysign(1.0 + math.log(abs(count)), count) if count else 0.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def embed_documents(self, texts):
+        return np.array([self.embed_query(text) for text in texts], dtype='float32').reshape(len(texts), self.dim)
+
+    def signature(self):
+        return {'backend' : self.name, 'model' : self.model, 'dim' : self.dim}
+
+
+def get_embedding_backend(api_key=None, backend=None, model=None):
+    """
+    process-wide backend object, backend defaults to PHOTOFIND_EMBEDDING_BACKEND
+    """
+    backend = backend or DEFAULT_EMBEDDING_BACKEND
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"unknown embedding backend {backend}, expected one of {EMBEDDING_BACKENDS}")
+
+    key = (backend, model, api_key if backend == 'openai' else None)
+    with _backends_lock:
+        if key not in _backends:
+            if backend == 'openai':
+                _backends[key] = OpenAIEmbeddingBackend(api_key, model or DEFAULT_OPENAI_MODEL)
+            else:
+                dim = int(model.rsplit('-', 1)[-1]) if model else HASHING_DIM
+                _backends[key] = HashingEmbeddingBackend(dim)
+        return _backends[key]
+
+
+def store_embedding(store_dir):
+    """
+    {"backend", "model", "dim"} recorded for an album store, None if there is no store yet
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        return None
+    embedding = manifest.get('embedding')
+    if embedding is None:
+        embedding = dict(LEGACY_EMBEDDING, dim=manifest['dim'])
+    return embedding
+
+
+def get_store_backend(store_dir, api_key=None):
+    """
+    backend for reading and extending an album store: the one that built it, or the configured default
+    for an album without vectors yet
+    """
+    embedding = store_embedding(store_dir)
+    if embedding is None:
+        return get_embedding_backend(api_key)
+
+    if embedding['backend'] != DEFAULT_EMBEDDING_BACKEND and store_dir not in _notified_stores:
+        _notified_stores.add(store_dir)
+        print(f"{store_dir} was embedded with {embedding['backend']} ({embedding['model']}), "
+              f"using it instead of {DEFAULT_EMBEDDING_BACKEND}")
+    backend = get_embedding_backend(api_key, embedding['backend'], embedding['model'])
+    check_store_backend(store_dir, backend)
+    return backend
+
+
+def check_store_backend(store_dir, backend):
+    """
+    raise ValueError if the album store was built by a different backend, model or dimension
+    """
+    embedding = store_embedding(store_dir)
+    if embedding is None:
+        return
+    signature = backend.signature()
+    if (embedding['backend'], embedding['model'], embedding['dim']) != \
+            (signature['backend'], signature['model'], signature['dim']):
+        raise ValueError(f"{store_dir} holds {embedding['backend']}/{embedding['model']} vectors of dim "
+                         f"{embedding['dim']}, got {signature['backend']}/{signature['model']} of dim {signature['dim']}")
+
+
+def benchmark_hashing_backend(num_docs=2000, num_queries=200, seed=0):
+    """
+    time the local backend on synthetic descriptions
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    descriptions = [' '.join(rng.choice(vocabulary) for _ in range(60)) for _ in range(num_docs)]
+    backend = HashingEmbeddingBackend()
+
+    t_start = time.perf_counter()
+    backend.embed_documents(descriptions)
+    docs_time = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for description in descriptions[:num_queries]:
+        backend.embed_query(description[:40])
+    query_time = (time.perf_counter() - t_start) / num_queries
+
+    print(f"hashing-{backend.dim}: {num_docs} documents in {docs_time:.2f}s, {query_time * 1000:.3f}ms per query")
+
+
+if __name__ == '__main__':
+    """
+    python embedding_backends.py benchmark [num_docs]
+    python embedding_backends.py reembed <album_dir> <openai|hashing> [api_key]
+    """
+    if len(sys.argv) >= 2 and sys.argv[1] == 'benchmark':
+        benchmark_hashing_backend(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'reembed':
+        from utils import create_and_store_embeddings, retrieve_contents_from_json
+        from vector_store import get_store_dir
+
+        album_dir = sys.argv[2]
+        backend = get_embedding_backend(sys.argv[4] if len(sys.argv) > 4 else None, sys.argv[3])
+        descriptions = retrieve_contents_from_json(os.path.join(album_dir, 'descriptions.json'))
+        create_and_store_embeddings(backend, get_store_dir(album_dir), descriptions)
+        print(f"re-embedded {len(descriptions)} descriptions of {album_dir} with {backend.model}")
+    else:
+        print(__doc__)
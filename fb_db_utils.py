@@ -1,40 +1,15 @@
 import uuid
 import json
 import os
+import sys
 import ast
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-
-CURR_DIR = os.path.dirname(os.path.realpath(__file__))
-
-keyfile_path = os.path.join(CURR_DIR, 'image-finder-demo-firebase-adminsdk-3kvua-934cc33dbb.json')
-
-if os.path.exists(keyfile_path):
-    cred_input = keyfile_path
-else:
-    cred_input = {
-        "type": os.environ.get("FIREBASE_TYPE"),
-        "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
-        "private_key_id": os.environ.get("FIREBASE_PRIVATE_KEY_ID"),
-        "private_key": os.environ.get("FIREBASE_PRIVATE_KEY").replace('\\n', '\n'),
-        "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
-        "client_id": os.environ.get("FIREBASE_CLIENT_ID"),
-        "auth_uri": os.environ.get("FIREBASE_AUTH_URI"),
-        "token_uri": os.environ.get("FIREBASE_TOKEN_URI"),
-        "auth_provider_x509_cert_url": os.environ.get("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
-        "client_x509_cert_url": os.environ.get("FIREBASE_CLIENT_X509_CERT_URL"),
-        "universe_domain": os.environ.get("FIREBASE_UNIVERSE_DOMAIN")
-    }
+import hashlib
 
-try:
-    firebase_admin.get_app()
-except ValueError:
-    cred = credentials.Certificate(cred_input)
-    print('initing app....')
-    firebase_admin.initialize_app(cred, {'storageBucket': 'image-finder-demo.appspot.com'})
-    print('firebase initialized')
+from log_sink import iter_log_entries
+from storage_backends import get_db, server_timestamp, DESCENDING
 
+#firestore WriteBatch limit is 500 writes
+SYNC_BATCH_SIZE = 500
 
 #TODO: .stream() method, slightly faster than get_data()??
 def read_data(db, user_id):
@@ -49,7 +24,7 @@ def read_data(db, user_id):
 
 #TODO: .stream() method, better than get_data()??
 def print_data(user_id):
-    db = firestore.client()
+    db = get_db()
 
     query_logs_ref = db.collection('logs').document(user_id).collection('query_logs')
     docs = query_logs_ref.stream()
@@ -58,17 +33,17 @@ def print_data(user_id):
 
 
 def get_and_printout_data(user_id):
-    db = firestore.client()
+    db = get_db()
 
     query_logs_ref = db.collection('logs').document(user_id).collection('query_logs')
-    queries = query_logs_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).get()
+    queries = query_logs_ref.order_by('timestamp', direction=DESCENDING).get()
     for query in queries:
         print(query.id, query.to_dict())
 
 
 def get_data(db, user_id):
     query_logs_ref = db.collection('logs').document(user_id).collection('query_logs')
-    queries = query_logs_ref.order_by('time_stamp', direction=firestore.Query.DESCENDING).get()
+    queries = query_logs_ref.order_by('time_stamp', direction=DESCENDING).get()
 
     query_data = [q.to_dict() for q in queries]
     return query_data
@@ -76,7 +51,7 @@ def get_data(db, user_id):
 
 #TODO: **not tested**
 def update_data():
-    db = firestore.client()
+    db = get_db()
 
     user_ref = db.collection('users').document('user_id')
     user_ref.update({
@@ -86,7 +61,7 @@ def update_data():
 
 #TODO: **not tested**
 def delete_data():
-    db = firestore.client()
+    db = get_db()
 
     user_ref = db.collection('users').document('user_id')
     user_ref.delete()
@@ -107,56 +82,139 @@ def get_dict_list_from_json(json_file_path):
 
 def get_existing_entry_times(db, user_id):
     query_data = get_data(db, user_id)
-    existing_times = [e.get('req_time_stamp') for e in query_data]
+    existing_times = {e.get('req_time_stamp') for e in query_data}
     return existing_times
 
 
 def get_number_of_queries(user_id):
-    db = firestore.client()
+    db = get_db()
     return len(read_data(db, user_id))
 
 
-def firebase_store_query_log(user_id, logging_entry, db=None):
-    if not db:
-        db = firestore.client()
-
+def make_query_log_doc(logging_entry):
+    """
+    (document id, firestore document) for a query logging entry
+    """
     req_time_stamp = logging_entry['time_stamp']
-    input = logging_entry['input']
-    rephrased_input = logging_entry['rephrased_input']
-    output = logging_entry['output']
-    raw_output = logging_entry['raw_output']
-
     query_id = req_time_stamp[5:10] + '-' + str(uuid.uuid4().hex)[6:]
-    new_query_doc_ref = db.collection('logs').document(user_id).collection('query_logs').document(query_id)
     query_data = {
-        'time_stamp' : firestore.SERVER_TIMESTAMP,  # Format as UTC ISO string
+        'time_stamp' : server_timestamp(),  # Format as UTC ISO string
         'req_time_stamp' : req_time_stamp,
-        'input': input,
-        'rephrased_input' : rephrased_input,
-        'output': output,
-        'raw_output': raw_output
+        'input': logging_entry['input'],
+        'rephrased_input' : logging_entry['rephrased_input'],
+        'output': logging_entry['output'],
+        'raw_output': logging_entry['raw_output']
     }
+    return query_id, query_data
 
+
+def firebase_store_query_log(user_id, logging_entry, db=None):
+    if not db:
+        db = get_db()
+
+    query_id, query_data = make_query_log_doc(logging_entry)
+    new_query_doc_ref = db.collection('logs').document(user_id).collection('query_logs').document(query_id)
     new_query_doc_ref.set(query_data)
 
 
-def sync_log_file_to_db(db, log_json_file, step_through=False):
-    #For syncing local JSON file of query logs to firebase db
-    user_id = os.path.basename(log_json_file)[:5]
+def store_query_logs_batch(user_entries, db=None):
+    """
+    write (user_id, logging_entry) pairs in one firestore WriteBatch (max 500 writes)
+    """
+    if not db:
+        db = get_db()
+
+    batch = db.batch()
+    for user_id, logging_entry in user_entries:
+        query_id, query_data = make_query_log_doc(logging_entry)
+        batch.set(db.collection('logs').document(user_id).collection('query_logs').document(query_id), query_data)
+    batch.commit()
+
+
+def sync_state_path(log_file):
+    return log_file + '.sync_state.json'
+
+
+def read_sync_state(log_file):
+    """
+    {'high_water_mark' : newest req_time_stamp already synced (str), 'synced' : entries written so far}
+    """
+    try:
+        with open(sync_state_path(log_file), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'high_water_mark' : None, 'synced' : 0}
+
+
+def write_sync_state(log_file, state):
+    tmp_path = sync_state_path(log_file) + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, sync_state_path(log_file))
+
 
-    existing_time_stamps = get_existing_entry_times(db, user_id)
-    query_entries = get_dict_list_from_json(log_json_file)
-    
+def entry_key(req_time_stamp, input):
+    """
+    dedupe key for a query log entry, time stamps alone collide for queries in the same second
+    """
+    return hashlib.sha1(f"{req_time_stamp}\x00{input}".encode('utf-8')).hexdigest()
+
+
+def get_remote_entry_keys(db, user_id, since=None):
+    """
+    set of entry keys for remote query logs, only docs with req_time_stamp >= since when given
+    """
+    query_logs_ref = db.collection('logs').document(user_id).collection('query_logs')
+    if since is not None:
+        query_logs_ref = query_logs_ref.where('req_time_stamp', '>=', since)
+    return {entry_key(d.get('req_time_stamp'), d.get('input')) for d in (doc.to_dict() for doc in query_logs_ref.stream())}
+
+
+def log_file_user_id(log_file):
+    #data/<user_id>/logs.jsonl, or the old <user_id>_logs.json naming
+    if os.path.basename(log_file).startswith('logs.'):
+        return os.path.basename(os.path.dirname(os.path.abspath(log_file)))
+    return os.path.basename(log_file)[:5]
+
+
+def sync_log_file_to_db(db, log_json_file, step_through=False, batch_size=SYNC_BATCH_SIZE):
+    """
+    Incremental sync of a local query log to the remote log store.
+
+    Only local entries at or after the last synced time stamp (kept in <log file>.sync_state.json) are considered,
+    they are deduped against remote docs from that time stamp on with a hashed set, and written in WriteBatches.
+    Returns number of entries written
+    """
+    user_id = log_file_user_id(log_json_file)
+    state = read_sync_state(log_json_file)
+    high_water_mark = state['high_water_mark']
+
+    existing_keys = get_remote_entry_keys(db, user_id, since=high_water_mark)
+    if log_json_file.endswith('.jsonl'):
+        query_entries = iter_log_entries(log_json_file, legacy_json_path=os.path.splitext(log_json_file)[0] + '.json')
+    else:
+        query_entries = get_dict_list_from_json(log_json_file) or []
+
+    query_logs_ref = db.collection('logs').document(user_id).collection('query_logs')
+    batch = db.batch()
+    batch_count = 0
+    written = 0
+    newest = high_water_mark
     for query in query_entries:
-        if step_through:
-            _ = input('add entry')
         if 'time_stamp' in query:
             req_time_stamp = query['time_stamp']
         else:
             req_time_stamp = query['req_time_stamp']
+        if high_water_mark is not None and req_time_stamp < high_water_mark:
+            continue
 
-        if req_time_stamp in existing_time_stamps:#TODO: do before traversal?
+        key = entry_key(req_time_stamp, query['input'])
+        if key in existing_keys:
             continue
+        existing_keys.add(key)
+
+        if step_through:
+            _ = input('add entry')
 
         if type(query['output']) == str:
             output = ast.literal_eval(query['output'])
@@ -165,20 +223,104 @@ def sync_log_file_to_db(db, log_json_file, step_through=False):
 
         q = {
             "req_time_stamp" : req_time_stamp,
-            "time_stamp" : firestore.SERVER_TIMESTAMP,
+            "time_stamp" : server_timestamp(),
             "input" : query['input'],
             "rephrased_input" : query['rephrased_input'],
             "output" : output
         }
-
-        query_id = uuid.uuid4().hex
-
-        new_query_doc_ref = db.collection('logs').document(user_id).collection('query_logs').document(query_id)
-        new_query_doc_ref.set(q)
+        batch.set(query_logs_ref.document(uuid.uuid4().hex), q)
+        batch_count += 1
+        newest = req_time_stamp if newest is None else max(newest, req_time_stamp)
+
+        if batch_count == batch_size:
+            batch.commit()
+            written += batch_count
+            batch = db.batch()
+            batch_count = 0
+            #only advance the mark past entries that are committed
+            write_sync_state(log_json_file, {'high_water_mark' : newest, 'synced' : state['synced'] + written})
+
+    if batch_count:
+        batch.commit()
+        written += batch_count
+    write_sync_state(log_json_file, {'high_water_mark' : newest, 'synced' : state['synced'] + written})
+    print(f"synced {written} new log entries for {user_id}")
+    return written
+
+
+def benchmark_log_sync(num_entries=20_000, num_new=1_000):
+    """
+    old sync (full remote read, list membership, one set() per entry) vs the incremental sync, both run
+    against copies of the same local backend fixture: a log with num_entries entries of which num_new
+    are not synced yet
+    """
+    import time
+    import shutil
+    import tempfile
+    from datetime import datetime, timedelta
+    from storage_backends import LocalDB
+
+    def old_sync_log_file_to_db(db, log_file, user_id):
+        #sync as it was before the high water mark: every remote doc read, list dedupe, one write per entry
+        existing_time_stamps = [e.get('req_time_stamp') for e in get_data(db, user_id)]
+        for query in iter_log_entries(log_file):
+            if query['time_stamp'] in existing_time_stamps:
+                continue
+            query_id, query_data = make_query_log_doc(query)
+            db.collection('logs').document(user_id).collection('query_logs').document(query_id).set(query_data)
+
+    start = datetime(2024, 1, 1)
+    entries = [{'time_stamp' : (start + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"),
+                'input' : f"query {i}", 'rephrased_input' : f"query {i}", 'output' : [], 'raw_output' : ''}
+               for i in range(num_entries)]
+    synced = num_entries - num_new
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        log_file = os.path.join(work_dir, 'bench0', 'logs.jsonl')
+        user_id = log_file_user_id(log_file)
+        os.makedirs(os.path.dirname(log_file))
+        with open(log_file, 'w') as file:
+            for e in entries:
+                file.write(json.dumps(e) + '\n')
+
+        #remote already holds the synced entries, each sync gets its own copy
+        fixture_dir = os.path.join(work_dir, 'firestore')
+        fixture_db = LocalDB(fixture_dir)
+        for i in range(0, synced, SYNC_BATCH_SIZE):
+            store_query_logs_batch([(user_id, e) for e in entries[i:min(i + SYNC_BATCH_SIZE, synced)]], fixture_db)
+        shutil.copytree(fixture_dir, fixture_dir + '_old')
+        shutil.copytree(fixture_dir, fixture_dir + '_new')
+        old_db = LocalDB(fixture_dir + '_old')
+        new_db = LocalDB(fixture_dir + '_new')
+
+        print(f"{num_entries} entries, {num_new} not yet synced")
+
+        t_start = time.perf_counter()
+        old_sync_log_file_to_db(old_db, log_file, user_id)
+        print(f"old sync (full read, list dedupe, {num_new} set() calls): {time.perf_counter() - t_start:.2f}s")
+
+        write_sync_state(log_file, {'high_water_mark' : entries[synced]['time_stamp'], 'synced' : synced})
+        t_start = time.perf_counter()
+        sync_log_file_to_db(new_db, log_file)
+        print(f"incremental sync ({-(-num_new // SYNC_BATCH_SIZE)} batch commits): "
+              f"{time.perf_counter() - t_start:.2f}s")
+
+        t_start = time.perf_counter()
+        sync_log_file_to_db(new_db, log_file)
+        print(f"incremental sync, nothing new: {time.perf_counter() - t_start:.2f}s")
+
+        remote_counts = [len(db.collection('logs').document(user_id).collection('query_logs').get())
+                         for db in (old_db, new_db)]
+        print(f"remote docs after sync: old {remote_counts[0]}, incremental {remote_counts[1]}")
 
 
 if __name__ == "__main__":
-    db = firestore.client()
+    if sys.argv[1:2] == ['benchmark']:
+        #python fb_db_utils.py benchmark [num_entries]
+        benchmark_log_sync(int(sys.argv[2]) if len(sys.argv) > 2 else 20_000)
+        sys.exit()
+
+    db = get_db()
 
     log_file = '/Users/cadeh/Desktop/MyCode/Workspace/image_finder_demo/query_logs/7vufQ_logs.json'
     uid = '7vufQ'
@@ -2,116 +2,178 @@ import os
 import sys
 import time
 import io
+import json
+import base64
+import hashlib
 import requests
 import datetime
-import firebase_admin
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from firebase_admin import credentials, firestore, storage
 from PIL import Image
 
+from retry_utils import retry_call
+from storage_backends import get_bucket, FIREBASE_BUCKET_NAME
+
 
 CURR_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIRECTORY = os.path.join(CURR_DIR, 'data')
 
 DESCRIPTIONS_FILENAME = 'descriptions.json'
 
-DB_APP_NAME = "image-finder-demo.appspot.com"
-
-keyfile_path = os.path.join(CURR_DIR, 'image-finder-demo-firebase-adminsdk-3kvua-934cc33dbb.json')
-if os.path.exists(keyfile_path):
-    cred_input = keyfile_path
-else:
-    cred_input = {
-        "type": os.environ.get("FIREBASE_TYPE"),
-        "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
-        "private_key_id": os.environ.get("FIREBASE_PRIVATE_KEY_ID"),
-        "private_key": os.environ.get("FIREBASE_PRIVATE_KEY").replace('\\n', '\n'),
-        "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
-        "client_id": os.environ.get("FIREBASE_CLIENT_ID"),
-        "auth_uri": os.environ.get("FIREBASE_AUTH_URI"),
-        "token_uri": os.environ.get("FIREBASE_TOKEN_URI"),
-        "auth_provider_x509_cert_url": os.environ.get("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
-        "client_x509_cert_url": os.environ.get("FIREBASE_CLIENT_X509_CERT_URL"),
-        "universe_domain": os.environ.get("FIREBASE_UNIVERSE_DOMAIN")
-    }
-
-try:
-    firebase_admin.get_app()
-except ValueError:
-    cred = credentials.Certificate(cred_input)
-    print('initing app....')
-    firebase_admin.initialize_app(cred, {'storageBucket': DB_APP_NAME})
-    print('firebase initialized')
-
-db = firestore.client()
-bucket = storage.bucket(DB_APP_NAME)
+DB_APP_NAME = FIREBASE_BUCKET_NAME
+
+#concurrent blob uploads, override with PHOTOFIND_UPLOAD_WORKERS
+UPLOAD_MAX_WORKERS = int(os.environ.get("PHOTOFIND_UPLOAD_WORKERS", 8))
+UPLOAD_ATTEMPTS = 5
+#per album record of uploaded files, lets an interrupted upload resume
+UPLOAD_MANIFEST_FILENAME = 'upload_manifest.json'
+
+#concurrent blob downloads, override with PHOTOFIND_DOWNLOAD_WORKERS
+DOWNLOAD_MAX_WORKERS = int(os.environ.get("PHOTOFIND_DOWNLOAD_WORKERS", 8))
+DOWNLOAD_ATTEMPTS = 5
+#per album record of the remote metadata each local file was downloaded at
+DOWNLOAD_MANIFEST_FILENAME = 'download_manifest.json'
+#line prefix the sync CLI prints progress with
+SYNC_PROGRESS_PREFIX = 'SYNC_PROGRESS'
 
 
 def init_app():
     """
-    first function that app.py loop runs to test correct import/db connection
+    first function that app.py loop runs, creates the storage client (see storage_backends.py)
     """
-    print('init app dud')
+    get_bucket()
 
 
-def upload_images_from_list(image_paths, skip_upload=False):
-    """
-    store images from list of paths to folder in firebase
+def upload_manifest_path(album_dir):
+    return os.path.join(album_dir, UPLOAD_MANIFEST_FILENAME)
 
-    images_paths: (list(str))
+
+def download_manifest_path(album_dir):
+    return os.path.join(album_dir, DOWNLOAD_MANIFEST_FILENAME)
+
+
+def _read_manifest(manifest_file):
+    try:
+        with open(manifest_file, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        print(f"unreadable manifest {manifest_file}, starting over")
+        return {}
+
+
+def _write_manifest(manifest_file, manifest):
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    tmp_path = manifest_file + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_file)
+
+
+def read_upload_manifest(album_dir):
+    """
+    {remote blob name : {'size', 'mtime_ns'}} of files already uploaded from this album
     """
-    if not skip_upload:
-        bucket = storage.bucket(DB_APP_NAME)
+    return _read_manifest(upload_manifest_path(album_dir))
 
-        folder_name = os.path.basename(os.path.dirname(image_paths[0]))
-        folder_name = image_paths[0].split('/')[-3]
-        num_imgs = len(image_paths)
 
-        for i, image_pathname in enumerate(image_paths):
-            if image_pathname.endswith((".png", ".jpg")):
-                image_name = os.path.basename(image_pathname)
+def write_upload_manifest(album_dir, manifest):
+    _write_manifest(upload_manifest_path(album_dir), manifest)
 
-                t_start = time.perf_counter()
-                blob = bucket.blob(os.path.join('data', folder_name, 'images', image_name))
-                t_end1 = time.perf_counter()
 
-                print('finished db connection in {}s'.format(round(t_end1 - t_start, 2)))
+def _file_signature(local_path):
+    stat = os.stat(local_path)
+    return {'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns}
 
-                try_again = False
-                try:
-                    blob.upload_from_filename(image_pathname)
-                except Exception as e: #TODO: specify exceptions
-                    print(e)
-                    print('file upload failed...sleeping and trying again')
-                    time.sleep(15)
-                    try_again = True
-                    print('trying again')
-                if try_again:
-                    blob.upload_from_filename(image_pathname)
 
-                t_end = time.perf_counter()
-                print('({}/{}) finished {} upload in {}s'.format(i+1, num_imgs, image_name, round(t_end - t_start, 2)))
+def upload_file(bucket, local_path, remote_name):
+    """
+    upload one file, retried with exponential backoff. returns bytes sent
+    """
+    blob = bucket.blob(remote_name)
+    retry_call(blob.upload_from_filename, local_path, attempts=UPLOAD_ATTEMPTS, base_delay=1.0, max_delay=30.0)
+    return os.path.getsize(local_path)
 
 
-def upload_images_from_dir(folder_path):
+def upload_files_parallel(file_pairs, album_dir, bucket=None, max_workers=UPLOAD_MAX_WORKERS, progress_callback=None):
     """
-    store images in a folder to folder in firebase
+    Upload files on a thread pool, skipping files the album's upload manifest already records unchanged.
+    The manifest is updated after every completed upload so an interrupted run resumes where it stopped.
+
+    file_pairs(list(tuple)): (local path, remote blob name)
+    bucket: storage bucket, anything with .blob(name).upload_from_filename(path) works
+    progress_callback(callable): called with (done_count, total_count) after every finished or failed upload
+    Returns dict with uploaded/skipped counts, failed local paths, bytes, seconds and MB/s
+    """
+    bucket = bucket or get_bucket()
+    manifest = read_upload_manifest(album_dir)
+
+    pending = [(local_path, remote_name) for local_path, remote_name in file_pairs
+               if manifest.get(remote_name) != _file_signature(local_path)]
+    skipped = len(file_pairs) - len(pending)
+    if skipped:
+        print(f"skipping {skipped} files already uploaded")
+
+    t_start = time.perf_counter()
+    uploaded = 0
+    failed = []
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload_file, bucket, local_path, remote_name) : (local_path, remote_name)
+                   for local_path, remote_name in pending}
+
+        #manifest is only touched from this thread
+        for i, future in enumerate(as_completed(futures)):
+            local_path, remote_name = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                print(f"({i+1}/{len(pending)}) upload of {os.path.basename(local_path)} failed: {e}")
+                failed.append(local_path)
+            else:
+                uploaded += 1
+                manifest[remote_name] = _file_signature(local_path)
+                write_upload_manifest(album_dir, manifest)
+                print(f"({i+1}/{len(pending)}) finished {os.path.basename(local_path)} upload")
+
+            #failed files count as done here, they are listed in the returned 'failed'
+            if progress_callback is not None:
+                progress_callback(i + 1, len(pending))
+
+    seconds = time.perf_counter() - t_start
+    mb_per_s = total_bytes / 1024**2 / seconds if seconds > 0 else 0.0
+    print(f"uploaded {uploaded} files ({total_bytes / 1024**2:.1f}MB) in {seconds:.1f}s, {mb_per_s:.2f}MB/s, "
+          f"{skipped} skipped, {len(failed)} failed")
+    return {'uploaded' : uploaded, 'skipped' : skipped, 'failed' : failed, 'bytes' : total_bytes,
+            'seconds' : round(seconds, 2), 'mb_per_s' : round(mb_per_s, 2)}
+
+
+def upload_images_from_list(image_paths, skip_upload=False, bucket=None, max_workers=UPLOAD_MAX_WORKERS,
+                            progress_callback=None):
     """
-    bucket = storage.bucket(DB_APP_NAME)
-    folder_name = folder_path.split('/')[-2]
+    store images from list of paths to folder in firebase
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith((".png", ".jpg")):
-            t_start = time.perf_counter()
-            blob = bucket.blob(os.path.join('data', folder_name, 'images', filename))
-            t_end1 = time.perf_counter()
+    images_paths: (list(str))
+    """
+    if skip_upload or not image_paths:
+        return None
 
-            print('finished db connection in {}s'.format(round(t_end1 - t_start, 2)))
+    album_dir = os.path.dirname(os.path.dirname(image_paths[0]))
+    folder_name = os.path.basename(album_dir)
+    file_pairs = [(path, os.path.join('data', folder_name, 'images', os.path.basename(path)))
+                  for path in image_paths if path.endswith((".png", ".jpg"))]
+    return upload_files_parallel(file_pairs, album_dir, bucket, max_workers, progress_callback)
 
-            blob.upload_from_filename(os.path.join(folder_path, filename))
 
-            t_end = time.perf_counter()
-            print('finished {} upload in {}s'.format(filename, round(t_end - t_start, 2)))
+def upload_images_from_dir(folder_path, bucket=None, max_workers=UPLOAD_MAX_WORKERS):
+    """
+    store images in a folder to folder in firebase
+    """
+    image_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path)]
+    return upload_images_from_list(image_paths, bucket=bucket, max_workers=max_workers)
 
 
 def fetch_and_process_images(blobs):
@@ -131,7 +193,7 @@ def upload_json_descriptions_file(json_descriptions_file):
     upload JSON file to firebase
     """
     api_key = json_descriptions_file.split('/')[-2]
-    bucket = storage.bucket(DB_APP_NAME)
+    bucket = get_bucket()
 
     if json_descriptions_file.endswith((".json")):
         blob = bucket.blob(os.path.join('data', api_key, DESCRIPTIONS_FILENAME))
@@ -139,7 +201,7 @@ def upload_json_descriptions_file(json_descriptions_file):
 
 
 def get_file_url(filename):
-    bucket = storage.bucket(DB_APP_NAME)
+    bucket = get_bucket()
     blob = bucket.blob(filename)
     return blob.generate_signed_url(version="v4",
                                     expiration=datetime.timedelta(minutes=15),
@@ -155,7 +217,7 @@ def fetch_image_descriptions(file_url, api_key=None):
 
 
 def list_files_in_folder(folder_name, search_pngs=True):
-    bucket = storage.bucket(DB_APP_NAME)
+    bucket = get_bucket()
     blobs = bucket.list_blobs(prefix=folder_name)
 
     if search_pngs and blobs:
@@ -171,7 +233,7 @@ def list_files_in_folder(folder_name, search_pngs=True):
 def does_image_folder_exist(folder_name):
     images_dir = os.path.join("data", folder_name, 'images')
 
-    bucket = storage.bucket(DB_APP_NAME)
+    bucket = get_bucket()
     blobs = list(bucket.list_blobs(prefix=images_dir))
 
     if len(blobs) > 1:
@@ -206,7 +268,7 @@ def get_remote_image_count(remote_folder, list_imgs=False):
     if not remote_folder.endswith('images'):
         remote_folder = os.path.join(remote_folder, 'images')
 
-    bucket = storage.bucket(DB_APP_NAME)
+    bucket = get_bucket()
     blobs = bucket.list_blobs(prefix=remote_folder)
 
     if list_imgs:
@@ -217,31 +279,121 @@ def get_remote_image_count(remote_folder, list_imgs=False):
     return img_count
 
 
-def download_images(remote_folder, local_folder):
-    if not remote_folder.startswith('data/'):
-        remote_folder = os.path.join('data', remote_folder)
-    if not remote_folder.endswith('images'):
-        remote_folder = os.path.join(remote_folder, 'images')
+def blob_signature(blob):
+    """
+    remote metadata a local copy is checked against, md5 falls back to crc32c for composite objects
+    """
+    return {'size' : blob.size, 'md5' : blob.md5_hash or blob.crc32c, 'generation' : blob.generation}
+
+
+def local_md5(file_path):
+    """
+    base64 md5 of a local file, same encoding as blob.md5_hash
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode('utf-8')
+
+
+def download_blob(blob, local_path):
+    """
+    download to a temp file and rename over local_path, readers never see a partial image. returns bytes written
+    """
+    tmp_path = local_path + '.part'
+    try:
+        retry_call(blob.download_to_filename, tmp_path, attempts=DOWNLOAD_ATTEMPTS, base_delay=1.0, max_delay=30.0)
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(local_path)
 
-    bucket = storage.bucket(DB_APP_NAME)
-    blobs = bucket.list_blobs(prefix=remote_folder)
 
+def sync_blobs(blobs, local_folder, album_dir, max_workers=DOWNLOAD_MAX_WORKERS, progress_callback=None):
+    """
+    Delta download: only blobs that are new or whose size/md5/generation changed since the last sync are fetched,
+    on a thread pool. Local files that match the remote md5 but predate the manifest are recorded, not re-downloaded.
+
+    progress_callback(callable): called with (done_count, total_count) for the blobs being downloaded
+    Returns dict with downloaded/unchanged/failed counts, bytes and seconds
+    """
+    manifest_file = download_manifest_path(album_dir)
+    manifest = _read_manifest(manifest_file)
     if not os.path.exists(local_folder):
         os.makedirs(local_folder)
 
+    pending = []
+    unchanged = 0
     for blob in blobs:
-        if blob.name.lower().endswith((".png", ".jpg")):
-            file_path = os.path.join(local_folder, os.path.basename(blob.name))
-            if not os.path.exists(file_path):
-                blob.download_to_filename(file_path)
-                print(f"Downloaded {blob.name} to {file_path}")
+        local_path = os.path.join(local_folder, os.path.basename(blob.name))
+        signature = blob_signature(blob)
+        if os.path.exists(local_path):
+            if manifest.get(blob.name) == signature:
+                unchanged += 1
+                continue
+            if blob.name not in manifest and blob.md5_hash and blob.md5_hash == local_md5(local_path):
+                manifest[blob.name] = signature
+                unchanged += 1
+                continue
+        pending.append((blob, local_path, signature))
+    _write_manifest(manifest_file, manifest)
+    print(f"{len(pending)} new or changed files to download, {unchanged} up to date")
+
+    t_start = time.perf_counter()
+    downloaded = 0
+    failed = []
+    total_bytes = 0
+    if progress_callback is not None:
+        progress_callback(0, len(pending))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_blob, blob, local_path) : (blob, signature)
+                   for blob, local_path, signature in pending}
+
+        #manifest is only touched from this thread
+        for i, future in enumerate(as_completed(futures)):
+            blob, signature = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                print(f"({i+1}/{len(pending)}) download of {blob.name} failed: {e}")
+                failed.append(blob.name)
+                continue
+
+            downloaded += 1
+            manifest[blob.name] = signature
+            _write_manifest(manifest_file, manifest)
+            if progress_callback is not None:
+                progress_callback(i + 1, len(pending))
+
+    seconds = time.perf_counter() - t_start
+    print(f"downloaded {downloaded} files ({total_bytes / 1024**2:.1f}MB) in {seconds:.1f}s, {len(failed)} failed")
+    return {'downloaded' : downloaded, 'unchanged' : unchanged, 'failed' : failed, 'bytes' : total_bytes,
+            'seconds' : round(seconds, 2)}
+
+
+def download_images(remote_folder, local_folder, bucket=None, max_workers=DOWNLOAD_MAX_WORKERS, progress_callback=None):
+    """
+    mirror an album's remote images folder into local_folder, see sync_blobs
+    """
+    if not remote_folder.startswith('data/'):
+        remote_folder = os.path.join('data', remote_folder)
+    if not remote_folder.endswith('images'):
+        remote_folder = os.path.join(remote_folder, 'images')
+
+    bucket = bucket or get_bucket()
+    blobs = [blob for blob in bucket.list_blobs(prefix=remote_folder) if blob.name.lower().endswith((".png", ".jpg"))]
+
+    album_dir = os.path.dirname(os.path.normpath(local_folder))
+    return sync_blobs(blobs, local_folder, album_dir, max_workers, progress_callback)
 
 
 def download_descr_file(local_descr_filepath):
     print('******download_descr_file*******')
     print(local_descr_filepath)
 
-    bucket = storage.bucket(DB_APP_NAME)
+    bucket = get_bucket()
     filename = os.path.basename(local_descr_filepath)
     basename = os.path.basename(os.path.dirname(local_descr_filepath))
 
@@ -284,8 +436,8 @@ def compare_dev_local_and_db_imgs(img_folder_name):
 
 if __name__ == "__main__":
     """
-    loop in app.py calls via running this script with subprocess.
-    This is a workaround for the threading/concurrency issues between streamlit and firebase_admin functions
+    standalone album sync: python fb_storage_utils.py <descriptions file> <images folder>
+    (the app syncs in-process with sync_worker.py)
     """
     descr_file = sys.argv[1]
     image_folder_path = sys.argv[2]
@@ -294,9 +446,12 @@ if __name__ == "__main__":
     if not os.path.exists(image_folder_path):
         os.makedirs(image_folder_path)
 
+    def print_progress(done_count, total_count):
+        print(f"{SYNC_PROGRESS_PREFIX} {done_count} {total_count}", flush=True)
+
     t_start = time.perf_counter()
     download_descr_file(descr_file)
-    download_images(remote_image_folder_name, image_folder_path)
+    download_images(remote_image_folder_name, image_folder_path, progress_callback=print_progress)
     t_end = time.perf_counter()
 
     print('finished in {}s'.format(t_end - t_start))
@@ -0,0 +1,189 @@
+"""
+Content-hash catalog of every image ingested into any album
+
+hash_catalog.jsonl (in the data directory) holds one {"hash", "album", "name"} line per image, where hash is the
+sha256 of the original file. Ingest uses it to drop re-uploads of images an album already has, and to reuse the
+description and embedding row of an image already described in another album instead of calling the APIs again.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from descr_store import load_descriptions
+from vector_store import get_store_dir, load_vectors, append_vectors, read_manifest
+from image_utils import file_content_hash
+from embedding_backends import store_embedding
+#same write paths as freshly generated descriptions, so the lexical index and cached vector index see reused ones
+from descr_generator import append_to_json_file
+from utils import INDEX_MANAGER
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
+CATALOG_FILE = os.path.join(DATA_DIRECTORY, 'hash_catalog.jsonl')
+DESCR_FILENAME = 'descriptions.json'
+
+#reuse descriptions/embeddings across albums (different api keys), set PHOTOFIND_CROSS_ALBUM_DEDUP=0 to disable
+CROSS_ALBUM_DEDUP = os.environ.get("PHOTOFIND_CROSS_ALBUM_DEDUP", "1") != "0"
+
+_index = {'stamp' : None, 'by_hash' : {}, 'by_album' : {}}
+_lock = threading.Lock()
+
+
+def bytes_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _stamp(catalog_file):
+    try:
+        stat = os.stat(catalog_file)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def _load(catalog_file):
+    #caller holds _lock
+    stamp = _stamp(catalog_file)
+    if _index['stamp'] == stamp and _index.get('file') == catalog_file:
+        return _index
+
+    by_hash = {}
+    by_album = {}
+    if stamp is not None:
+        with open(catalog_file, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                by_hash.setdefault(entry['hash'], []).append((entry['album'], entry['name']))
+                by_album.setdefault(entry['album'], {})[entry['name']] = entry['hash']
+    _index.update({'stamp' : stamp, 'file' : catalog_file, 'by_hash' : by_hash, 'by_album' : by_album})
+    return _index
+
+
+def add_entries(entries, catalog_file=CATALOG_FILE):
+    """
+    record (hash, album, name) tuples, names already cataloged for an album with the same hash are skipped
+    """
+    with _lock:
+        index = _load(catalog_file)
+        new_entries = [(h, album, name) for h, album, name in entries
+                       if index['by_album'].get(album, {}).get(name) != h]
+        if not new_entries:
+            return
+
+        catalog_dir = os.path.dirname(catalog_file)
+        if catalog_dir and not os.path.exists(catalog_dir):
+            os.makedirs(catalog_dir)
+        with open(catalog_file, 'a') as file:
+            for h, album, name in new_entries:
+                file.write(json.dumps({'hash' : h, 'album' : album, 'name' : name}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        for h, album, name in new_entries:
+            index['by_hash'].setdefault(h, []).append((album, name))
+            index['by_album'].setdefault(album, {})[name] = h
+        index['stamp'] = _stamp(catalog_file)
+
+
+def lookup(content_hash, catalog_file=CATALOG_FILE):
+    """
+    list of (album, name) holding an image with this hash
+    """
+    with _lock:
+        return list(_load(catalog_file)['by_hash'].get(content_hash, []))
+
+
+def catalog_album(album_dir, catalog_file=CATALOG_FILE):
+    """
+    hash and record the album's images that are not cataloged yet, e.g. albums from before the catalog
+    """
+    album = os.path.basename(album_dir)
+    images_dir = os.path.join(album_dir, 'images')
+    if not os.path.isdir(images_dir):
+        return
+    with _lock:
+        known = dict(_load(catalog_file)['by_album'].get(album, {}))
+
+    entries = []
+    for name in os.listdir(images_dir):
+        if name.endswith((".png", ".jpg")) and name not in known:
+            entries.append((file_content_hash(os.path.join(images_dir, name)), album, name))
+    add_entries(entries, catalog_file)
+
+
+def find_duplicate_in_album(content_hash, album_dir, catalog_file=CATALOG_FILE):
+    """
+    name of an image in this album with the same content, None if there is none
+    """
+    album = os.path.basename(album_dir)
+    for other_album, name in lookup(content_hash, catalog_file):
+        if other_album == album and os.path.exists(os.path.join(album_dir, 'images', name)):
+            return name
+    return None
+
+
+def reuse_known_images(album_dir, pics, catalog_file=CATALOG_FILE):
+    """
+    Copy descriptions (and embedding rows, when both album stores were built by the same embedding backend)
+    for pics whose content is already described in another album, or under another name in this one.
+
+    Returns {pic : description} for the reused pics, the rest still need describing
+    """
+    album = os.path.basename(album_dir)
+    descr_file = os.path.join(album_dir, DESCR_FILENAME)
+    store_dir = get_store_dir(album_dir)
+    target_embedding = store_embedding(store_dir)
+
+    reused = {}
+    reused_rows = {} #source store dir -> [(pic, source name)]
+    source_descriptions = {}
+    for pic in pics:
+        content_hash = file_content_hash(os.path.join(album_dir, 'images', pic))
+        for source_album, source_name in lookup(content_hash, catalog_file):
+            if (source_album, source_name) == (album, pic) or (source_album != album and not CROSS_ALBUM_DEDUP):
+                continue
+            source_dir = os.path.join(os.path.dirname(album_dir), source_album)
+            if source_dir not in source_descriptions:
+                source_descriptions[source_dir] = load_descriptions(os.path.join(source_dir, DESCR_FILENAME)) or {}
+            description = source_descriptions[source_dir].get(source_name)
+            if description is None:
+                continue
+
+            reused[pic] = description
+            reused_rows.setdefault(get_store_dir(source_dir), []).append((pic, source_name))
+            break
+
+    if not reused:
+        return reused
+    append_to_json_file(descr_file, reused)
+
+    #no store yet -> the album's first embedding pass covers the reused descriptions too
+    if target_embedding is None:
+        return reused
+    for source_store, pairs in reused_rows.items():
+        if store_embedding(source_store) != target_embedding:
+            continue
+        row_names, vectors = load_vectors(source_store)
+        name_to_row = {name : i for i, name in enumerate(row_names) if name is not None}
+        pairs = [(pic, source_name) for pic, source_name in pairs if source_name in name_to_row]
+        if pairs:
+            rows = vectors[[name_to_row[source_name] for _, source_name in pairs]]
+            append_vectors(store_dir, [pic for pic, _ in pairs], rows, embedding=target_embedding)
+            INDEX_MANAGER.bump_version(store_dir)
+    return reused
+
+
+def missing_vector_rows(album_dir, names):
+    """
+    names that have no row in the album's vector store (all of them if there is no store)
+    """
+    store_dir = get_store_dir(album_dir)
+    if read_manifest(store_dir) is None:
+        return list(names)
+    row_names, _ = load_vectors(store_dir)
+    present = set(name for name in row_names if name is not None)
+    return [name for name in names if name not in present]
@@ -0,0 +1,404 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+_3_MB = 3*1024*1024
+
+#the vision api downsizes anything larger than 2048px on its long side
+MAX_LONG_SIDE = 2048
+#rough JPEG size at quality ~85 for photos, used to size the image for the byte budget before encoding
+BYTES_PER_PIXEL_ESTIMATE = 0.35
+
+MIN_QUALITY = 40
+MAX_QUALITY = 90
+#processes in the compression pool
+COMPRESSION_MAX_WORKERS = os.cpu_count() or 2
+
+RENDITIONS_DIR = os.path.join(os.path.dirname(__file__), 'data', 'renditions')
+#derived variants of an original, part of the cache key so changing a spec regenerates its renditions
+RENDITION_SPECS = {
+    'api' : {'max_bytes' : _3_MB, 'max_long_side' : MAX_LONG_SIDE}, #vision api payload
+    'gallery' : {'width' : 300, 'max_height' : 400, 'quality' : 80}, #gallery grid, fixed width, center cropped
+    'preview' : {'long_side' : 800, 'quality' : 85}, #sidebar preview
+}
+
+#process-wide budget for encoded thumbnails held in memory, override with PHOTOFIND_THUMBNAIL_CACHE_MB
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("PHOTOFIND_THUMBNAIL_CACHE_MB", 64)) * 1024 * 1024
+
+_hash_memo = {} #image_path -> (mtime_ns, size, sha256)
+
+_compression_pool = None
+_compression_pool_lock = threading.Lock()
+
+
+# ****** COMPRESSION ENGINE ******
+
+def target_dimensions(size, max_bytes, max_long_side=MAX_LONG_SIDE):
+    """
+    dimensions to encode at, from the byte budget and the long side cap, never upscales
+    """
+    width, height = size
+    max_pixels = max_bytes / BYTES_PER_PIXEL_ESTIMATE
+    scale = min(1.0, math.sqrt(max_pixels / (width * height)), max_long_side / max(width, height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def open_for_size(image_path, target_size):
+    """
+    open and decode an image for a target size, JPEGs are decoded at a reduced scale with draft()
+    """
+    img = Image.open(image_path)
+    if img.format == 'JPEG':
+        #DCT scaling, decodes at 1/2, 1/4 or 1/8 size as long as that stays >= target_size
+        img.draft('RGB', target_size)
+    img = ImageOps.exif_transpose(img)
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def encode_jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def compress_image_bytes(image_path, max_bytes=_3_MB, max_long_side=MAX_LONG_SIDE):
+    """
+    JPEG bytes of an image under max_bytes, the original file is left untouched.
+
+    Dimensions are computed from the byte budget up front, then the highest quality that fits
+    is binary searched in memory. Small JPEGs are passed through without re-encoding.
+    """
+    with Image.open(image_path) as probe:
+        size = probe.size
+        is_jpeg = probe.format == 'JPEG'
+
+    target_size = target_dimensions(size, max_bytes, max_long_side)
+    if is_jpeg and target_size == size and os.path.getsize(image_path) <= max_bytes:
+        with open(image_path, 'rb') as file:
+            return file.read()
+
+    img = open_for_size(image_path, target_size)
+    if img.size != target_size:
+        img = img.resize(target_size, Image.Resampling.LANCZOS)
+
+    while True:
+        best = None
+        low, high = MIN_QUALITY, MAX_QUALITY
+        while low <= high:
+            quality = (low + high) // 2
+            encoded = encode_jpeg(img, quality)
+            if len(encoded) <= max_bytes:
+                best = encoded
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        if best is not None or min(img.size) <= 100:
+            return best if best is not None else encoded
+
+        #budget estimate was off for this image, shrink by the size overshoot and search again
+        shrink = math.sqrt(max_bytes / len(encoded)) * 0.95
+        img = img.resize((max(1, int(img.width * shrink)), max(1, int(img.height * shrink))),
+                         Image.Resampling.LANCZOS)
+
+
+def get_compression_pool():
+    """
+    process-wide pool for CPU-bound image preprocessing, so it overlaps api requests on the worker threads
+    """
+    global _compression_pool
+    with _compression_pool_lock:
+        if _compression_pool is None:
+            _compression_pool = ProcessPoolExecutor(max_workers=COMPRESSION_MAX_WORKERS)
+        return _compression_pool
+
+
+def compress_images_parallel(image_paths, max_bytes=_3_MB):
+    """
+    {image_path : future of compressed bytes}, computed on the compression pool
+    """
+    pool = get_compression_pool()
+    return {path : pool.submit(compress_image_bytes, path, max_bytes) for path in image_paths}
+
+
+# ****** RENDITION CACHE ******
+
+def file_content_hash(image_path):
+    """
+    sha256 of a file's bytes, memoized on (mtime, size) so unchanged files are only read once per process
+    """
+    stat = os.stat(image_path)
+    memo = _hash_memo.get(image_path)
+    if memo is not None and memo[:2] == (stat.st_mtime_ns, stat.st_size):
+        return memo[2]
+
+    sha = hashlib.sha256()
+    with open(image_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(chunk)
+    _hash_memo[image_path] = (stat.st_mtime_ns, stat.st_size, sha.hexdigest())
+    return sha.hexdigest()
+
+
+def spec_digest(spec_name):
+    spec = json.dumps(RENDITION_SPECS[spec_name], sort_keys=True)
+    return hashlib.sha256(spec.encode()).hexdigest()[:8]
+
+
+def rendition_path(content_hash, spec_name, cache_dir=RENDITIONS_DIR):
+    return os.path.join(cache_dir, content_hash[:2], f"{content_hash}.{spec_name}-{spec_digest(spec_name)}.jpg")
+
+
+def fit_width_and_crop(img, width, max_height):
+    """
+    resize to a fixed width keeping the aspect ratio, center crop if taller than max_height
+    """
+    new_height = max(1, int(width * img.height / img.width))
+    img = img.resize((width, new_height), Image.Resampling.LANCZOS)
+    if new_height > max_height:
+        top = (new_height - max_height) // 2
+        img = img.crop((0, top, width, top + max_height))
+    return img
+
+
+def render(image_path, spec_name):
+    """
+    encoded JPEG bytes of one rendition of an image
+    """
+    spec = RENDITION_SPECS[spec_name]
+    if spec_name == 'api':
+        return compress_image_bytes(image_path, spec['max_bytes'], spec['max_long_side'])
+
+    with Image.open(image_path) as probe:
+        width, height = probe.size
+    if spec_name == 'gallery':
+        scale = spec['width'] / width
+    else:
+        scale = min(1.0, spec['long_side'] / max(width, height))
+    target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    img = open_for_size(image_path, target_size)
+    if spec_name == 'gallery':
+        img = fit_width_and_crop(img, spec['width'], spec['max_height'])
+    elif img.size != target_size:
+        img = img.resize(target_size, Image.Resampling.LANCZOS)
+    return encode_jpeg(img, spec['quality'])
+
+
+def get_rendition(image_path, spec_name, cache_dir=RENDITIONS_DIR):
+    """
+    bytes of a rendition, generated once and read back from the content addressed cache after that.
+    originals are never modified
+    """
+    cached_path = rendition_path(file_content_hash(image_path), spec_name, cache_dir)
+    try:
+        with open(cached_path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    data = render(image_path, spec_name)
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    #unique temp name, other processes in the pool may be rendering the same file
+    tmp_path = f"{cached_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, cached_path)
+    return data
+
+
+def get_renditions_parallel(image_paths, spec_name, cache_dir=RENDITIONS_DIR):
+    """
+    {image_path : future of rendition bytes}, cache misses are rendered on the compression pool
+    """
+    pool = get_compression_pool()
+    return {path : pool.submit(get_rendition, path, spec_name, cache_dir) for path in image_paths}
+
+
+# ****** THUMBNAIL CACHE ******
+
+class ThumbnailCache:
+    """
+    Process-wide LRU of encoded rendition bytes, shared by every session instead of a PIL image per session.
+    Entries are keyed on (path, mtime, size) so replaced files are picked up, misses go through the rendition cache.
+
+    spec_name(str): rendition to hold, see RENDITION_SPECS
+    max_bytes(int): memory budget for the encoded bytes
+    """
+    def __init__(self, spec_name='gallery', max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.spec_name = spec_name
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() #(path, mtime_ns, size) -> bytes
+        self._lock = threading.Lock()
+
+    def _key(self, image_path):
+        stat = os.stat(image_path)
+        return (image_path, stat.st_mtime_ns, stat.st_size)
+
+    def _lookup(self, key):
+        #caller holds _lock
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return data
+
+    def _put(self, key, data):
+        #caller holds _lock
+        if key in self._entries or len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self.nbytes += len(data)
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def get(self, image_path):
+        key = self._key(image_path)
+        with self._lock:
+            data = self._lookup(key)
+        if data is None:
+            data = get_rendition(image_path, self.spec_name)
+            with self._lock:
+                self._put(key, data)
+        return data
+
+    def get_many(self, image_paths):
+        """
+        {image_path : bytes} in the given order, misses are rendered in parallel on the compression pool
+        """
+        keys = {path : self._key(path) for path in image_paths}
+        found = {}
+        with self._lock:
+            for path, key in keys.items():
+                data = self._lookup(key)
+                if data is not None:
+                    found[path] = data
+
+        missing = [path for path in image_paths if path not in found]
+        if len(missing) == 1:
+            found[missing[0]] = get_rendition(missing[0], self.spec_name)
+        elif missing:
+            for path, future in get_renditions_parallel(missing, self.spec_name).items():
+                found[path] = future.result()
+        with self._lock:
+            for path in missing:
+                self._put(keys[path], found[path])
+
+        return {path : found[path] for path in image_paths}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries' : len(self._entries), 'nbytes' : self.nbytes, 'max_bytes' : self.max_bytes,
+                    'hits' : self.hits, 'misses' : self.misses}
+
+
+THUMBNAIL_CACHE = ThumbnailCache('gallery')
+
+
+# ****** BENCHMARK ******
+
+def make_synthetic_corpus(corpus_dir, count=12, size=(4032, 3024)):
+    """
+    photo-sized JPEGs and PNGs with noise + gradients, roughly as hard to compress as real photos
+    """
+    noise = Image.effect_noise(size, 60).convert('L')
+    gradient = Image.linear_gradient('L').resize(size)
+    paths = []
+    for i in range(count):
+        channels = [noise, gradient.rotate(90 * (i % 4)), ImageOps.invert(noise)]
+        img = Image.merge('RGB', channels[i % 3:] + channels[:i % 3])
+        ext = 'png' if i % 4 == 0 else 'jpg'
+        path = os.path.join(corpus_dir, f"synthetic_{i}.{ext}")
+        if ext == 'png':
+            img.save(path, 'PNG')
+        else:
+            img.save(path, 'JPEG', quality=95)
+        paths.append(path)
+    return paths
+
+
+def benchmark_compression(count=12):
+    """
+    current utils.reduce_png_quality / reduce_jpeg_size (serial, on disk) vs compress_image_bytes
+    (serial and on the process pool) over a synthetic corpus
+    """
+    from utils import reduce_png_quality, reduce_jpeg_size
+
+    corpus_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    try:
+        paths = make_synthetic_corpus(corpus_dir, count)
+        total_mb = sum(os.path.getsize(p) for p in paths) / 1024**2
+        print(f"corpus: {len(paths)} images, {total_mb:.1f}MB")
+
+        t_start = time.perf_counter()
+        for path in paths:
+            work_path = os.path.join(work_dir, os.path.basename(path))
+            shutil.copy(path, work_path)
+            try:
+                if work_path.endswith('.png'):
+                    reduce_png_quality(work_path, work_path)
+                else:
+                    reduce_jpeg_size(work_path, work_path)
+            except Exception as e:
+                print(f"current function failed on {os.path.basename(path)}: {e}")
+        current_time = time.perf_counter() - t_start
+
+        t_start = time.perf_counter()
+        serial_sizes = [len(compress_image_bytes(path)) for path in paths]
+        serial_time = time.perf_counter() - t_start
+
+        #workers are spawned lazily on submit, busy every slot once so startup is timed on its own.
+        #short sleeps keep workers from being reused, which a no-op task would allow
+        pool = get_compression_pool()
+        t_start = time.perf_counter()
+        list(pool.map(time.sleep, [0.05] * COMPRESSION_MAX_WORKERS))
+        startup_time = max(0.0, time.perf_counter() - t_start - 0.05)
+
+        t_start = time.perf_counter()
+        futures = compress_images_parallel(paths)
+        parallel_sizes = [len(future.result()) for future in futures.values()]
+        parallel_time = time.perf_counter() - t_start
+
+        print(f"current (serial, on disk):       {current_time:.2f}s")
+        print(f"in-memory engine (serial):       {serial_time:.2f}s")
+        print(f"in-memory engine (process pool): {parallel_time:.2f}s (+{startup_time:.2f}s one-time worker startup"
+              f" for {COMPRESSION_MAX_WORKERS} workers)")
+        print(f"max output size: {max(serial_sizes + parallel_sizes) / 1024**2:.2f}MB")
+    finally:
+        shutil.rmtree(corpus_dir)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    benchmark_compression(int(sys.argv[1]) if len(sys.argv) > 1 else 12)
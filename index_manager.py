@@ -0,0 +1,409 @@
+import os
+import sys
+import time
+import math
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+#memory budget for all cached album indexes, override with PHOTOFIND_INDEX_CACHE_MB
+DEFAULT_MEMORY_BUDGET = int(os.environ.get("PHOTOFIND_INDEX_CACHE_MB", 512)) * 1024 * 1024
+
+INDEX_TYPES = ['flat', 'ivf_flat', 'ivf_pq', 'hnsw']
+
+#index_type='auto': exact search for small albums, IVF once a brute-force scan gets slow,
+#IVF-PQ once full float32 vectors no longer fit comfortably in memory
+AUTO_IVF_MIN_ROWS = 20_000
+AUTO_PQ_MIN_ROWS = 250_000
+
+#retrain IVF coarse centroids once an album has grown this much since they were trained
+RETRAIN_GROWTH_FACTOR = 2.0
+
+IVF_TRAIN_POINTS_PER_LIST = 64
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+HNSW_M = 32
+PQ_BITS = 8
+
+
+def select_index_type(num_rows):
+    if num_rows < AUTO_IVF_MIN_ROWS:
+        return 'flat'
+    if num_rows < AUTO_PQ_MIN_ROWS:
+        return 'ivf_flat'
+    return 'ivf_pq'
+
+
+def default_nlist(num_rows):
+    #~4*sqrt(n) lists, but keep enough training points per list
+    return max(1, min(int(4 * math.sqrt(num_rows)), num_rows // IVF_TRAIN_POINTS_PER_LIST))
+
+
+def pq_subquantizers(dim):
+    #largest sub-quantizer count <= dim/16 that divides dim
+    for m in range(max(1, dim // 16), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def normalize_rows(vectors):
+    vectors = np.array(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def ranking_agreement(reference_embeddings, compact_embeddings, dtype, k=10, num_queries=200):
+    """
+    how closely a normalized float16/int8 inner-product index reproduces the float32 L2 ranking.
+    stored rows are used as queries.
+
+    reference_embeddings(np.array): original float32 vectors
+    compact_embeddings(np.array): the same rows decoded from the compact store
+    returns dict with overlap@k, top-1 agreement and index sizes
+    """
+    reference_embeddings = np.ascontiguousarray(reference_embeddings, dtype='float32')
+    num_rows, dim = reference_embeddings.shape
+    num_queries = min(num_queries, num_rows)
+    k = min(k, num_rows)
+    queries = reference_embeddings[np.sort(np.random.default_rng(0).choice(num_rows, num_queries, replace=False))]
+
+    reference_index = build_faiss_index(reference_embeddings, 'flat')
+    compact_index = build_faiss_index(compact_embeddings, 'flat', dtype=dtype, metric='ip')
+
+    _, reference_ids = reference_index.search(queries, k)
+    _, compact_ids = compact_index.search(normalize_rows(queries), k)
+
+    overlap = sum(len(set(reference_ids[q]) & set(compact_ids[q])) for q in range(num_queries))
+    top1 = sum(reference_ids[q][0] == compact_ids[q][0] for q in range(num_queries))
+    return {
+        'dtype' : dtype,
+        'rows' : num_rows,
+        'k' : k,
+        'overlap_at_k' : overlap / (num_queries * k),
+        'top1_agreement' : float(top1 / num_queries),
+        'float32_index_bytes' : index_nbytes('flat', num_rows, dim),
+        'compact_index_bytes' : index_nbytes('flat', num_rows, dim, dtype)
+    }
+
+
+def index_factory_string(index_type, num_rows, dim, nlist=None, dtype='float32'):
+    """
+    faiss index_factory description for an index type over an album's storage dtype,
+    float16/int8 albums keep their vectors scalar-quantized inside the index as well
+    """
+    codec = {'float32' : 'Flat', 'float16' : 'SQfp16', 'int8' : 'SQ8'}[dtype]
+
+    if index_type == 'flat':
+        return codec
+    if index_type == 'hnsw':
+        return f"HNSW{HNSW_M}_SQ8" if dtype == 'int8' else f"HNSW{HNSW_M}"
+    if index_type == 'ivf_flat':
+        return f"IVF{nlist or default_nlist(num_rows)},{codec}"
+    if index_type == 'ivf_pq':
+        return f"IVF{nlist or default_nlist(num_rows)},PQ{pq_subquantizers(dim)}x{PQ_BITS}"
+    raise ValueError(f"unknown index type {index_type}, expected one of {INDEX_TYPES}")
+
+
+def build_faiss_index(embeddings, index_type='flat', nlist=None, dtype='float32', metric='l2'):
+    """
+    build and (if needed) train an index over float32 embeddings of shape (n, dim)
+
+    index_type(str): one of INDEX_TYPES
+    nlist(int): IVF coarse lists, defaults to default_nlist(n)
+    dtype(str): album storage dtype, 'float32', 'float16' or 'int8'
+    metric(str): 'l2', or 'ip' for L2-normalized albums (cosine)
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    num_rows, dim = embeddings.shape
+
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == 'ip' else faiss.METRIC_L2
+    index = faiss.index_factory(dim, index_factory_string(index_type, num_rows, dim, nlist, dtype), faiss_metric)
+
+    if not index.is_trained:
+        train_size = min(num_rows, max(nlist or default_nlist(num_rows), 1) * 256)
+        if train_size < num_rows:
+            sample = np.random.default_rng(0).choice(num_rows, train_size, replace=False)
+            index.train(embeddings[np.sort(sample)])
+        else:
+            index.train(embeddings)
+
+    index.add(embeddings)
+    return index
+
+
+def search_params(index_type, nprobe=None, ef_search=None):
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return faiss.SearchParametersIVF(nprobe=nprobe or DEFAULT_NPROBE)
+    if index_type == 'hnsw':
+        return faiss.SearchParametersHNSW(efSearch=ef_search or DEFAULT_EF_SEARCH)
+    return None
+
+
+def index_nbytes(index_type, num_rows, dim, dtype='float32'):
+    code_size = dim * {'float32' : 4, 'float16' : 2, 'int8' : 1}[dtype]
+    if index_type == 'ivf_pq':
+        return num_rows * (pq_subquantizers(dim) + 8)
+    if index_type == 'ivf_flat':
+        return num_rows * (code_size + 8)
+    if index_type == 'hnsw':
+        code_size = dim if dtype == 'int8' else dim * 4
+        return num_rows * (code_size + HNSW_M * 2 * 4)
+    return num_rows * code_size
+
+
+class AlbumIndexManager:
+    """
+    Process-wide cache of built faiss indexes, one per album embeddings store.
+
+    An index is only reloaded when its version file changes (mtime/size on disk or an
+    explicit bump_version() after a write). Appended rows are added to the cached index
+    without a rebuild as long as the store generation and dim are unchanged, invalidate()
+    drops the cached index altogether. IVF indexes are retrained once the album grows past
+    RETRAIN_GROWTH_FACTOR times the rows they were trained on. Least recently used albums
+    are evicted once the cached indexes go over the memory budget.
+
+    loader(callable): embeddings_file -> (row_names, float32 np.array of shape (n, dim))
+    version_file(callable): embeddings_file -> path that changes whenever the embeddings do
+    store_settings(callable): embeddings_file -> dict with the album's storage 'dtype', 'metric' and 'generation'
+    """
+    def __init__(self, loader, version_file=None, store_settings=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.loader = loader
+        self.version_file = version_file or (lambda embeddings_file: embeddings_file)
+        self.store_settings = store_settings or (lambda embeddings_file: {})
+        self.memory_budget = memory_budget
+
+        self._entries = OrderedDict() #embeddings_file -> entry dict, see _update_entry
+        self._counters = {} #embeddings_file -> explicit version counter
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _version(self, embeddings_file):
+        stat = os.stat(self.version_file(embeddings_file))
+        return (stat.st_mtime_ns, stat.st_size, self._counters.get(embeddings_file, 0))
+
+    def bump_version(self, embeddings_file):
+        """
+        bump the version counter after rows were appended, next lookup adds the new rows to the cached index
+        """
+        with self._lock:
+            self._counters[embeddings_file] = self._counters.get(embeddings_file, 0) + 1
+
+    def invalidate(self, embeddings_file):
+        """
+        drop the cached index for an album, next lookup rebuilds it from scratch
+        """
+        with self._lock:
+            self._counters[embeddings_file] = self._counters.get(embeddings_file, 0) + 1
+            entry = self._entries.pop(embeddings_file, None)
+            if entry is not None:
+                self._total_bytes -= entry['nbytes']
+
+    def get_index(self, embeddings_file, index_type='auto', nlist=None):
+        """
+        return the cached entry for an embeddings file, (re)building the index if it is missing or stale.
+        entry keys: index, row_names, dead_rows, index_type, nlist, trained_rows, generation
+
+        index_type(str): 'auto' or one of INDEX_TYPES
+        nlist(int): IVF coarse lists, only used when an IVF index is (re)trained
+        """
+        version = self._version(embeddings_file)
+
+        with self._lock:
+            entry = self._entries.get(embeddings_file)
+            if (entry is not None and entry['version'] == version
+                    and index_type in ('auto', entry['index_type'])
+                    and (nlist is None or nlist == entry['nlist'])):
+                self._entries.move_to_end(embeddings_file)
+                return entry
+
+        #build outside the lock so other albums can still be served
+        row_names, embeddings = self.loader(embeddings_file)
+        settings = self.store_settings(embeddings_file) or {}
+        entry = self._update_entry(entry, row_names, embeddings, index_type, nlist,
+                                   settings.get('dtype', 'float32'), settings.get('metric', 'l2'),
+                                   settings.get('generation', 0))
+        entry['version'] = version
+
+        with self._lock:
+            old_entry = self._entries.pop(embeddings_file, None)
+            if old_entry is not None:
+                self._total_bytes -= old_entry['nbytes']
+            self._entries[embeddings_file] = entry
+            self._total_bytes += entry['nbytes']
+            self._evict()
+
+        return entry
+
+    def _update_entry(self, entry, row_names, embeddings, index_type, nlist, dtype, metric, generation):
+        num_rows = len(row_names)
+        wanted_type = select_index_type(num_rows) if index_type == 'auto' else index_type
+
+        #a new store generation means existing rows were rewritten (re-embedded, converted), rebuild
+        if (entry is not None and (entry['dtype'], entry['metric'], entry['generation']) == (dtype, metric, generation)
+                and self._can_append(entry, row_names, embeddings, wanted_type, nlist)):
+            #append-only growth: add just the new rows to the already trained index.
+            #added to a clone, searches may still be running against the cached one
+            old_names = entry['row_names']
+            index = faiss.clone_index(entry['index'])
+            index.add(np.ascontiguousarray(embeddings[index.ntotal:], dtype='float32'))
+            #superseded rows are counted here, on the write path, so searches don't scan row_names
+            newly_dead = sum(1 for old_name, new_name in zip(old_names, row_names)
+                             if new_name is None and old_name is not None)
+            dead_rows = entry['dead_rows'] + newly_dead + row_names[len(old_names):].count(None)
+            return dict(entry, index=index, row_names=row_names, dead_rows=dead_rows,
+                        nbytes=index_nbytes(wanted_type, num_rows, embeddings.shape[1], dtype))
+
+        t_start = time.perf_counter()
+        if wanted_type in ('ivf_flat', 'ivf_pq'):
+            nlist = nlist or default_nlist(num_rows)
+        index = build_faiss_index(embeddings, wanted_type, nlist, dtype, metric)
+        print(f"built {wanted_type} ({dtype}, {metric}) index over {num_rows} rows"
+              f" in {round(time.perf_counter() - t_start, 2)}s")
+
+        return {
+            'index' : index,
+            'row_names' : row_names,
+            'dead_rows' : row_names.count(None),
+            'index_type' : wanted_type,
+            'nlist' : nlist,
+            'trained_rows' : num_rows,
+            'dtype' : dtype,
+            'metric' : metric,
+            'generation' : generation,
+            'nbytes' : index_nbytes(wanted_type, num_rows, embeddings.shape[1], dtype)
+        }
+
+    def _can_append(self, entry, row_names, embeddings, wanted_type, nlist):
+        old_names = entry['row_names']
+        if wanted_type != entry['index_type'] or len(row_names) < len(old_names):
+            return False
+        #the cached index must hold exactly the old rows, with vectors of the same size
+        if entry['index'].ntotal != len(old_names) or entry['index'].d != embeddings.shape[1]:
+            return False
+        if nlist is not None and nlist != entry['nlist']:
+            return False
+        if wanted_type in ('ivf_flat', 'ivf_pq') and len(row_names) > RETRAIN_GROWTH_FACTOR * entry['trained_rows']:
+            return False
+        #old rows may only have been superseded, never reordered (compaction reorders)
+        for old_name, new_name in zip(old_names, row_names):
+            if new_name is not None and new_name != old_name:
+                return False
+        return True
+
+    def search(self, embeddings_file, query_embedding, k, index_type='auto', nlist=None, nprobe=None, ef_search=None):
+        """
+        lookup the album index and search it
+
+        returns (distances, names): ranked image names for the top k rows, superseded rows are skipped.
+        distances are squared L2, cosine albums report the equivalent 2 - 2*cos so callers see one scale
+        nprobe(int): IVF lists visited per query
+        ef_search(int): HNSW search breadth
+        """
+        entry = self.get_index(embeddings_file, index_type, nlist)
+        index, row_names = entry['index'], entry['row_names']
+        query_embedding = np.array(query_embedding, dtype='float32').reshape(1, -1)
+        if query_embedding.shape[1] != index.d:
+            raise ValueError(f"query embedding has dim {query_embedding.shape[1]}, {embeddings_file} index has dim "
+                             f"{index.d}, the query was embedded with a different backend than the album")
+        if entry['metric'] == 'ip':
+            query_embedding = normalize_rows(query_embedding)
+
+        #over-fetch by the number of superseded rows so k live names still come back
+        n_dead = entry['dead_rows']
+        params = search_params(entry['index_type'], nprobe, ef_search)
+        distances, indices = index.search(query_embedding, min(k + n_dead, index.ntotal), params=params)
+
+        ranked_distances = []
+        ranked_names = []
+        for dist, i in zip(distances[0], indices[0]):
+            if i < 0 or row_names[i] is None:
+                continue
+            if entry['metric'] == 'ip':
+                dist = 2 - 2 * dist
+            ranked_distances.append(float(dist))
+            ranked_names.append(row_names[i])
+        return ranked_distances[:k], ranked_names[:k]
+
+    def report_recall(self, embeddings_file, k=10, num_queries=100, index_type='auto', nlist=None,
+                      nprobe=None, ef_search=None):
+        """
+        recall@k of the album's (approximate) index against an exact flat scan, using stored rows as queries.
+        returns dict with recall, average query times and the index settings used
+        """
+        entry = self.get_index(embeddings_file, index_type, nlist)
+        _, embeddings = self.loader(embeddings_file)
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+
+        num_queries = min(num_queries, embeddings.shape[0])
+        query_rows = np.random.default_rng(0).choice(embeddings.shape[0], num_queries, replace=False)
+        queries = embeddings[np.sort(query_rows)]
+        k = min(k, embeddings.shape[0])
+
+        if entry['metric'] == 'ip':
+            queries = normalize_rows(queries)
+            exact_index = faiss.IndexFlatIP(embeddings.shape[1])
+        else:
+            exact_index = faiss.IndexFlatL2(embeddings.shape[1])
+        exact_index.add(embeddings)
+
+        t_start = time.perf_counter()
+        _, exact_ids = exact_index.search(queries, k)
+        exact_time = time.perf_counter() - t_start
+
+        params = search_params(entry['index_type'], nprobe, ef_search)
+        t_start = time.perf_counter()
+        _, approx_ids = entry['index'].search(queries, k, params=params)
+        approx_time = time.perf_counter() - t_start
+
+        hits = sum(len(set(exact_ids[q]) & set(approx_ids[q])) for q in range(num_queries))
+        return {
+            'index_type' : entry['index_type'],
+            'dtype' : entry['dtype'],
+            'rows' : embeddings.shape[0],
+            'nlist' : entry['nlist'],
+            'nprobe' : nprobe or DEFAULT_NPROBE,
+            'ef_search' : ef_search or DEFAULT_EF_SEARCH,
+            'k' : k,
+            'recall' : hits / (num_queries * k),
+            'exact_ms_per_query' : 1000 * exact_time / num_queries,
+            'index_ms_per_query' : 1000 * approx_time / num_queries
+        }
+
+    def _evict(self):
+        #always keep the most recently used album, even if it alone is over budget
+        while self._total_bytes > self.memory_budget and len(self._entries) > 1:
+            evicted_file, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry['nbytes']
+            print(f"index cache: evicted {evicted_file}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'albums' : len(self._entries),
+                'bytes' : self._total_bytes,
+                'memory_budget' : self.memory_budget
+            }
+
+
+if __name__ == '__main__':
+    """
+    recall@k report for an album, to tune the speed/recall trade-off
+    python index_manager.py <album_dir> [index_type] [nprobe/ef_search]
+    """
+    from vector_store import get_store_dir, load_vectors, manifest_path, read_manifest
+
+    store_dir = get_store_dir(sys.argv[1])
+    report_index_type = sys.argv[2] if len(sys.argv) > 2 else 'auto'
+    breadth = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    manager = AlbumIndexManager(loader=load_vectors, version_file=manifest_path, store_settings=read_manifest)
+    print(manager.report_recall(store_dir, index_type=report_index_type, nprobe=breadth, ef_search=breadth))
@@ -0,0 +1,207 @@
+"""
+Background shipping of query logs to the remote log store (firestore, see storage_backends.py)
+
+Searches only queue an entry, a worker thread writes queued entries in WriteBatches once
+LOG_SHIP_BATCH_SIZE entries are waiting or LOG_SHIP_FLUSH_INTERVAL seconds have passed.
+While the remote is failing, batches are appended to a local spill file (fsynced) and
+replayed after the next successful write, so entries survive outages and restarts.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+
+from fb_db_utils import store_query_logs_batch
+from retry_utils import backoff_delay
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
+
+#firestore WriteBatch limit is 500 writes
+LOG_SHIP_BATCH_SIZE = 100
+LOG_SHIP_FLUSH_INTERVAL = 2.0
+LOG_SHIP_QUEUE_SIZE = 10_000
+#kept outside album folders and named so it never matches the logs.*.jsonl segment pattern
+SPILL_FILE = os.path.join(DATA_DIRECTORY, 'query_log_spill.jsonl')
+
+_shipper = None
+_shipper_lock = threading.Lock()
+
+
+class LogShipper:
+    """
+    Bounded queue + worker thread that ships (user_id, logging_entry) pairs in batches.
+
+    write_batch(callable): writes a list of (user_id, logging_entry), raises on failure
+    spill_path(str): local durable buffer for entries that could not be shipped
+    """
+    def __init__(self, write_batch=store_query_logs_batch, spill_path=SPILL_FILE, batch_size=LOG_SHIP_BATCH_SIZE,
+                 flush_interval=LOG_SHIP_FLUSH_INTERVAL, queue_size=LOG_SHIP_QUEUE_SIZE):
+        self.write_batch = write_batch
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.shipped = 0
+        self.spilled = 0
+        self._failures = 0
+        self._retry_at = 0.0
+        self._spill_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='query-log-shipper', daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, logging_entry):
+        """
+        queue one entry without blocking, spills straight to disk if the queue is full
+        """
+        if self._closed:
+            raise ValueError("log shipper is closed")
+        try:
+            self._queue.put_nowait((user_id, logging_entry))
+        except queue.Full:
+            self._spill([(user_id, logging_entry)])
+
+    def flush(self):
+        """
+        block until everything queued so far has been shipped or spilled
+        """
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            entries = [e for e in batch if e is not None]
+            try:
+                if entries:
+                    self._ship(entries)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                return
+
+    def _ship(self, entries):
+        #remote marked down, don't wait on it until the backoff expires
+        if time.monotonic() < self._retry_at:
+            self._spill(entries)
+            return
+
+        try:
+            self.write_batch(entries)
+        except Exception as e:
+            self._failures += 1
+            delay = backoff_delay(self._failures, base_delay=2.0, max_delay=300.0)
+            self._retry_at = time.monotonic() + delay
+            print(f"log shipper: remote write failed ({e}), spilling {len(entries)} entries, retrying in {delay:.0f}s")
+            self._spill(entries)
+            return
+
+        self._failures = 0
+        self.shipped += len(entries)
+        self._replay_spill()
+
+    def _spill(self, entries):
+        with self._spill_lock:
+            self._append_spill(entries)
+            self.spilled += len(entries)
+
+    def _append_spill(self, entries):
+        #caller holds _spill_lock
+        spill_dir = os.path.dirname(self.spill_path)
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        with open(self.spill_path, 'a') as file:
+            for user_id, logging_entry in entries:
+                file.write(json.dumps({'user_id' : user_id, 'entry' : logging_entry}, default=str) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _read_spill(self, path):
+        entries = []
+        if not os.path.exists(path):
+            return entries
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"log shipper: skipping unreadable line in {path}")
+                    continue
+                entries.append((item['user_id'], item['entry']))
+        return entries
+
+    def _replay_spill(self):
+        """
+        ship spilled entries now that the remote is reachable, whatever fails is appended to the spill file again.
+
+        The spill file is only held for the rename, the remote writes run without _spill_lock
+        so submit() never waits on the network when the queue is full. Entries being replayed
+        live in spill_path.replay until they are shipped or re-spilled, a crash in between
+        replays them again on the next successful write.
+        """
+        replay_path = self.spill_path + '.replay'
+        with self._spill_lock:
+            if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > 0:
+                if os.path.exists(replay_path):
+                    #left over from a crash mid-replay, fold it into the new batch
+                    self._append_spill(self._read_spill(replay_path))
+                    os.remove(replay_path)
+                os.replace(self.spill_path, replay_path)
+            elif not os.path.exists(replay_path):
+                return
+
+        #only the worker thread replays, so replay_path is not touched by anyone else from here
+        entries = self._read_spill(replay_path)
+        shipped = 0
+        try:
+            for i in range(0, len(entries), self.batch_size):
+                self.write_batch(entries[i:i + self.batch_size])
+                shipped = i + len(entries[i:i + self.batch_size])
+        except Exception as e:
+            print(f"log shipper: replaying spilled entries failed ({e}), {len(entries) - shipped} left")
+
+        with self._spill_lock:
+            if shipped < len(entries):
+                self._append_spill(entries[shipped:])
+            os.remove(replay_path)
+            self.shipped += shipped
+            self.spilled -= min(self.spilled, shipped)
+
+
+def get_log_shipper():
+    """
+    process-wide log shipper, started on first use
+    """
+    global _shipper
+    with _shipper_lock:
+        if _shipper is None:
+            _shipper = LogShipper()
+        return _shipper
+
+
+@atexit.register
+def close_log_shipper():
+    with _shipper_lock:
+        shipper = _shipper
+    if shipper is not None:
+        shipper.close()
@@ -0,0 +1,191 @@
+"""
+Append-only newline-delimited JSON log sinks, used for logs.jsonl (queries) and info.jsonl (raw api responses)
+
+Writes are queued and written by a background thread, off the request path. The live file is
+rotated once it passes max_bytes or max_age_seconds, rotated segments are optionally gzipped:
+
+logs.jsonl                              - live segment
+logs.20240501-101500-000001.jsonl.gz    - rotated segments, names sort oldest first
+"""
+
+import os
+import glob
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_QUEUE_SIZE = 10_000
+
+_writers = {} #path -> RotatingJsonlWriter
+_writers_lock = threading.Lock()
+
+
+class RotatingJsonlWriter:
+    """
+    Buffered writer for one JSON-lines log file.
+
+    path(str): live log file
+    max_bytes(int): rotate once the live file is larger than this, None to disable
+    max_age_seconds(float): rotate once the live file is older than this, None to disable
+    compress(bool): gzip rotated segments
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, max_age_seconds=None, compress=True,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.compress = compress
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._rotate_seq = 0
+        self._opened_at = time.time()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"log-sink-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def write(self, entry):
+        """
+        queue one entry, blocks only if the writer has fallen queue_size entries behind
+        """
+        if self._closed:
+            raise ValueError(f"log sink for {self.path} is closed")
+        self._queue.put(entry)
+
+    def flush(self):
+        """
+        block until everything queued so far is on disk
+        """
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            #drain whatever else is already queued, one write per batch
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            entries = [e for e in batch if e is not None]
+            try:
+                if entries:
+                    self._write_entries(entries)
+            except Exception as e:
+                print(f"log sink: failed writing {len(entries)} entries to {self.path}: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                return
+
+    def _write_entries(self, entries):
+        log_dir = os.path.dirname(self.path)
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+        self._maybe_rotate()
+        with open(self.path, 'a') as file:
+            for entry in entries:
+                file.write(json.dumps(entry, default=str) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _maybe_rotate(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._opened_at = time.time()
+            return
+
+        too_big = self.max_bytes is not None and stat.st_size >= self.max_bytes
+        too_old = self.max_age_seconds is not None and time.time() - self._opened_at >= self.max_age_seconds
+        if stat.st_size == 0 or not (too_big or too_old):
+            return
+
+        self._rotate_seq += 1
+        base, ext = os.path.splitext(self.path)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        rotated_path = f"{base}.{stamp}-{self._rotate_seq:06d}{ext}"
+        os.replace(self.path, rotated_path)
+        self._opened_at = time.time()
+
+        if self.compress:
+            with open(rotated_path, 'rb') as src, gzip.open(rotated_path + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated_path)
+
+
+def get_log_writer(path, **kwargs):
+    """
+    process-wide writer for a log path, created on first use (kwargs only apply then)
+    """
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = RotatingJsonlWriter(path, **kwargs)
+            _writers[path] = writer
+        return writer
+
+
+@atexit.register
+def close_log_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+def get_log_segments(path):
+    """
+    rotated segments of a log, oldest first, followed by the live file
+    """
+    base, ext = os.path.splitext(path)
+    segments = sorted(glob.glob(f"{glob.escape(base)}.*{ext}") + glob.glob(f"{glob.escape(base)}.*{ext}.gz"))
+    if os.path.exists(path):
+        segments.append(path)
+    return segments
+
+
+def iter_log_entries(path, legacy_json_path=None):
+    """
+    Generator: stream entries back from every segment of a log, oldest first, one line in memory at a time.
+
+    legacy_json_path(str): old json-array log (e.g. logs.json) whose entries come first
+    """
+    if legacy_json_path and os.path.exists(legacy_json_path) and os.path.getsize(legacy_json_path) > 0:
+        with open(legacy_json_path, 'r') as file:
+            try:
+                yield from json.load(file)
+            except json.JSONDecodeError:
+                print(f"Error decoding JSON file: {legacy_json_path}")
+
+    for segment in get_log_segments(path):
+        opener = gzip.open if segment.endswith('.gz') else open
+        with opener(segment, 'rt') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"skipping unreadable log line in {segment}")
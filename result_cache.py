@@ -0,0 +1,104 @@
+"""
+Semantic cache of retrieval results, per album
+
+A query whose embedding has cosine similarity >= threshold with a cached query of the same album
+returns the cached image names instead of another completion request. Entries are tagged with the album
+version (see descr_store.descriptions_version) and dropped once the album's descriptions change.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+#override with PHOTOFIND_RESULT_CACHE_THRESHOLD, 1.0 only matches the same query
+RESULT_CACHE_THRESHOLD = float(os.environ.get("PHOTOFIND_RESULT_CACHE_THRESHOLD", 0.95))
+RESULT_CACHE_MAX_ENTRIES = 256 #per album
+RESULT_CACHE_MAX_ALBUMS = 64
+
+
+class SemanticResultCache:
+    """
+    threshold(float): minimum cosine similarity between query embeddings for a hit
+    max_entries(int): cached queries per album, least recently used are evicted first
+    """
+    def __init__(self, threshold=RESULT_CACHE_THRESHOLD, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                 max_albums=RESULT_CACHE_MAX_ALBUMS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_albums = max_albums
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._albums = OrderedDict() #album key -> {'version', 'entries' : OrderedDict(query -> entry)}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype='float32').ravel()
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def _album(self, album_key, version):
+        #caller holds _lock
+        album = self._albums.get(album_key)
+        if album is None or album['version'] != version:
+            album = {'version' : version, 'entries' : OrderedDict()}
+            self._albums[album_key] = album
+        self._albums.move_to_end(album_key)
+        while len(self._albums) > self.max_albums:
+            self._albums.popitem(last=False)
+        return album
+
+    def lookup(self, album_key, version, query_embedding):
+        """
+        (image names, similarity, cached query) of the closest cached query above threshold, None on a miss
+        """
+        query = self._normalize(query_embedding)
+        with self._lock:
+            entries = self._album(album_key, version)['entries']
+            best = None
+            for cached_query, entry in entries.items():
+                if entry['embedding'].shape != query.shape:
+                    continue
+                similarity = float(entry['embedding'] @ query)
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (cached_query, similarity)
+
+            if best is None:
+                self.misses += 1
+                return None
+
+            entry = entries[best[0]]
+            entries.move_to_end(best[0])
+            self.hits += 1
+            self.saved_seconds += entry['latency']
+            return list(entry['results']), best[1], best[0]
+
+    def store(self, album_key, version, query, query_embedding, results, latency):
+        """
+        cache the image names returned for a query, latency(float) is what a later hit saves
+        """
+        with self._lock:
+            entries = self._album(album_key, version)['entries']
+            entries[query] = {'embedding' : self._normalize(query_embedding), 'results' : list(results),
+                              'latency' : latency}
+            entries.move_to_end(query)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, album_key):
+        with self._lock:
+            self._albums.pop(album_key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits' : self.hits, 'misses' : self.misses,
+                    'hit_rate' : round(self.hits / lookups, 3) if lookups else 0.0,
+                    'saved_seconds' : round(self.saved_seconds, 2), 'threshold' : self.threshold,
+                    'entries' : sum(len(album['entries']) for album in self._albums.values())}
+
+
+RESULT_CACHE = SemanticResultCache()
@@ -6,9 +6,16 @@ import re
 
 from openai import OpenAI
 
-from utils import (create_logging_entry, store_logging_entry,
+from utils import (create_logging_entry, store_logging_entry, embed_query_cached,
                    retrieve_contents_from_json, rank_and_filter_descriptions)
-from fb_db_utils import firebase_store_query_log
+from log_shipper import get_log_shipper
+from descr_store import descriptions_version
+from result_cache import RESULT_CACHE
+from search_session import SearchSession, DEFAULT_RANKING
+from vector_store import get_store_dir
+from embedding_backends import get_store_backend
+from candidate_packing import (PROMPT_TOKEN_BUDGET, MAX_CANDIDATES, pack_candidates, parse_alias_response,
+                               resolve_aliases)
 
 MAIN_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
@@ -38,6 +45,11 @@ def get_prompt(image_descriptions, option=1):
                 "The user will input a brief description that will match one or multiple of the provided full descriptions. You are to output the filename(s) whose descriptions best match the user given description."
                 "For example, if a user asks you for the file names of pictures that have animals in them, find and output all picture file names that contain a reference to an animal in their description."
                 "Provide your answer as a list of strings. Simply provide the desired output list, do not include additional explanation. If there are no valid answers, simply output 'None'.")
+    if option == 2: #numeric ids instead of filenames, see candidate_packing.py
+        return (f"You are an assistant for finding images based on the associated image descriptions given for each photo."
+                f"Here are image ids as keys and corresponding image descriptions as values in JSON format: {json.dumps(image_descriptions)}"
+                "The user will input a brief description that will match one or multiple of the provided full descriptions. You are to output the id(s) whose descriptions best match the user given description, best match first."
+                "Provide your answer as a list of id strings, for example [\"3\", \"12\"]. Simply provide the desired output list, do not include additional explanation. If there are no valid answers, simply output 'None'.")
 
 
 def handle_faulty_response_format(res):
@@ -90,33 +102,217 @@ def handle_faulty_response_format(res):
     return res_list
 
 
-def retrieve_and_return(image_descriptions_file, retrieval_prompt, api_key, filter=0.1, return_filter=False):
+def parse_filename_response(res):
+    """
+    list of filenames from a response to the filename keyed prompt
+    """
+    output_images = []
+    try:
+        output_images = ast.literal_eval(res)
+    except ValueError:
+        print("ValueError: The response is not a valid Python literal.")
+    except SyntaxError:
+        print("SyntaxError: The response string contains a syntax error.")
+
+        formatted_output = handle_faulty_response_format(res)
+
+        if type(formatted_output) == list: #TODO: needed?
+            output_images = []
+            for s in formatted_output:
+                if s.endswith((".png", ".jpg")):
+                    output_images.append(s)
+    return output_images
+
+
+class StreamingResponseParser:
+    """
+    Incremental parser for a streamed retrieval response.
+
+    feed() returns the image names completed by a chunk of text, finish() runs the full response through
+    the regular parsers and returns whatever the incremental pass missed.
+
+    aliases(dict): {alias : image name} for the numeric id prompt, None for the filename keyed prompt
+    candidates(iterable): image names that were sent, incremental matches outside of them are ignored
+    """
+    #a token only counts once the character after it has arrived, i.e. it can't grow any more.
+    #aliases only as elements of the requested list: ["3", "12"] or [3, 12], digits anywhere else are ignored
+    ALIAS_PATTERN = re.compile(r"[\[,]\s*([\"']?)(\d+)\1\s*(?=[,\]])")
+    FILENAME_PATTERN = re.compile(r"([^\s\"'`\[\],]+\.(?:png|jpg))(?=[\s\"'`\],])")
+
+    def __init__(self, aliases=None, candidates=()):
+        self.aliases = aliases
+        self.candidates = set(candidates)
+        self.text = ''
+        self.found = []
+        self._pos = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        pattern = self.ALIAS_PATTERN if self.aliases is not None else self.FILENAME_PATTERN
+        start = self._pos
+        if self.aliases is not None:
+            #nothing before the list opens can be an alias
+            list_start = self.text.find('[')
+            if list_start < 0:
+                return []
+            start = max(start, list_start)
+        new_names = []
+        for match in pattern.finditer(self.text, start):
+            self._pos = match.end()
+            if self.aliases is not None:
+                names = resolve_aliases([match.group(2)], self.aliases)
+            else:
+                names = [match.group(1)] if match.group(1) in self.candidates else []
+            for name in names:
+                if name not in self.found:
+                    self.found.append(name)
+                    new_names.append(name)
+        return new_names
+
+    def finish(self):
+        res = self.text.replace("'", "\"")
+        if self.aliases is not None:
+            #text around the list (counts, dates) is not parsed for aliases either
+            list_start, list_end = res.find('['), res.rfind(']')
+            if 0 <= list_start < list_end:
+                res = res[list_start:list_end + 1]
+            output_images = resolve_aliases(parse_alias_response(res), self.aliases)
+        else:
+            output_images = parse_filename_response(res)
+        if type(output_images) == str:
+            output_images = [output_images]
+        if not output_images:
+            return []
+
+        missed = [name for name in output_images if name not in self.found]
+        if missed:
+            print(f"stream parser: {len(missed)} results only found in the full response")
+        self.found.extend(missed)
+        return missed
+
+
+def _log_request(api_key, logging_entry):
+    #both writes are queued and persisted by background threads
+    get_log_shipper().submit(api_key[-5:], logging_entry)
+
+    #localy append to JSON-lines file
+    logging_file = os.path.join(DATA_DIRECTORY, api_key[-5:], 'logs.jsonl')
+    store_logging_entry(logging_file, logging_entry)
+
+
+def _prepare_request(image_descriptions_file, retrieval_prompt, api_key, filter, search_session, token_budget,
+                     ranking=DEFAULT_RANKING, use_cache=True):
+    """
+    shared setup of retrieve_and_return and retrieve_stream: ranking, result cache lookup and the prompt.
+
+    Returns a dict, request['cached'] is (output_images, similarity, cached_query) on a result cache hit,
+    in which case no prompt is built
+    """
+    request = {
+        't_start' : time.perf_counter(),
+        'api_key' : api_key,
+        'retrieval_prompt' : retrieval_prompt,
+        'album_version' : descriptions_version(image_descriptions_file),
+    }
+    if search_session is None and (filter is None or ranking != 'vector'):
+        #candidate packing needs the ranking with distances
+        search_session = SearchSession(api_key, retrieval_prompt,
+                                       get_store_dir(os.path.dirname(image_descriptions_file)), image_descriptions_file,
+                                       ranking=ranking)
+    if search_session is not None:
+        embedding_backend = search_session.embedding_backend
+        request['query_embedding'] = search_session.query_embedding
+        ranking = search_session.ranking
+    else:
+        embedding_backend = get_store_backend(get_store_dir(os.path.dirname(image_descriptions_file)), api_key)
+        request['query_embedding'] = embed_query_cached(embedding_backend, retrieval_prompt)
+    #query embeddings of different backends are not comparable, each one gets its own cache entries
+    request['album_key'] = (api_key[-5:], filter if filter is not None else token_budget,
+                            getattr(embedding_backend, 'model', None), ranking)
+
+    #lexical sessions have no query embedding to match cached queries by
+    use_cache = use_cache and request['query_embedding'] is not None
+    request['cached'] = RESULT_CACHE.lookup(request['album_key'], request['album_version'],
+                                            request['query_embedding']) if use_cache else None
+    if request['cached'] is not None:
+        return request
+
+    aliases = None
+    if filter is None:
+        #short numeric aliases in the prompt, mapped back to filenames after parsing
+        ranked_images = search_session.top_images(MAX_CANDIDATES)
+        aliases, prompt_descriptions = pack_candidates(ranked_images, search_session.distances[:len(ranked_images)],
+                                                       search_session.descriptions, token_budget)
+        image_descriptions = {aliases[alias] : descr for alias, descr in prompt_descriptions.items()}
+        prompt_option = 2
+    else:
+        if search_session is not None:
+            image_descriptions = search_session.filtered_descriptions(filter)
+        else:
+            image_descriptions = rank_and_filter_descriptions(api_key, retrieve_contents_from_json(image_descriptions_file),
+                                                              retrieval_prompt, filter=filter)
+        prompt_descriptions = image_descriptions
+        prompt_option = 1
+    print(f"filtered descriptions -> only sending {len(image_descriptions)} to api")
+
+    request['aliases'] = aliases
+    request['image_descriptions'] = image_descriptions
+    request['messages'] = [
+        {"role": "system", "content": get_prompt(prompt_descriptions, option=prompt_option)},
+        {"role": "user", "content": f"{retrieval_prompt}"},
+    ]
+    return request
+
+
+def _cached_response(request):
+    output_images, similarity, cached_query = request['cached']
+    retrieval_prompt = request['retrieval_prompt']
+    print(f"RESULT CACHE HIT: '{retrieval_prompt}' ~ '{cached_query}' ({round(similarity, 3)}), {RESULT_CACHE.stats()}")
+    logging_entry = create_logging_entry(retrieval_prompt, retrieval_prompt, output_images,
+                                         f"result cache hit: {cached_query} ({round(similarity, 3)})")
+    _log_request(request['api_key'], logging_entry)
+    return output_images
+
+
+def _finish_request(request, output_images, res_raw, store_result=True):
+    """
+    cache a non-empty result and log the request
+    """
+    retrieval_prompt = request['retrieval_prompt']
+    if output_images and store_result and request['query_embedding'] is not None:
+        RESULT_CACHE.store(request['album_key'], request['album_version'], retrieval_prompt, request['query_embedding'],
+                           output_images, latency=time.perf_counter() - request['t_start'])
+
+    logging_entry = create_logging_entry(retrieval_prompt, retrieval_prompt, output_images, str(res_raw))
+    _log_request(request['api_key'], logging_entry)
+
+
+def retrieve_and_return(image_descriptions_file, retrieval_prompt, api_key, filter=None, return_filter=False,
+                        search_session=None, token_budget=PROMPT_TOKEN_BUDGET, ranking=DEFAULT_RANKING):
     """
     Send OpenAI api request -- find the image description(s) the user is searching for.
 
-    filter(float): The fraction of top ranking descriptions to send to the model
+    filter(float): Send a fixed fraction of top ranking descriptions instead of token budgeted candidates
     return_filter(bool): Return the filtered descriptions that were sent -- Used for testing
-    """
-    client = OpenAI(api_key=api_key)
+    search_session(SearchSession): Reuse an existing ranking for this query instead of re-ranking
+    token_budget(int): tokens of candidate descriptions to send, see candidate_packing.py
+    ranking(str): candidate ranking when no search_session is given, see SearchSession
 
-    image_descriptions: dict = retrieve_contents_from_json(image_descriptions_file)
+    Near-identical earlier queries on an unchanged album are answered from the semantic result cache
+    """
+    request = _prepare_request(image_descriptions_file, retrieval_prompt, api_key, filter, search_session, token_budget,
+                               ranking, use_cache=not return_filter)
+    if request['cached'] is not None:
+        return _cached_response(request)
 
-    if filter is not None:
-        image_descriptions = rank_and_filter_descriptions(api_key, image_descriptions,
-                                                          retrieval_prompt, filter=filter)
-        print(f"filtered descriptions -> only sending {len(image_descriptions)} to api")
+    client = OpenAI(api_key=api_key)
 
     req_start_time = time.perf_counter()
     print('-----')
 
-    retrieval_prompt_orig = retrieval_prompt
-
     response = client.chat.completions.create(
         model=MODELS[4],
-        messages=[
-            {"role": "system", "content": get_prompt(image_descriptions, option=1)},
-            {"role": "user", "content": f"{retrieval_prompt}"},
-        ]
+        messages=request['messages']
     )
     res_raw = response.choices[0].message.content
     res = res_raw.replace("'", "\"")
@@ -124,36 +320,61 @@ def retrieve_and_return(image_descriptions_file, retrieval_prompt, api_key, filt
     req_stop_time = time.perf_counter()
     
     output_images = []
-    try:
-        output_images = ast.literal_eval(res)
-    except ValueError:
-        print("ValueError: The response is not a valid Python literal.")
-    except SyntaxError:
-        print("SyntaxError: The response string contains a syntax error.")
-
-        formatted_output = handle_faulty_response_format(res)
-
-        if type(formatted_output) == list: #TODO: needed?
-            output_images = []
-            for s in formatted_output:
-                if s.endswith((".png", ".jpg")):
-                    output_images.append(s)
+    if request['aliases'] is not None:
+        output_images = resolve_aliases(parse_alias_response(res), request['aliases'])
+    else:
+        output_images = parse_filename_response(res)
 
     print(f"RESPONSE RECEIVED in {round(req_stop_time - req_start_time, 2)}s")
 
     if type(output_images) == str:
         output_images = [output_images]
 
-    #store to logs
-    logging_entry = create_logging_entry(retrieval_prompt_orig, retrieval_prompt, output_images, str(res_raw))
-    firebase_store_query_log(api_key[-5:], logging_entry)
-
-    #localy append to JSON file
-    logging_file = os.path.join(DATA_DIRECTORY, api_key[-5:], 'logs.json')
-    store_logging_entry(logging_file, logging_entry)
+    _finish_request(request, output_images, res_raw, store_result=not return_filter)
 
     if return_filter:
-        return image_descriptions, output_images
+        return request['image_descriptions'], output_images
     else:
         return output_images
-    
\ No newline at end of file
+
+
+def retrieve_stream(image_descriptions_file, retrieval_prompt, api_key, filter=None, search_session=None,
+                    token_budget=PROMPT_TOKEN_BUDGET, ranking=DEFAULT_RANKING):
+    """
+    Streaming version of retrieve_and_return, a generator yielding image names as soon as the model outputs them.
+
+    Names are parsed from the streamed text as it arrives, when the stream ends the full response still goes
+    through the regular parsers and anything they find that was not yielded yet is yielded last.
+    The result is cached and logged once the stream is consumed.
+    """
+    request = _prepare_request(image_descriptions_file, retrieval_prompt, api_key, filter, search_session, token_budget,
+                               ranking)
+    if request['cached'] is not None:
+        yield from _cached_response(request)
+        return
+
+    client = OpenAI(api_key=api_key)
+    parser = StreamingResponseParser(request['aliases'], request['image_descriptions'])
+
+    req_start_time = time.perf_counter()
+    first_result_time = None
+    print('-----')
+
+    stream = client.chat.completions.create(
+        model=MODELS[4],
+        messages=request['messages'],
+        stream=True
+    )
+    for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        for name in parser.feed(chunk.choices[0].delta.content):
+            if first_result_time is None:
+                first_result_time = time.perf_counter()
+                print(f"FIRST RESULT in {round(first_result_time - req_start_time, 2)}s")
+            yield name
+
+    yield from parser.finish()
+    print(f"RESPONSE STREAMED in {round(time.perf_counter() - req_start_time, 2)}s")
+
+    _finish_request(request, parser.found, parser.text)
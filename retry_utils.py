@@ -0,0 +1,91 @@
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    exponential backoff with full jitter, attempt starts at 1
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+
+def retry_call(fn, *args, attempts=4, base_delay=1.0, max_delay=60.0, retry_on=(Exception,), **kwargs):
+    """
+    call fn(*args, **kwargs), retrying with exponential backoff on the given exceptions.
+    the last exception is re-raised once all attempts are used
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn(*args, **kwargs)
+        except retry_on as e:
+            if attempt == attempts:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"{getattr(fn, '__name__', 'call')} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def retry_after_seconds(response):
+    """
+    seconds to wait from a response's Retry-After header (delta-seconds or HTTP date), None if absent
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucketLimiter:
+    """
+    Client-side limiter for a requests-per-minute and tokens-per-minute budget, shared by worker threads.
+    acquire() blocks until both buckets can cover the request.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_rate = requests_per_minute / 60.0
+        self.token_rate = tokens_per_minute / 60.0
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+
+        #start with a small burst instead of a full minute of budget
+        self._requests = min(self.request_capacity, 1.0)
+        self._tokens = min(self.token_capacity, self.token_capacity / 10)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.request_capacity, self._requests + elapsed * self.request_rate)
+        self._tokens = min(self.token_capacity, self._tokens + elapsed * self.token_rate)
+
+    def acquire(self, tokens=0):
+        tokens = min(tokens, self.token_capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) / self.request_rate, (tokens - self._tokens) / self.token_rate, 0.01)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        drain the buckets after a 429 so every worker backs off, not just the one that was limited
+        """
+        with self._lock:
+            self._refill()
+            self._requests = min(self._requests, -seconds * self.request_rate)
@@ -0,0 +1,171 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import (INDEX_MANAGER, RANKING_MODES, HYBRID_FETCH_DEPTH, embed_query_cached, retrieve_contents_from_json,
+                   create_and_store_embeddings)
+from vector_store import ensure_vector_store
+from embedding_backends import get_store_backend
+from bm25_index import RRF_K, get_lexical_index, rrf_scores
+
+DEFAULT_PAGE_SIZE = 24
+#'vector', 'hybrid' or 'lexical', override with PHOTOFIND_RANKING
+DEFAULT_RANKING = os.environ.get("PHOTOFIND_RANKING", 'vector')
+#seconds to wait for the query embedding before ranking with the local BM25 index instead
+EMBEDDING_TIMEOUT = float(os.environ.get("PHOTOFIND_EMBEDDING_TIMEOUT", 10.0))
+
+#query embedding requests run here so a slow one can be abandoned, it finishes in the background
+_embedding_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='query-embedding')
+
+
+class SearchSession:
+    """
+    A single search over an album. The query is embedded once and ranked results are fetched
+    incrementally as top-k pages, the gallery pages and the LLM candidate set are both read from here.
+
+    images_ranked(list(str)): image names ranked so far, most relevant first
+    distances(list(float)): ascending sort key for each entry of images_ranked. L2 distance for 'vector',
+                            negated BM25 / fusion score for 'lexical' / 'hybrid'
+    page_size(int): images per gallery page, the first page is ranked up front
+    ranking(str): 'vector' (FAISS), 'lexical' (local BM25 index, no network) or 'hybrid' (reciprocal rank fusion).
+                  If the query embedding fails or takes longer than embedding_timeout, the session ranks
+                  lexically and fallback_reason says why
+    index_params(dict): index_type/nlist/nprobe/ef_search, see utils.query_and_filter
+    """
+    def __init__(self, api_key, query, embeddings_store_dir, descriptions_file, page_size=DEFAULT_PAGE_SIZE,
+                 ranking=DEFAULT_RANKING, rrf_k=RRF_K, embedding_timeout=EMBEDDING_TIMEOUT, **index_params):
+        if ranking not in RANKING_MODES:
+            assert False, f"ranking must be one of {RANKING_MODES}"
+        self.api_key = api_key
+        self.query = query
+        self.embeddings_store_dir = embeddings_store_dir
+        self.descriptions_file = descriptions_file
+        self.page_size = page_size
+        self.ranking = ranking
+        self.rrf_k = rrf_k
+        self.index_params = index_params
+        self.fallback_reason = None
+
+        self.descriptions = retrieve_contents_from_json(descriptions_file)
+
+        self.embedding_backend = None
+        self.query_embedding = None
+        if ranking != 'lexical':
+            try:
+                self._embed_query(embedding_timeout)
+            except Exception as e:
+                self.fallback_reason = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+                print(f"query embedding unavailable ({self.fallback_reason}), ranking with the lexical index")
+                self.ranking = 'lexical'
+
+        self._lexical_scores = None
+        self.images_ranked = []
+        self.distances = []
+        self._fetched_k = 0
+        self._exhausted = False
+        self._ensure_ranked(page_size)
+
+    def _embed_query(self, timeout):
+        """
+        embed the query, raises TimeoutError if the embedding takes longer than timeout.
+        An album without vectors gets them first, that one-time build is not timed
+        """
+        if not ensure_vector_store(self.embeddings_store_dir):
+            create_and_store_embeddings(get_store_backend(self.embeddings_store_dir, self.api_key),
+                                        self.embeddings_store_dir, self.descriptions)
+
+        #queries are embedded with the backend that built the album's vectors
+        self.embedding_backend = get_store_backend(self.embeddings_store_dir, self.api_key)
+        future = _embedding_executor.submit(embed_query_cached, self.embedding_backend, self.query)
+        self.query_embedding = future.result(timeout=timeout)
+
+    def lexical_scores(self):
+        """
+        {image_name : BM25 score} for the images sharing a word with the query, computed once
+        """
+        if self._lexical_scores is None:
+            scores, names = get_lexical_index(self.descriptions_file).search(self.query, k=0)
+            self._lexical_scores = {name : score for name, score in zip(names, scores) if name in self.descriptions}
+        return self._lexical_scores
+
+    def _rank_lexical(self):
+        """
+        whole album at once (BM25 is cheap): matches by score, then the rest in description order
+        """
+        scores = self.lexical_scores()
+        matched = sorted(scores, key=lambda img: -scores[img])
+        self.images_ranked = matched + [img for img in self.descriptions if img not in scores]
+        self.distances = [-scores[img] for img in matched] + [0.0] * (len(self.images_ranked) - len(matched))
+        self._exhausted = True
+
+    @property
+    def total_count(self):
+        """
+        number of images that can be ranked, known exactly once the ranking is exhausted
+        """
+        return len(self.images_ranked) if self._exhausted else len(self.descriptions)
+
+    def _ensure_ranked(self, count):
+        """
+        rank at least count images, fetch size doubles so paging through the album costs O(log n) searches
+        """
+        if self.ranking == 'lexical':
+            if not self._exhausted:
+                self._rank_lexical()
+            return
+
+        while len(self.images_ranked) < count and not self._exhausted:
+            fetch_k = min(max(count, 2 * self._fetched_k), len(self.descriptions))
+            if self.ranking == 'hybrid':
+                #deeper than the page so images ranked well by only the lexical side can still make it
+                fetch_k = min(max(fetch_k, HYBRID_FETCH_DEPTH), len(self.descriptions))
+            distances, images_ranked = INDEX_MANAGER.search(self.embeddings_store_dir, self.query_embedding,
+                                                            fetch_k, **self.index_params)
+            self._fetched_k = fetch_k
+            self._exhausted = len(images_ranked) < fetch_k or fetch_k >= len(self.descriptions)
+
+            #store rows without a description (e.g. deleted since) can't be shown or sent
+            self.images_ranked = []
+            self.distances = []
+            for dist, img in zip(distances, images_ranked):
+                if img in self.descriptions:
+                    self.images_ranked.append(img)
+                    self.distances.append(dist)
+
+            if self.ranking == 'hybrid':
+                lexical = self.lexical_scores()
+                scores = rrf_scores([self.images_ranked, sorted(lexical, key=lambda img: -lexical[img])], self.rrf_k)
+                self.images_ranked = sorted(scores, key=lambda img: -scores[img])
+                self.distances = [-scores[img] for img in self.images_ranked]
+
+    def top_images(self, k):
+        if k <= 0:
+            self._ensure_ranked(len(self.descriptions))
+            return list(self.images_ranked)
+        self._ensure_ranked(k)
+        return self.images_ranked[:k]
+
+    def ranked_page(self, page, page_size=None):
+        """
+        image names for one page (0-based) of the ranking, only ranks as far as that page
+        """
+        page_size = page_size or self.page_size
+        self._ensure_ranked((page + 1) * page_size)
+        return self.images_ranked[page * page_size : (page + 1) * page_size]
+
+    def num_pages(self, page_size=None):
+        page_size = page_size or self.page_size
+        return max(1, -(-self.total_count // page_size))
+
+    def filtered_descriptions(self, filter=1.0):
+        """
+        top fraction of ranked descriptions as a {image_name : description} dict, in ranked order.
+        same filter handling as utils.rank_and_filter_descriptions
+        """
+        if filter > 1.0 or filter <= 0.0:
+            filter = 1.0
+        if len(self.descriptions) * filter < 1:
+            filter = 1.0
+
+        k = int(len(self.descriptions) * filter)
+        self._ensure_ranked(k)
+        return {img : self.descriptions[img] for img in self.images_ranked[:k]}
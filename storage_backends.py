@@ -0,0 +1,337 @@
+"""
+Remote storage (images, descriptions) and query log backends
+
+firebase    - Firebase Storage bucket + Firestore, initialized on first use instead of at import
+local       - same interface on the local filesystem (LOCAL_BACKEND_DIR), for offline runs, CLIs and benchmarks
+
+PHOTOFIND_BACKEND selects one, when unset firebase is used if credentials are available and local otherwise.
+Only the parts of the bucket/blob and firestore client APIs this repo uses are implemented locally.
+"""
+
+import os
+import json
+import uuid
+import base64
+import shutil
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+FIREBASE_BUCKET_NAME = "image-finder-demo.appspot.com"
+KEYFILE_PATH = os.path.join(CURR_DIR, 'image-finder-demo-firebase-adminsdk-3kvua-934cc33dbb.json')
+LOCAL_BACKEND_DIR = os.environ.get("PHOTOFIND_LOCAL_BACKEND_DIR", os.path.join(CURR_DIR, 'data', '.local_backend'))
+
+BACKENDS = ('firebase', 'local')
+#firestore accepts the direction as a string, same value as firestore.Query.DESCENDING
+DESCENDING = 'DESCENDING'
+
+_backend = None
+_bucket = None
+_db = None
+_lock = threading.Lock()
+
+
+def firebase_credentials():
+    """
+    keyfile path or service account dict from FIREBASE_* variables, None when neither is available
+    """
+    if os.path.exists(KEYFILE_PATH):
+        return KEYFILE_PATH
+    if not os.environ.get("FIREBASE_PRIVATE_KEY"):
+        return None
+    return {
+        "type": os.environ.get("FIREBASE_TYPE"),
+        "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
+        "private_key_id": os.environ.get("FIREBASE_PRIVATE_KEY_ID"),
+        "private_key": os.environ.get("FIREBASE_PRIVATE_KEY").replace('\\n', '\n'),
+        "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
+        "client_id": os.environ.get("FIREBASE_CLIENT_ID"),
+        "auth_uri": os.environ.get("FIREBASE_AUTH_URI"),
+        "token_uri": os.environ.get("FIREBASE_TOKEN_URI"),
+        "auth_provider_x509_cert_url": os.environ.get("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
+        "client_x509_cert_url": os.environ.get("FIREBASE_CLIENT_X509_CERT_URL"),
+        "universe_domain": os.environ.get("FIREBASE_UNIVERSE_DOMAIN")
+    }
+
+
+def get_backend():
+    """
+    name of the active backend, resolved once per process
+    """
+    global _backend
+    with _lock:
+        if _backend is None:
+            backend = os.environ.get("PHOTOFIND_BACKEND", "").lower()
+            if backend not in BACKENDS:
+                backend = 'firebase' if firebase_credentials() is not None else 'local'
+                print(f"storage backend: {backend}")
+            _backend = backend
+        return _backend
+
+
+def _init_firebase():
+    #caller holds _lock
+    import firebase_admin
+    from firebase_admin import credentials
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        cred_input = firebase_credentials()
+        if cred_input is None:
+            assert False, "PHOTOFIND_BACKEND=firebase but no firebase credentials found"
+        print('initing app....')
+        firebase_admin.initialize_app(credentials.Certificate(cred_input), {'storageBucket': FIREBASE_BUCKET_NAME})
+        print('firebase initialized')
+
+
+def get_bucket():
+    """
+    process-wide storage bucket, created on first use
+    """
+    global _bucket
+    backend = get_backend()
+    with _lock:
+        if _bucket is None:
+            if backend == 'firebase':
+                _init_firebase()
+                from firebase_admin import storage
+                _bucket = storage.bucket(FIREBASE_BUCKET_NAME)
+            else:
+                _bucket = LocalBucket(os.path.join(LOCAL_BACKEND_DIR, 'storage'))
+        return _bucket
+
+
+def get_db():
+    """
+    process-wide firestore (or local document store) client, created on first use
+    """
+    global _db
+    backend = get_backend()
+    with _lock:
+        if _db is None:
+            if backend == 'firebase':
+                _init_firebase()
+                from firebase_admin import firestore
+                _db = firestore.client()
+            else:
+                _db = LocalDB(os.path.join(LOCAL_BACKEND_DIR, 'firestore'))
+        return _db
+
+
+def server_timestamp():
+    """
+    value for a document's server-side write time
+    """
+    if get_backend() == 'firebase':
+        from firebase_admin import firestore
+        return firestore.SERVER_TIMESTAMP
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ****** LOCAL STORAGE ******
+
+class LocalBlob:
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, *name.split('/'))
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else None
+
+    @property
+    def md5_hash(self):
+        if not os.path.exists(self.path):
+            return None
+        md5 = hashlib.md5()
+        with open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                md5.update(chunk)
+        return base64.b64encode(md5.digest()).decode('utf-8')
+
+    crc32c = None
+
+    @property
+    def generation(self):
+        return os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def upload_from_filename(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def download_as_bytes(self):
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def generate_signed_url(self, **kwargs):
+        return 'file://' + self.path
+
+
+class LocalBucket:
+    """
+    directory standing in for a storage bucket, blob names map to relative paths
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def blob(self, name):
+        return LocalBlob(self.root, name)
+
+    def list_blobs(self, prefix=''):
+        blobs = []
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith('.tmp'):
+                    continue
+                name = os.path.relpath(os.path.join(dir_path, file_name), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    blobs.append(LocalBlob(self.root, name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+
+# ****** LOCAL DOCUMENT STORE ******
+
+class LocalSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class LocalDocument:
+    """
+    document stored as <root>/<collection>/<doc>.json, subcollections under <root>/<collection>/<doc>/
+    """
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        self.id = path[-1]
+
+    @property
+    def file_path(self):
+        return os.path.join(self.root, *self.path) + '.json'
+
+    def collection(self, name):
+        return LocalCollection(self.root, self.path + [name])
+
+    def get(self):
+        try:
+            with open(self.file_path, 'r') as file:
+                return LocalSnapshot(self.id, json.load(file))
+        except FileNotFoundError:
+            return LocalSnapshot(self.id, None)
+
+    def set(self, data):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        tmp_path = f"{self.file_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file, default=str)
+        os.replace(tmp_path, self.file_path)
+
+    def update(self, fields):
+        data = self.get().to_dict() or {}
+        data.update(fields)
+        self.set(data)
+
+    def delete(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+
+class LocalQuery:
+    _ops = {
+        '==' : lambda a, b: a == b,
+        '>' : lambda a, b: a is not None and a > b,
+        '>=' : lambda a, b: a is not None and a >= b,
+        '<' : lambda a, b: a is not None and a < b,
+        '<=' : lambda a, b: a is not None and a <= b,
+    }
+
+    def __init__(self, collection, filters=(), order=None, limit_count=None):
+        self.collection = collection
+        self.filters = list(filters)
+        self.order = order
+        self.limit_count = limit_count
+
+    def where(self, field, op, value):
+        return LocalQuery(self.collection, self.filters + [(field, op, value)], self.order, self.limit_count)
+
+    def order_by(self, field, direction='ASCENDING'):
+        return LocalQuery(self.collection, self.filters, (field, direction), self.limit_count)
+
+    def limit(self, count):
+        return LocalQuery(self.collection, self.filters, self.order, count)
+
+    def stream(self):
+        docs = [doc for doc in self.collection._all_snapshots()
+                if all(self._ops[op](doc.to_dict().get(field), value) for field, op, value in self.filters)]
+        if self.order is not None:
+            field, direction = self.order
+            docs.sort(key=lambda doc: str(doc.to_dict().get(field, '')), reverse=direction == DESCENDING)
+        if self.limit_count is not None:
+            docs = docs[:self.limit_count]
+        return iter(docs)
+
+    def get(self):
+        return list(self.stream())
+
+
+class LocalCollection(LocalQuery):
+    def __init__(self, root, path):
+        super().__init__(self)
+        self.root = root
+        self.path = path
+
+    def document(self, doc_id=None):
+        return LocalDocument(self.root, self.path + [doc_id or uuid.uuid4().hex])
+
+    def _all_snapshots(self):
+        dir_path = os.path.join(self.root, *self.path)
+        if not os.path.isdir(dir_path):
+            return []
+        return [self.document(file_name[:-len('.json')]).get()
+                for file_name in sorted(os.listdir(dir_path)) if file_name.endswith('.json')]
+
+
+class LocalWriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, doc_ref, data):
+        self._writes.append((doc_ref, data))
+
+    def commit(self):
+        for doc_ref, data in self._writes:
+            doc_ref.set(data)
+        self._writes = []
+
+
+class LocalDB:
+    """
+    directory standing in for a firestore client
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def collection(self, name):
+        return LocalCollection(self.root, [name])
+
+    def batch(self):
+        return LocalWriteBatch()
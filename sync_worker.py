@@ -0,0 +1,117 @@
+"""
+In-process background sync of albums from firebase storage
+
+One long-lived worker thread takes sync jobs off a queue and shares the process' firebase client,
+instead of a fresh interpreter + firebase init per login. The streamlit script submits a job and
+polls its status on reruns: descriptions are fetched first, so search can start while images
+are still streaming into the album folder.
+"""
+
+import os
+import time
+import queue
+import threading
+
+from fb_storage_utils import download_descr_file, download_images
+
+#job states, in order
+SYNC_QUEUED = 'queued'
+SYNC_DESCRIPTIONS = 'descriptions'
+SYNC_IMAGES = 'images'
+SYNC_DONE = 'done'
+SYNC_FAILED = 'failed'
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class SyncService:
+    """
+    Job queue + worker thread for album syncs. Jobs are keyed by album, submitting an album that
+    is already queued or syncing returns the existing job.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._jobs = {} #album key -> status dict
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='album-sync', daemon=True)
+        self._thread.start()
+
+    def submit(self, album_key, descr_file, images_dir):
+        """
+        queue a sync of an album's descriptions and images, returns the job id (the album key)
+        """
+        with self._lock:
+            job = self._jobs.get(album_key)
+            if job is not None and job['state'] not in (SYNC_DONE, SYNC_FAILED):
+                return album_key
+
+            self._jobs[album_key] = {
+                'state' : SYNC_QUEUED,
+                'descriptions_ready' : False,
+                'done' : 0,
+                'total' : None,
+                'error' : None,
+                'report' : None,
+                'submitted' : time.time(),
+                'finished' : None,
+            }
+        self._queue.put((album_key, descr_file, images_dir))
+        return album_key
+
+    def status(self, job_id):
+        """
+        copy of a job's status dict, None for unknown jobs
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def is_active(self, job_id):
+        job = self.status(job_id)
+        return job is not None and job['state'] not in (SYNC_DONE, SYNC_FAILED)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _run(self):
+        while True:
+            job_id, descr_file, images_dir = self._queue.get()
+            try:
+                self._sync(job_id, descr_file, images_dir)
+            except Exception as e:
+                print(f"sync of {job_id} failed: {e}")
+                self._update(job_id, state=SYNC_FAILED, error=str(e), finished=time.time())
+            finally:
+                self._queue.task_done()
+
+    def _sync(self, job_id, descr_file, images_dir):
+        t_start = time.perf_counter()
+        if not os.path.exists(images_dir):
+            os.makedirs(images_dir)
+
+        self._update(job_id, state=SYNC_DESCRIPTIONS)
+        download_descr_file(descr_file)
+        self._update(job_id, state=SYNC_IMAGES, descriptions_ready=True)
+
+        def on_progress(done_count, total_count):
+            self._update(job_id, done=done_count, total=total_count)
+
+        report = download_images(os.path.basename(os.path.dirname(images_dir)), images_dir,
+                                 progress_callback=on_progress)
+        state = SYNC_FAILED if report['failed'] else SYNC_DONE
+        error = f"{len(report['failed'])} images failed to download" if report['failed'] else None
+        self._update(job_id, state=state, error=error, report=report, finished=time.time())
+        print(f"synced {job_id} in {round(time.perf_counter() - t_start, 2)}s")
+
+
+def get_sync_service():
+    """
+    process-wide sync service, started on first use
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = SyncService()
+        return _service
@@ -0,0 +1,157 @@
+"""
+upload_files_parallel / upload_images_from_list against the local fake bucket (storage_backends.LocalBucket)
+
+python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fb_storage_utils
+from fb_storage_utils import upload_files_parallel, upload_images_from_list, read_upload_manifest, UPLOAD_ATTEMPTS
+from storage_backends import LocalBucket, LocalBlob
+
+
+class FlakyBlob(LocalBlob):
+    def __init__(self, bucket, name):
+        super().__init__(bucket.root, name)
+        self.bucket = bucket
+
+    def upload_from_filename(self, filename):
+        with self.bucket.lock:
+            self.bucket.calls[self.name] = self.bucket.calls.get(self.name, 0) + 1
+            calls = self.bucket.calls[self.name]
+        if self.name in self.bucket.broken or calls <= self.bucket.fail_first:
+            raise ConnectionError(f"transient failure #{calls} for {self.name}")
+        super().upload_from_filename(filename)
+        with self.bucket.lock:
+            self.bucket.sent.append(self.name)
+
+
+class FlakyBucket(LocalBucket):
+    """
+    LocalBucket whose blobs fail their first fail_first uploads, blobs named in broken always fail
+    """
+    def __init__(self, root, fail_first=0, broken=()):
+        super().__init__(root)
+        self.fail_first = fail_first
+        self.broken = set(broken)
+        self.calls = {}
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FlakyBlob(self, name)
+
+
+class UploadFilesParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.album_dir = os.path.join(self.tmp_dir, 'album')
+        self.images_dir = os.path.join(self.album_dir, 'images')
+        os.makedirs(self.images_dir)
+        self.image_paths = []
+        for i in range(6):
+            path = os.path.join(self.images_dir, f"IMG{i}.jpg")
+            with open(path, 'wb') as file:
+                file.write(os.urandom(1000 * (i + 1)))
+            self.image_paths.append(path)
+        self.remote_names = [f"data/album/images/IMG{i}.jpg" for i in range(6)]
+
+        #backoff sleeps are recorded instead of slept
+        self.sleeps = []
+        patcher = mock.patch('retry_utils.time.sleep', side_effect=self.sleeps.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def bucket_root(self):
+        return os.path.join(self.tmp_dir, 'bucket')
+
+    def test_interrupted_upload_resumes_from_manifest(self):
+        broken = self.remote_names[4:]
+        first = upload_images_from_list(self.image_paths, bucket=FlakyBucket(self.bucket_root(), broken=broken),
+                                        max_workers=3)
+        self.assertEqual(first['uploaded'], 4)
+        self.assertEqual(sorted(first['failed']), self.image_paths[4:])
+        self.assertEqual(sorted(read_upload_manifest(self.album_dir)), self.remote_names[:4])
+
+        bucket = FlakyBucket(self.bucket_root())
+        second = upload_images_from_list(self.image_paths, bucket=bucket, max_workers=3)
+        self.assertEqual(second['skipped'], 4)
+        self.assertEqual(second['uploaded'], 2)
+        self.assertEqual(sorted(bucket.sent), broken)
+        self.assertEqual(sorted(read_upload_manifest(self.album_dir)), self.remote_names)
+
+        #a changed file is sent again, unchanged ones are not
+        with open(self.image_paths[0], 'ab') as file:
+            file.write(b'edited')
+        bucket = FlakyBucket(self.bucket_root())
+        third = upload_images_from_list(self.image_paths, bucket=bucket, max_workers=3)
+        self.assertEqual(bucket.sent, [self.remote_names[0]])
+        self.assertEqual(third['skipped'], 5)
+
+    def test_transient_errors_are_retried_with_backoff(self):
+        bucket = FlakyBucket(self.bucket_root(), fail_first=2)
+        report = upload_files_parallel(list(zip(self.image_paths, self.remote_names)), self.album_dir, bucket,
+                                       max_workers=2)
+
+        self.assertEqual(report['uploaded'], 6)
+        self.assertEqual(report['failed'], [])
+        self.assertEqual(set(bucket.calls.values()), {3})
+        for remote_name in self.remote_names:
+            self.assertTrue(bucket.blob(remote_name).exists())
+
+        #two backoff waits per file, full jitter under the 1s/2s exponential caps
+        self.assertEqual(len(self.sleeps), 2 * 6)
+        self.assertTrue(all(0 <= delay <= 2.0 for delay in self.sleeps))
+
+    def test_gives_up_after_upload_attempts(self):
+        bucket = FlakyBucket(self.bucket_root(), broken=self.remote_names[:1])
+        report = upload_files_parallel(list(zip(self.image_paths, self.remote_names))[:1], self.album_dir, bucket)
+
+        self.assertEqual(report['failed'], self.image_paths[:1])
+        self.assertEqual(bucket.calls[self.remote_names[0]], UPLOAD_ATTEMPTS)
+        self.assertEqual(read_upload_manifest(self.album_dir), {})
+
+    def test_report_counts_bytes_and_throughput(self):
+        sizes = [os.path.getsize(path) for path in self.image_paths]
+        upload_files_parallel(list(zip(self.image_paths, self.remote_names))[:2], self.album_dir,
+                              FlakyBucket(self.bucket_root()))
+
+        with mock.patch.object(fb_storage_utils.time, 'perf_counter', side_effect=[10.0, 12.0]):
+            report = upload_files_parallel(list(zip(self.image_paths, self.remote_names)), self.album_dir,
+                                           FlakyBucket(self.bucket_root()))
+
+        self.assertEqual(report['uploaded'], 4)
+        self.assertEqual(report['skipped'], 2)
+        self.assertEqual(report['bytes'], sum(sizes[2:]))
+        self.assertEqual(report['seconds'], 2.0)
+        self.assertEqual(report['mb_per_s'], round(sum(sizes[2:]) / 1024**2 / 2.0, 2))
+
+    def test_progress_callback_counts_uploads(self):
+        progress = []
+        upload_images_from_list(self.image_paths, bucket=FlakyBucket(self.bucket_root()),
+                                progress_callback=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress, [(i, 6) for i in range(1, 7)])
+
+    def test_progress_reaches_total_when_uploads_fail(self):
+        progress = []
+        report = upload_images_from_list(self.image_paths, bucket=FlakyBucket(self.bucket_root(), broken=self.remote_names[:2]),
+                                         progress_callback=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress, [(i, 6) for i in range(1, 7)])
+        self.assertEqual(report['uploaded'], 4)
+        self.assertEqual(sorted(report['failed']), self.image_paths[:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+AlbumIndexManager incremental updates against a real vector store, results must match a fresh build
+
+python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_manager import AlbumIndexManager
+from vector_store import append_vectors, load_vectors, manifest_path, read_manifest
+
+
+def new_manager():
+    return AlbumIndexManager(loader=load_vectors, version_file=manifest_path, store_settings=read_manifest)
+
+
+class IncrementalIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+        self.names = [f"IMG{i}.jpg" for i in range(40)]
+        self.manager = new_manager()
+        append_vectors(self.store_dir, self.names, self.rng.random((40, 16)), create_new=True)
+        self.manager.search(self.store_dir, self.rng.random(16), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def assertMatchesFreshBuild(self, queries, k=5):
+        fresh = new_manager()
+        for query in queries:
+            self.assertEqual(self.manager.search(self.store_dir, query, k)[1], fresh.search(self.store_dir, query, k)[1])
+
+    def test_appended_rows_are_added_to_cached_index(self):
+        cached_index = self.manager.get_index(self.store_dir)['index']
+        new_rows = self.rng.random((5, 16))
+        append_vectors(self.store_dir, self.names[:2] + ['NEW0.jpg', 'NEW1.jpg', 'NEW2.jpg'], new_rows)
+        self.manager.bump_version(self.store_dir)
+
+        entry = self.manager.get_index(self.store_dir)
+        self.assertEqual(entry['index'].ntotal, cached_index.ntotal + 5)
+        self.assertEqual(entry['dead_rows'], 2)
+        self.assertEqual(entry['trained_rows'], 40)
+        self.assertEqual(self.manager.search(self.store_dir, new_rows[2], 1)[1], ['NEW0.jpg'])
+        self.assertEqual(self.manager.search(self.store_dir, new_rows[0], 1)[1], ['IMG0.jpg'])
+        self.assertMatchesFreshBuild(new_rows)
+
+    def test_rewritten_rows_rebuild_the_index(self):
+        new_rows = self.rng.random((40, 16))
+        append_vectors(self.store_dir, self.names, new_rows, create_new=True)
+        #version bump only, the store generation alone has to force the rebuild
+        self.manager.bump_version(self.store_dir)
+
+        self.assertEqual(self.manager.search(self.store_dir, new_rows[3], 1)[1], ['IMG3.jpg'])
+        self.assertEqual(self.manager.get_index(self.store_dir)['generation'], read_manifest(self.store_dir)['generation'])
+        self.assertMatchesFreshBuild(new_rows)
+
+    def test_rewritten_rows_with_new_dim(self):
+        new_rows = self.rng.random((40, 8))
+        append_vectors(self.store_dir, self.names, new_rows, create_new=True)
+        self.manager.invalidate(self.store_dir)
+
+        self.assertEqual(self.manager.get_index(self.store_dir)['index'].d, 8)
+        self.assertEqual(self.manager.search(self.store_dir, new_rows[3], 1)[1], ['IMG3.jpg'])
+        self.assertMatchesFreshBuild(new_rows)
+
+    def test_invalidate_drops_cached_entry(self):
+        self.manager.invalidate(self.store_dir)
+        self.assertEqual(self.manager.stats()['albums'], 0)
+        self.assertEqual(self.manager.stats()['bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
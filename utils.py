@@ -1,14 +1,23 @@
 import os
 import json
 import pickle
-import faiss
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from PIL import Image
 from openai import OpenAI
-from langchain_community.embeddings import OpenAIEmbeddings
+
+from index_manager import AlbumIndexManager
+from vector_store import (append_vectors, ensure_vector_store, get_store_dir, load_vectors, manifest_path,
+                          read_manifest)
+from retry_utils import retry_call
+from descr_store import load_descriptions
+from bm25_index import RRF_K, get_lexical_index, reciprocal_rank_fusion
+from embedding_backends import get_store_backend
+from log_sink import get_log_writer
 
 MAIN_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
@@ -20,6 +29,17 @@ _10_MB = 10*1024*1024
 _5_MB = 5*1024*1024
 _3_MB = 3*1024*1024
 
+QUERY_EMBEDDING_CACHE_SIZE = 256
+
+#embedding requests: inputs per request, rough per-request size cap (~4 chars per token), requests in flight
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_MAX_CHARS = 400_000
+EMBEDDING_MAX_WORKERS = 4
+
+RANKING_MODES = ('vector', 'hybrid', 'lexical')
+#candidates taken from each ranking before fusing them in hybrid ranking
+HYBRID_FETCH_DEPTH = 100
+
 
 def validate_openai_api_key(openai_api_key):
     validate = False
@@ -61,6 +81,13 @@ def validate_openai_api_key(openai_api_key):
 
 def retrieve_contents_from_json(json_file_path):
     #return list of dicts(keys = filename, value = descr)
+    if os.path.basename(json_file_path) == DESCR_FILENAME:
+        #descriptions are served from the append-only store (snapshot + log)
+        descriptions = load_descriptions(json_file_path)
+        if descriptions is None:
+            print(f"File not found: {json_file_path}")
+        return descriptions
+
     try:
         with open(json_file_path, 'r') as file:
             data = json.load(file)
@@ -263,57 +290,139 @@ def remove_description_pretense(description):
 
 # ****** EMBEDDINGS UTILS ******
 
-def add_new_descr_to_embedding_pickle(embeddings_obj, pickle_file, descriptions, create_new=False):
-    #one or multiple descr
-    #NOTE: np array additions must have same amount of columns(1536)
-    if not create_new:
-        with open(pickle_file, 'rb') as file:
-            existing_embeddings = pickle.load(file)
-    else:
-        existing_embeddings = []
+def get_embeddings_store_dir(images_dir):
+    """
+    album embeddings live next to the images folder, see vector_store.py for the format
+    """
+    return get_store_dir(os.path.dirname(images_dir))
 
+
+def add_new_descr_to_embedding_store(embeddings_obj, store_dir, file_names, descriptions, create_new=False,
+                                     progress_callback=None):
+    """
+    embed one or multiple descriptions and append them to the album vector store
+
+    file_names(list(str)): image name for each description, ties each row to its image
+    progress_callback(callable): see embed_descriptions_batched
+    """
     if type(descriptions) == str:
         descriptions = [descriptions]
+    if type(file_names) == str:
+        file_names = [file_names]
+    if not descriptions:
+        return
 
-    new_rows = []
-    for descr in descriptions:
-        new_row = create_single_embedding(embeddings_obj, descr)
-        new_rows.append(new_row)
-
-    new_rows = np.array(new_rows).astype('float32')
+    new_rows = embed_descriptions_batched(embeddings_obj, descriptions, progress_callback=progress_callback)
+    append_vectors(store_dir, list(file_names), new_rows, create_new=create_new, embedding=embeddings_obj.signature())
     if create_new:
-        new_embeddings = new_rows
+        INDEX_MANAGER.invalidate(store_dir)
     else:
-        new_embeddings = np.vstack((existing_embeddings, new_rows))
-
-    with open(pickle_file, 'wb') as file:
-        pickle.dump(new_embeddings, file)
+        INDEX_MANAGER.bump_version(store_dir)
 
 
 def create_single_embedding(embeddings_obj, description):
     return embeddings_obj.embed_query(description)
 
 
-def create_and_store_embeddings_to_pickle(embeddings_obj, pickle_file, descriptions):
+def make_embedding_batches(descriptions, batch_size=EMBEDDING_BATCH_SIZE, max_chars=EMBEDDING_BATCH_MAX_CHARS):
+    """
+    split descriptions into consecutive batches under the provider's per-request input limits.
+    returns list of (start_row, list(str))
     """
-    embeddings list(np.array(np.array)) - list of descriptions that are converted to embeddings np.arrays
+    batches = []
+    batch = []
+    batch_start = 0
+    batch_chars = 0
+    for i, descr in enumerate(descriptions):
+        if batch and (len(batch) >= batch_size or batch_chars + len(descr) > max_chars):
+            batches.append((batch_start, batch))
+            batch = []
+            batch_start = i
+            batch_chars = 0
+        batch.append(descr)
+        batch_chars += len(descr)
+    if batch:
+        batches.append((batch_start, batch))
+    return batches
+
+
+def embed_descriptions_batched(embeddings_obj, descriptions, max_workers=EMBEDDING_MAX_WORKERS,
+                               progress_callback=None):
     """
-    embeddings_list = []
-    for descr in descriptions:
-        embeddings_list.append(embeddings_obj.embed_query(descr))
+    embed descriptions in batches with several requests in flight, failed batches are retried.
+    rows come back in the same order as descriptions.
 
-    embeddings_list = np.array(embeddings_list).astype('float32')
+    progress_callback(callable): called with (embedded_count, total_count) as batches finish
+    """
+    rows = [None] * len(descriptions)
+    batches = make_embedding_batches(descriptions)
+    done_count = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(retry_call, embeddings_obj.embed_documents, batch) : (start, batch)
+                   for start, batch in batches}
+
+        for future in as_completed(futures):
+            start, batch = futures[future]
+            batch_rows = future.result()
+            rows[start:start + len(batch)] = batch_rows
+
+            done_count += len(batch)
+            if progress_callback is not None:
+                progress_callback(done_count, len(descriptions))
 
-    with open(pickle_file, 'wb') as file:
-        pickle.dump(embeddings_list, file)
+    return np.array(rows).astype('float32')
+
+
+def create_and_store_embeddings(embeddings_obj, store_dir, descriptions_dict, progress_callback=None):
+    """
+    (re)create the album vector store from a {image_name : description} dict
+    """
+    add_new_descr_to_embedding_store(embeddings_obj, store_dir, list(descriptions_dict.keys()),
+                                     list(descriptions_dict.values()), create_new=True,
+                                     progress_callback=progress_callback)
 
 
 def get_embeddings_from_pickle_file(pickle_file):
+    #legacy embeddings.pkl, see vector_store.migrate_pickle_to_vector_store
     with open(pickle_file, 'rb') as file:
         embeddings_list = pickle.load(file)
     return embeddings_list
 
 
+#process-wide, albums keep their built index between searches
+INDEX_MANAGER = AlbumIndexManager(loader=load_vectors, version_file=manifest_path, store_settings=read_manifest)
+
+_query_embedding_cache = OrderedDict() #(model, normalized query) -> embedding
+_query_embedding_lock = threading.Lock()
+
+
+def normalize_query_text(query):
+    return ' '.join(query.lower().split())
+
+
+def embed_query_cached(embeddings_obj, query):
+    """
+    embed_query with a bounded LRU cache keyed by embedding model and normalized query text
+    """
+    model = getattr(embeddings_obj, 'model', type(embeddings_obj).__name__)
+    key = (model, normalize_query_text(query))
+
+    with _query_embedding_lock:
+        if key in _query_embedding_cache:
+            _query_embedding_cache.move_to_end(key)
+            return _query_embedding_cache[key]
+
+    query_embedding = embeddings_obj.embed_query(query)
+
+    with _query_embedding_lock:
+        _query_embedding_cache[key] = query_embedding
+        while len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embedding_cache.popitem(last=False)
+
+    return query_embedding
+
+
 def rank_and_filter_descriptions(api_key, descriptions_dict, prompt, filter=1.0):
     """
     helper function for retrieve_and_return. get descriptions dictionary from descriptions json file.
@@ -323,81 +432,99 @@ def rank_and_filter_descriptions(api_key, descriptions_dict, prompt, filter=1.0)
     if len(descriptions_dict) * filter < 1:
         filter = 1.0
 
-    pickle_file = os.path.join(DATA_DIRECTORY, api_key[-5:], "embeddings.pkl")
-    print(pickle_file)
+    store_dir = get_store_dir(os.path.join(DATA_DIRECTORY, api_key[-5:]))
+    print(store_dir)
 
-    if not os.path.exists(pickle_file):
-        assert False, "rank_and_filter_descriptions: no pickle file "
+    if not ensure_vector_store(store_dir):
+        assert False, "rank_and_filter_descriptions: no embeddings store "
     
     #embeddings search -> return top percentage of ranked descriptions based on filter value
-    filtered_images = query_and_filter(api_key, pickle_file, descriptions_dict, prompt, filter)[0]
+    filtered_images = query_and_filter(api_key, store_dir, descriptions_dict, prompt, filter)[0]
 
     filtered_descr_dict = dict()
     for img in list(filtered_images):
-        filtered_descr_dict[img] = descriptions_dict[img]
+        if img in descriptions_dict:
+            filtered_descr_dict[img] = descriptions_dict[img]
     
     return filtered_descr_dict
     #TODO: still need to return iin ranked form -> cant use dictionary
 
 
-def query_and_filter(api_key, embeddings_pickle_file, descriptions_dict, query, filter):
-    file_names = list(descriptions_dict.keys())
+def query_and_filter(api_key, embeddings_store_dir, descriptions_dict, query, filter, index_type='auto',
+                     nlist=None, nprobe=None, ef_search=None):
+    """
+    index_type(str): 'auto' picks by album size, or one of index_manager.INDEX_TYPES
+    nlist, nprobe(int): IVF lists built / visited per query
+    ef_search(int): HNSW search breadth
+    """
     descriptions = list(descriptions_dict.values())
-    embeddings_obj = OpenAIEmbeddings(api_key=api_key)
+    embeddings_obj = get_store_backend(embeddings_store_dir, api_key)
 
     k = int(len(descriptions) * filter)
 
-    embeddings_list = get_embeddings_from_pickle_file(embeddings_pickle_file)
+    query_embedding = embed_query_cached(embeddings_obj, query)
+    distances, images_ranked = INDEX_MANAGER.search(embeddings_store_dir, query_embedding, k, index_type=index_type,
+                                                    nlist=nlist, nprobe=nprobe, ef_search=ef_search)
 
-    index = faiss.IndexFlatL2(1536)
-    index.add(embeddings_list)
+    return np.array([images_ranked])
 
-    query_embedding = embeddings_obj.embed_query(query)
-    query_embedding = np.array([query_embedding]).astype('float32')
-
-    distances, indices = index.search(query_embedding, k)
 
-    images_ranked = np.array(file_names)[indices]
+def lexical_ranking(descriptions_file, descriptions_dict, query, k):
+    """
+    BM25 ranking from the album's local lexical index, no network. Images sharing no word with the query
+    follow the matches (in description order) so that k results are returned when the album has them
+    """
+    _, images_ranked = get_lexical_index(descriptions_file).search(query, k)
+    if k == 0 or len(images_ranked) < k:
+        matched = set(images_ranked)
+        rest = [img for img in descriptions_dict if img not in matched]
+        images_ranked = images_ranked + rest[:k - len(images_ranked) if k else len(rest)]
+    return images_ranked
 
-    #search_ouput = np.array(descriptions)[indices]
-    #print(search_ouput)
-    #print(images_ranked)
 
-    return images_ranked
+def query_for_related_descriptions(api_key, query, embeddings_store_dir, images_dir, k=10, index_type='auto',
+                                   nlist=None, nprobe=None, ef_search=None, ranking='vector', rrf_k=RRF_K):
+    """
+    rank album images for a query, k=0 ranks the whole album. index params as in query_and_filter
 
+    ranking(str): 'vector' (FAISS), 'lexical' (local BM25 only, no embedding request) or 'hybrid'
+                  (reciprocal rank fusion of both, falls back to lexical if the embedding request fails)
+    rrf_k(int): rank constant for the fusion, see bm25_index.reciprocal_rank_fusion
+    """
+    if ranking not in RANKING_MODES:
+        assert False, f"ranking must be one of {RANKING_MODES}"
 
-def query_for_related_descriptions(api_key, query, embeddings_pickle_file, images_dir, k=10):
     json_descr_filepath = get_descr_filepath(images_dir)
     json_dict = retrieve_contents_from_json(json_descr_filepath)
-    
-    file_names = list(json_dict.keys())
-    descriptions = list(json_dict.values())
-
-    embeddings_obj = OpenAIEmbeddings(api_key=api_key)
-
-    if not os.path.exists(embeddings_pickle_file):
-        add_new_descr_to_embedding_pickle(embeddings_obj, embeddings_pickle_file, descriptions, create_new=True)
 
     if k == 0:
-        k = len(file_names)
-
-    embeddings_list = get_embeddings_from_pickle_file(embeddings_pickle_file)
+        k = len(json_dict)
 
-    index = faiss.IndexFlatL2(1536)
-    index.add(embeddings_list)
+    if ranking == 'lexical':
+        return np.array([lexical_ranking(json_descr_filepath, json_dict, query, k)])
 
-    query_embedding = embeddings_obj.embed_query(query)
-    query_embedding = np.array([query_embedding]).astype('float32')
-
-    distances, indices = index.search(query_embedding, k)
-
-    images_ranked = np.array(file_names)[indices]
+    #both rankings go deeper than k so images ranked well by only one of them can still make the fused top k
+    fetch_k = k if ranking == 'vector' else min(len(json_dict), max(k, HYBRID_FETCH_DEPTH))
+    try:
+        if not ensure_vector_store(embeddings_store_dir):
+            create_and_store_embeddings(get_store_backend(embeddings_store_dir, api_key), embeddings_store_dir, json_dict)
+
+        embeddings_obj = get_store_backend(embeddings_store_dir, api_key)
+        query_embedding = embed_query_cached(embeddings_obj, query)
+        distances, images_ranked = INDEX_MANAGER.search(embeddings_store_dir, query_embedding, fetch_k,
+                                                        index_type=index_type, nlist=nlist, nprobe=nprobe,
+                                                        ef_search=ef_search)
+    except Exception as e:
+        if ranking == 'vector':
+            raise
+        print(f"embedding search failed ({e}), using lexical ranking only")
+        return np.array([lexical_ranking(json_descr_filepath, json_dict, query, k)])
 
-    #search_ouput = np.array(descriptions)[indices] NOTE: for looking at ranking results
-    #print(search_ouput)
-    #print(images_ranked)
+    if ranking == 'hybrid':
+        lexical_ranked = lexical_ranking(json_descr_filepath, json_dict, query, fetch_k)
+        images_ranked = reciprocal_rank_fusion([list(images_ranked), lexical_ranked], k=rrf_k, limit=k)
 
-    return images_ranked
+    return np.array([images_ranked])
 
 
 # ****** LOGGING UTILS ******
@@ -416,23 +543,6 @@ def create_logging_entry(input, rephrased_input, output, raw_output):
 
 def store_logging_entry(logging_file, entry):
     """
-    save a new single entry to a json logging file
+    save a new single entry to a JSON-lines logging file, written in the background (see log_sink.py)
     """
-    if not os.path.exists(os.path.dirname(logging_file)):
-        os.mkdir(os.path.dirname(logging_file))
-
-    try:
-        with open(logging_file, 'r') as file:
-            if os.path.getsize(logging_file) != 0:
-              existing_data = json.load(file)
-            else:
-                existing_data = []
-    except FileNotFoundError:
-        existing_data = []
-        print('logging store: error getting existing')
-
-    existing_data.append(entry)
-
-    #write the combined data back to the file
-    with open(logging_file, 'w') as file:
-        json.dump(existing_data, file, indent=2)
+    get_log_writer(logging_file).write(entry)
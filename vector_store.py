@@ -0,0 +1,333 @@
+"""
+On-disk embeddings store for an album, replaces embeddings.pkl
+
+vectors/
+    manifest.json           - {"version", "generation", "dim", "dtype", "embedding", "segments": [{"file", "ids", "rows"}]}
+    seg_000001.npy          - raw float32 rows, loaded with np.load(mmap_mode='r')
+    seg_000001.ids.json     - image file names for each row of the segment
+
+Appends only write a new segment + its ids file, then atomically swap in the manifest.
+Rows are tied to file names explicitly, if a name is appended again the newest row wins.
+"embedding" is the {"backend", "model", "dim"} that produced the rows (see embedding_backends.py),
+rows from another backend are refused. "generation" is bumped whenever existing rows are rewritten
+(create_new, convert), plain appends keep it so cached indexes know they can just add the new rows.
+
+Compact albums (dtype float16 or int8) store L2-normalized rows and are searched by inner
+product (cosine), int8 rows are scalar-quantized as round(v * 127).
+"""
+
+import os
+import sys
+import json
+import pickle
+
+import numpy as np
+
+MANIFEST_FILENAME = 'manifest.json'
+STORE_DIRNAME = 'vectors'
+LEGACY_PICKLE_FILENAME = 'embeddings.pkl'
+DESCR_FILENAME = 'descriptions.json'
+
+#merge segments once an album has accumulated this many appends
+MAX_SEGMENTS = 16
+
+VECTOR_DTYPES = ['float32', 'float16', 'int8']
+INT8_SCALE = 127.0
+
+#storage for new albums, override with PHOTOFIND_VECTOR_DTYPE
+DEFAULT_DTYPE = os.environ.get("PHOTOFIND_VECTOR_DTYPE", 'float32')
+
+
+def get_store_dir(album_dir):
+    return os.path.join(album_dir, STORE_DIRNAME)
+
+
+def manifest_path(store_dir):
+    return os.path.join(store_dir, MANIFEST_FILENAME)
+
+
+def read_manifest(store_dir):
+    try:
+        with open(manifest_path(store_dir), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def default_metric(dtype):
+    return 'l2' if dtype == 'float32' else 'ip'
+
+
+def encode_rows(rows, dtype, metric):
+    """
+    float32 rows -> storage rows for an album dtype/metric
+    """
+    rows = np.asarray(rows, dtype='float32')
+    if metric == 'ip':
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        rows = rows / norms
+
+    if dtype == 'int8':
+        return np.clip(np.round(rows * INT8_SCALE), -127, 127).astype('int8')
+    return np.ascontiguousarray(rows, dtype=dtype)
+
+
+def decode_rows(rows):
+    """
+    storage rows -> float32, float32 stores are passed through untouched (stay memory-mapped)
+    """
+    if rows.dtype == np.int8:
+        return rows.astype('float32') / INT8_SCALE
+    if rows.dtype != np.float32:
+        return rows.astype('float32')
+    return rows
+
+
+def _atomic_write_json(file_path, data):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def _write_segment(store_dir, seg_num, names, rows):
+    seg_file = f"seg_{seg_num:06d}.npy"
+    ids_file = f"seg_{seg_num:06d}.ids.json"
+
+    tmp_path = os.path.join(store_dir, seg_file + '.tmp')
+    with open(tmp_path, 'wb') as file:
+        np.save(file, rows)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, os.path.join(store_dir, seg_file))
+    _atomic_write_json(os.path.join(store_dir, ids_file), list(names))
+
+    return {'file' : seg_file, 'ids' : ids_file, 'rows' : len(names), 'num' : seg_num}
+
+
+def append_vectors(store_dir, names, rows, create_new=False, embedding=None):
+    """
+    add rows for the given image names, only the new rows are written to disk
+
+    names(list(str)): image file name for each row
+    rows(np.array): float32, shape (len(names), dim), encoded to the album's storage dtype here
+    create_new(bool): drop any existing segments first, the album keeps its dtype/metric
+    embedding(dict): {"backend", "model", "dim"} of the rows, recorded on create and checked on append
+    """
+    rows = np.ascontiguousarray(rows, dtype='float32')
+    if rows.ndim == 1:
+        rows = rows.reshape(1, -1)
+    if len(names) != rows.shape[0]:
+        raise ValueError(f"append_vectors: {len(names)} names for {rows.shape[0]} rows")
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    old_manifest = read_manifest(store_dir)
+    if create_new or old_manifest is None:
+        dtype = old_manifest.get('dtype', 'float32') if old_manifest else DEFAULT_DTYPE
+        metric = old_manifest.get('metric', 'l2') if old_manifest else default_metric(dtype)
+        manifest = {'version' : old_manifest['version'] if old_manifest else 0,
+                    'generation' : old_manifest.get('generation', 0) + 1 if old_manifest else 0,
+                    'dim' : rows.shape[1], 'dtype' : dtype, 'metric' : metric, 'segments' : []}
+        if embedding is not None:
+            manifest['embedding'] = dict(embedding)
+        stale_segments = old_manifest['segments'] if old_manifest else []
+    else:
+        manifest = old_manifest
+        stale_segments = []
+
+    if manifest['dim'] != rows.shape[1]:
+        raise ValueError(f"append_vectors: store dim is {manifest['dim']}, got rows of dim {rows.shape[1]}")
+    if embedding is not None:
+        recorded = manifest.get('embedding')
+        if recorded is None:
+            #store from before embeddings were recorded, dims already match
+            manifest['embedding'] = dict(embedding)
+        elif (recorded['backend'], recorded['model']) != (embedding['backend'], embedding['model']):
+            raise ValueError(f"append_vectors: store holds {recorded['backend']}/{recorded['model']} vectors, "
+                             f"got {embedding['backend']}/{embedding['model']}")
+
+    if len(names) > 0:
+        #never reuse a segment number, stale files are only removed after the manifest swap
+        seg_num = max([s['num'] for s in manifest['segments'] + stale_segments], default=0) + 1
+        stored_rows = encode_rows(rows, manifest['dtype'], manifest.get('metric', 'l2'))
+        manifest['segments'].append(_write_segment(store_dir, seg_num, names, stored_rows))
+
+    manifest['version'] += 1
+    _atomic_write_json(manifest_path(store_dir), manifest)
+    _remove_segment_files(store_dir, stale_segments)
+
+    if len(manifest['segments']) > MAX_SEGMENTS:
+        compact_vector_store(store_dir)
+
+
+def load_vectors(store_dir, mmap=True, decode=True):
+    """
+    returns (row_names, vectors)
+
+    row_names(list(str|None)): image name for each row, None for rows that were superseded
+    vectors(np.array): float32 (n, dim), zero-copy memmap when the store is a single float32 segment
+    decode(bool): False returns rows in the album's storage dtype
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"no vector store at {store_dir}")
+
+    mmap_mode = 'r' if mmap else None
+    row_names = []
+    segments = []
+    for seg in manifest['segments']:
+        with open(os.path.join(store_dir, seg['ids']), 'r') as file:
+            row_names.extend(json.load(file))
+        segments.append(np.load(os.path.join(store_dir, seg['file']), mmap_mode=mmap_mode))
+
+    if not segments:
+        vectors = np.zeros((0, manifest['dim']), dtype=manifest.get('dtype', 'float32'))
+    elif len(segments) == 1:
+        vectors = segments[0]
+    else:
+        vectors = np.concatenate(segments)
+
+    if decode:
+        vectors = decode_rows(vectors)
+
+    #newest row for a name wins
+    latest_row = {name : i for i, name in enumerate(row_names)}
+    row_names = [name if latest_row[name] == i else None for i, name in enumerate(row_names)]
+
+    return row_names, vectors
+
+
+def get_name_to_row_map(store_dir):
+    row_names, _ = load_vectors(store_dir)
+    return {name : i for i, name in enumerate(row_names) if name is not None}
+
+
+def compact_vector_store(store_dir):
+    """
+    merge all segments into one and drop superseded rows
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None or not manifest['segments']:
+        return
+
+    row_names, vectors = load_vectors(store_dir, mmap=False, decode=False)
+    keep = [i for i, name in enumerate(row_names) if name is not None]
+    names = [row_names[i] for i in keep]
+    rows = np.ascontiguousarray(vectors[keep])
+
+    old_segments = manifest['segments']
+    seg_num = max(s['num'] for s in old_segments) + 1
+    manifest['segments'] = [_write_segment(store_dir, seg_num, names, rows)]
+    manifest['version'] += 1
+    _atomic_write_json(manifest_path(store_dir), manifest)
+    _remove_segment_files(store_dir, old_segments)
+    print(f"compacted {len(old_segments)} segments into 1 ({len(names)} rows)")
+
+
+def convert_vector_store(store_dir, dtype):
+    """
+    rewrite an album store in another storage dtype (compacting it on the way).
+    float16/int8 rows are L2-normalized and searched by inner product.
+
+    returns (reference_vectors, converted_vectors) as float32 for comparing rankings
+    """
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"unknown dtype {dtype}, expected one of {VECTOR_DTYPES}")
+
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"no vector store at {store_dir}")
+
+    row_names, reference = load_vectors(store_dir, mmap=False)
+    keep = [i for i, name in enumerate(row_names) if name is not None]
+    names = [row_names[i] for i in keep]
+    reference = np.ascontiguousarray(reference[keep])
+
+    metric = default_metric(dtype)
+    stored_rows = encode_rows(reference, dtype, metric)
+
+    old_segments = manifest['segments']
+    seg_num = max([s['num'] for s in old_segments], default=0) + 1
+    manifest['segments'] = [_write_segment(store_dir, seg_num, names, stored_rows)]
+    manifest['dtype'] = dtype
+    manifest['metric'] = metric
+    manifest['generation'] = manifest.get('generation', 0) + 1
+    manifest['version'] += 1
+    _atomic_write_json(manifest_path(store_dir), manifest)
+    _remove_segment_files(store_dir, old_segments)
+
+    print(f"converted {store_dir} to {dtype} ({len(names)} rows, {stored_rows.nbytes / 1024**2:.2f}MB"
+          f" from {reference.nbytes / 1024**2:.2f}MB)")
+    return reference, decode_rows(stored_rows)
+
+
+def _remove_segment_files(store_dir, segments):
+    for seg in segments:
+        for filename in (seg['file'], seg['ids']):
+            try:
+                os.remove(os.path.join(store_dir, filename))
+            except FileNotFoundError:
+                pass
+
+
+def migrate_pickle_to_vector_store(pickle_file, descriptions_file, store_dir):
+    """
+    one-shot migration of a legacy embeddings.pkl, row i belongs to the i-th key of descriptions.json
+    """
+    with open(pickle_file, 'rb') as file:
+        embeddings = np.asarray(pickle.load(file), dtype='float32')
+    with open(descriptions_file, 'r') as file:
+        names = list(json.load(file).keys())
+
+    if len(names) != embeddings.shape[0]:
+        print(f"migrate: {len(names)} descriptions for {embeddings.shape[0]} embeddings, keeping the overlap")
+    n = min(len(names), embeddings.shape[0])
+
+    append_vectors(store_dir, names[:n], embeddings[:n], create_new=True)
+    print(f"migrated {pickle_file} -> {store_dir} ({n} rows)")
+
+
+def ensure_vector_store(store_dir):
+    """
+    True if the store exists, migrating a legacy embeddings.pkl in the album dir first if there is one
+    """
+    if read_manifest(store_dir) is not None:
+        return True
+
+    album_dir = os.path.dirname(store_dir)
+    pickle_file = os.path.join(album_dir, LEGACY_PICKLE_FILENAME)
+    descriptions_file = os.path.join(album_dir, DESCR_FILENAME)
+    if os.path.exists(pickle_file) and os.path.exists(descriptions_file):
+        migrate_pickle_to_vector_store(pickle_file, descriptions_file, store_dir)
+        return True
+
+    return False
+
+
+if __name__ == '__main__':
+    """
+    python vector_store.py migrate <album_dir>
+    python vector_store.py compact <album_dir>
+    python vector_store.py convert <album_dir> <float32|float16|int8>
+    """
+    command = sys.argv[1]
+    album_store_dir = get_store_dir(sys.argv[2])
+
+    if command == 'migrate':
+        ensure_vector_store(album_store_dir)
+    elif command == 'compact':
+        compact_vector_store(album_store_dir)
+    elif command == 'convert':
+        from index_manager import ranking_agreement
+
+        target_dtype = sys.argv[3]
+        reference_vectors, converted_vectors = convert_vector_store(album_store_dir, target_dtype)
+        #ranking agreement of the converted album against the float32 L2 results
+        print(ranking_agreement(reference_vectors, converted_vectors, target_dtype))
+    else:
+        print(f"unknown command: {command}")